@@ -0,0 +1,79 @@
+"""Add BOM transitive-closure table (composicao_fechamento).
+
+Revision ID: 004
+Revises: 003
+Create Date: 2026-10-18
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "004"
+down_revision: Union[str, None] = "003"
+branch_labels: Union[str, None] = None
+depends_on: Union[str, None] = None
+
+# Mesma profundidade máxima das antigas consultas recursivas (settings.BOM_MAX_DEPTH)
+MAX_DEPTH = 10
+
+
+def upgrade() -> None:
+    # 1. Fechamento transitivo da estrutura: uma linha por (composição, descendente),
+    #    com o coeficiente acumulado somado sobre todos os caminhos e o menor nível.
+    op.create_table(
+        "composicao_fechamento",
+        sa.Column("composicao_codigo", sa.Integer(), nullable=False),
+        sa.Column("tipo_item", sa.String(length=20), nullable=False),
+        sa.Column("item_codigo", sa.Integer(), nullable=False),
+        sa.Column("coeficiente_total", sa.Numeric(), nullable=True),
+        sa.Column("nivel_min", sa.SmallInteger(), nullable=False),
+        sa.Column("updated_at", sa.TIMESTAMP(timezone=True), server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint("composicao_codigo", "tipo_item", "item_codigo"),
+    )
+    # Onde-usado: busca reversa pelo descendente
+    op.create_index(
+        "ix_composicao_fechamento_item",
+        "composicao_fechamento",
+        ["item_codigo", "tipo_item"],
+    )
+
+    # 2. Assinatura dos itens diretos de cada composição na última reconstrução,
+    #    usada para recalcular apenas as composições alteradas (e seus ancestrais).
+    op.create_table(
+        "composicao_fechamento_estado",
+        sa.Column("composicao_codigo", sa.Integer(), nullable=False),
+        sa.Column("assinatura", sa.String(length=32), nullable=False),
+        sa.Column("updated_at", sa.TIMESTAMP(timezone=True), server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint("composicao_codigo"),
+    )
+
+    # 3. Carga inicial
+    op.execute(f"""
+        INSERT INTO composicao_fechamento (composicao_codigo, tipo_item, item_codigo, coeficiente_total, nivel_min)
+        WITH RECURSIVE fechamento (composicao_codigo, item_codigo, tipo_item, coeficiente_total, nivel) AS (
+            SELECT composicao_pai_codigo, item_codigo, tipo_item, CAST(coeficiente AS numeric), 1
+            FROM vw_composicao_itens_unificados
+            UNION ALL
+            SELECT f.composicao_codigo, v.item_codigo, v.tipo_item, f.coeficiente_total * v.coeficiente, f.nivel + 1
+            FROM vw_composicao_itens_unificados v
+            JOIN fechamento f ON v.composicao_pai_codigo = f.item_codigo
+            WHERE f.tipo_item = 'COMPOSICAO' AND f.nivel < {MAX_DEPTH}
+        )
+        SELECT composicao_codigo, tipo_item, item_codigo, SUM(coeficiente_total), MIN(nivel)
+        FROM fechamento
+        GROUP BY composicao_codigo, tipo_item, item_codigo
+    """)
+    op.execute("""
+        INSERT INTO composicao_fechamento_estado (composicao_codigo, assinatura)
+        SELECT composicao_pai_codigo,
+               md5(string_agg(tipo_item || ':' || item_codigo || ':' || COALESCE(coeficiente::text, ''),
+                              ',' ORDER BY tipo_item, item_codigo))
+        FROM vw_composicao_itens_unificados
+        GROUP BY composicao_pai_codigo
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table("composicao_fechamento_estado")
+    op.drop_index("ix_composicao_fechamento_item", table_name="composicao_fechamento")
+    op.drop_table("composicao_fechamento")
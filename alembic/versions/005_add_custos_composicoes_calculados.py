@@ -0,0 +1,48 @@
+"""Add table for batch cost roll-up results (custos_composicoes_calculados).
+
+Revision ID: 005
+Revises: 004
+Create Date: 2026-10-18
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "005"
+down_revision: Union[str, None] = "004"
+branch_labels: Union[str, None] = None
+depends_on: Union[str, None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "custos_composicoes_calculados",
+        sa.Column("composicao_codigo", sa.Integer(), nullable=False),
+        sa.Column("uf", sa.CHAR(length=2), nullable=False),
+        sa.Column("data_referencia", sa.Date(), nullable=False),
+        sa.Column("regime", sa.String(length=50), nullable=False),
+        sa.Column("custo_calculado", sa.Numeric(precision=14, scale=4), nullable=True),
+        sa.Column("custo_oficial", sa.Numeric(precision=14, scale=2), nullable=True),
+        sa.Column("diferenca", sa.Numeric(precision=14, scale=4), nullable=True),
+        sa.Column("diferenca_percentual", sa.Numeric(precision=10, scale=4), nullable=True),
+        sa.Column("mao_de_obra", sa.Numeric(precision=14, scale=4), nullable=True),
+        sa.Column("material", sa.Numeric(precision=14, scale=4), nullable=True),
+        sa.Column("equipamento", sa.Numeric(precision=14, scale=4), nullable=True),
+        sa.Column("total_hh", sa.Numeric(precision=14, scale=6), nullable=True),
+        sa.Column("itens_sem_preco", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("divergente", sa.Boolean(), nullable=False, server_default=sa.false()),
+        sa.Column("created_at", sa.TIMESTAMP(timezone=True), server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint("composicao_codigo", "uf", "data_referencia", "regime"),
+    )
+    # Consulta das divergências de uma fatia (UF, mês, regime)
+    op.create_index(
+        "ix_custos_calculados_divergentes",
+        "custos_composicoes_calculados",
+        ["uf", "data_referencia", "regime"],
+        postgresql_where=sa.text("divergente"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_custos_calculados_divergentes", table_name="custos_composicoes_calculados")
+    op.drop_table("custos_composicoes_calculados")
@@ -0,0 +1,41 @@
+"""Add pg_trgm/unaccent GIN indexes for accent-insensitive description search.
+
+Revision ID: 006
+Revises: 005
+Create Date: 2026-10-18
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "006"
+down_revision: Union[str, None] = "005"
+branch_labels: Union[str, None] = None
+depends_on: Union[str, None] = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.execute("CREATE EXTENSION IF NOT EXISTS unaccent")
+    # unaccent() é STABLE (depende do search_path); o invólucro com dicionário
+    # explícito é IMMUTABLE e pode ser usado em índices de expressão.
+    op.execute("""
+        CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+        AS $$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$
+    """)
+    # Mesma expressão usada pelas buscas em `crud` (lower + f_unaccent)
+    op.execute("""
+        CREATE INDEX IF NOT EXISTS idx_insumos_descricao_trgm
+        ON insumos USING gin (f_unaccent(lower(descricao)) gin_trgm_ops)
+    """)
+    op.execute("""
+        CREATE INDEX IF NOT EXISTS idx_composicoes_descricao_trgm
+        ON composicoes USING gin (f_unaccent(lower(descricao)) gin_trgm_ops)
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS idx_composicoes_descricao_trgm")
+    op.execute("DROP INDEX IF EXISTS idx_insumos_descricao_trgm")
+    op.execute("DROP FUNCTION IF EXISTS f_unaccent(text)")
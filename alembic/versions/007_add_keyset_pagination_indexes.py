@@ -0,0 +1,38 @@
+"""Add (descricao, codigo) indexes for keyset pagination of the search endpoints.
+
+Revision ID: 007
+Revises: 006
+Create Date: 2026-10-18
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "007"
+down_revision: Union[str, None] = "006"
+branch_labels: Union[str, None] = None
+depends_on: Union[str, None] = None
+
+
+def upgrade() -> None:
+    # Chave de ordenação da paginação por cursor: (descricao, codigo) > (:descricao, :codigo)
+    op.create_index("idx_insumos_descricao_codigo", "insumos", ["descricao", "codigo"])
+    op.create_index("idx_composicoes_descricao_codigo", "composicoes", ["descricao", "codigo"])
+    # Mesma chave dentro de uma classificação / grupo (filtros UPPER(...) = UPPER(:valor) de `crud`)
+    op.create_index(
+        "idx_insumos_classificacao_descricao_codigo",
+        "insumos",
+        [sa.text("upper(classificacao)"), "descricao", "codigo"],
+    )
+    op.create_index(
+        "idx_composicoes_grupo_descricao_codigo",
+        "composicoes",
+        [sa.text("upper(grupo)"), "descricao", "codigo"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("idx_composicoes_grupo_descricao_codigo", table_name="composicoes")
+    op.drop_index("idx_insumos_classificacao_descricao_codigo", table_name="insumos")
+    op.drop_index("idx_composicoes_descricao_codigo", table_name="composicoes")
+    op.drop_index("idx_insumos_descricao_codigo", table_name="insumos")
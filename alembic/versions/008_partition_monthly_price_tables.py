@@ -0,0 +1,102 @@
+"""Convert precos_insumos_mensal and custos_composicoes_mensal to monthly range partitions.
+
+Revision ID: 008
+Revises: 007
+Create Date: 2026-10-18
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "008"
+down_revision: Union[str, None] = "007"
+branch_labels: Union[str, None] = None
+depends_on: Union[str, None] = None
+
+# tabela -> (colunas da chave primária, índice em updated_at criado na migração 002)
+TABLES = {
+    "precos_insumos_mensal": (["insumo_codigo", "uf", "data_referencia", "regime"], "idx_precos_updated_at"),
+    "custos_composicoes_mensal": (["composicao_codigo", "uf", "data_referencia", "regime"], "idx_custos_updated_at"),
+}
+
+
+def upgrade() -> None:
+    # Cria (se preciso) a partição mensal de uma tabela particionada por data_referencia.
+    # Linhas do mês que já estejam na partição default são movidas para a nova partição.
+    # Em tabelas não particionadas (ex.: cópias do sandbox) não faz nada e retorna NULL.
+    op.execute("""
+        CREATE OR REPLACE FUNCTION sinapi_ensure_month_partition(p_table text, p_month date)
+        RETURNS text LANGUAGE plpgsql AS $$
+        DECLARE
+            v_start date := date_trunc('month', p_month)::date;
+            v_end date := (date_trunc('month', p_month) + interval '1 month')::date;
+            v_name text := p_table || '_' || to_char(v_start, 'YYYY_MM');
+            v_default text := p_table || '_default';
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(p_table)) THEN
+                RETURN NULL;
+            END IF;
+            IF to_regclass(v_name) IS NOT NULL THEN
+                RETURN v_name;
+            END IF;
+            EXECUTE format('CREATE TEMP TABLE sinapi_pendentes ON COMMIT DROP AS '
+                           'SELECT * FROM %I WHERE data_referencia >= %L AND data_referencia < %L',
+                           v_default, v_start, v_end);
+            EXECUTE format('DELETE FROM %I WHERE data_referencia >= %L AND data_referencia < %L',
+                           v_default, v_start, v_end);
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                           v_name, p_table, v_start, v_end);
+            EXECUTE format('INSERT INTO %I SELECT * FROM sinapi_pendentes', p_table);
+            DROP TABLE sinapi_pendentes;
+            RETURN v_name;
+        END $$
+    """)
+    # Desanexa a partição de um mês: o mês some da tabela em O(1) e os dados ficam
+    # na tabela avulsa retornada, que pode ser descartada ou reanexada.
+    op.execute("""
+        CREATE OR REPLACE FUNCTION sinapi_detach_month_partition(p_table text, p_month date)
+        RETURNS text LANGUAGE plpgsql AS $$
+        DECLARE
+            v_name text := p_table || '_' || to_char(date_trunc('month', p_month), 'YYYY_MM');
+        BEGIN
+            IF to_regclass(v_name) IS NULL THEN
+                RETURN NULL;
+            END IF;
+            EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', p_table, v_name);
+            RETURN v_name;
+        END $$
+    """)
+
+    for table, (pk_columns, updated_index) in TABLES.items():
+        legacy = f"{table}_legacy"
+        op.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        op.execute(f"ALTER TABLE {legacy} RENAME CONSTRAINT {table}_pkey TO {legacy}_pkey")
+        op.execute(f"ALTER INDEX {updated_index} RENAME TO {updated_index}_legacy")
+        op.execute(f"""
+            CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+            PARTITION BY RANGE (data_referencia)
+        """)
+        op.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+        op.execute(f"""
+            SELECT sinapi_ensure_month_partition('{table}', mes)
+            FROM (SELECT DISTINCT date_trunc('month', data_referencia)::date AS mes FROM {legacy}) AS meses
+        """)
+        op.execute(f"INSERT INTO {table} SELECT * FROM {legacy}")
+        op.execute(f"DROP TABLE {legacy}")
+        op.execute(f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY ({', '.join(pk_columns)})")
+        op.create_index(updated_index, table, ["updated_at"])
+
+
+def downgrade() -> None:
+    for table, (pk_columns, updated_index) in TABLES.items():
+        partitioned = f"{table}_partitioned"
+        op.execute(f"ALTER TABLE {table} RENAME TO {partitioned}")
+        op.execute(f"ALTER TABLE {partitioned} RENAME CONSTRAINT {table}_pkey TO {partitioned}_pkey")
+        op.execute(f"ALTER INDEX {updated_index} RENAME TO {updated_index}_partitioned")
+        op.execute(f"CREATE TABLE {table} (LIKE {partitioned} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        op.execute(f"INSERT INTO {table} SELECT * FROM {partitioned}")
+        op.execute(f"DROP TABLE {partitioned} CASCADE")
+        op.execute(f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY ({', '.join(pk_columns)})")
+        op.create_index(updated_index, table, ["updated_at"])
+    op.execute("DROP FUNCTION IF EXISTS sinapi_detach_month_partition(text, date)")
+    op.execute("DROP FUNCTION IF EXISTS sinapi_ensure_month_partition(text, date)")
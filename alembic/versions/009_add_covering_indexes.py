@@ -0,0 +1,63 @@
+"""Add covering indexes for the hot price/cost lookups and the reverse structure edges.
+
+Revision ID: 009
+Revises: 008
+Create Date: 2026-10-18
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "009"
+down_revision: Union[str, None] = "008"
+branch_labels: Union[str, None] = None
+depends_on: Union[str, None] = None
+
+
+def upgrade() -> None:
+    # Fatia (UF, regime, mês) das consultas de `crud`: com o código no fim e o valor
+    # incluído, lookups, buscas, tendências e roll-up leem só o índice (index-only scan).
+    # Criados na tabela particionada (migração 008), valem para todas as partições.
+    op.create_index(
+        "idx_precos_uf_regime_data_insumo",
+        "precos_insumos_mensal",
+        ["uf", "regime", "data_referencia", "insumo_codigo"],
+        postgresql_include=["preco_mediano"],
+    )
+    op.create_index(
+        "idx_custos_uf_regime_data_composicao",
+        "custos_composicoes_mensal",
+        ["uf", "regime", "data_referencia", "composicao_codigo"],
+        postgresql_include=["custo_total"],
+    )
+    # Arestas reversas da estrutura (onde um item é usado); as chaves primárias só
+    # atendem a busca pelo pai.
+    op.create_index(
+        "idx_composicao_insumos_filho",
+        "composicao_insumos",
+        ["insumo_filho_codigo"],
+        postgresql_include=["composicao_pai_codigo", "coeficiente"],
+    )
+    op.create_index(
+        "idx_composicao_subcomposicoes_filho",
+        "composicao_subcomposicoes",
+        ["composicao_filho_codigo"],
+        postgresql_include=["composicao_pai_codigo", "coeficiente"],
+    )
+    # Onde-usado pelo fechamento transitivo: o índice da migração 004 passa a cobrir a consulta
+    op.drop_index("ix_composicao_fechamento_item", table_name="composicao_fechamento")
+    op.create_index(
+        "idx_composicao_fechamento_item",
+        "composicao_fechamento",
+        ["item_codigo", "tipo_item"],
+        postgresql_include=["composicao_codigo", "coeficiente_total", "nivel_min"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("idx_composicao_fechamento_item", table_name="composicao_fechamento")
+    op.create_index("ix_composicao_fechamento_item", "composicao_fechamento", ["item_codigo", "tipo_item"])
+    op.drop_index("idx_composicao_subcomposicoes_filho", table_name="composicao_subcomposicoes")
+    op.drop_index("idx_composicao_insumos_filho", table_name="composicao_insumos")
+    op.drop_index("idx_custos_uf_regime_data_composicao", table_name="custos_composicoes_mensal")
+    op.drop_index("idx_precos_uf_regime_data_insumo", table_name="precos_insumos_mensal")
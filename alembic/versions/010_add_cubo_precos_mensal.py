@@ -0,0 +1,90 @@
+"""Add pre-aggregated price cube (cubo_precos_mensal) for trends and regional drill-down.
+
+Revision ID: 010
+Revises: 009
+Create Date: 2026-10-18
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "010"
+down_revision: Union[str, None] = "009"
+branch_labels: Union[str, None] = None
+depends_on: Union[str, None] = None
+
+# Mesmas macrorregiões de maintenance.MACRORREGIOES
+MACRORREGIOES = {
+    "NORTE": ("AC", "AP", "AM", "PA", "RO", "RR", "TO"),
+    "NORDESTE": ("AL", "BA", "CE", "MA", "PB", "PE", "PI", "RN", "SE"),
+    "CENTRO_OESTE": ("DF", "GO", "MT", "MS"),
+    "SUDESTE": ("ES", "MG", "RJ", "SP"),
+    "SUL": ("PR", "RS", "SC"),
+}
+
+# tipo_item -> (tabela de valores, tabela de itens, coluna do item, coluna da categoria, coluna do valor)
+SOURCES = {
+    "INSUMO": ("precos_insumos_mensal", "insumos", "insumo_codigo", "classificacao", "preco_mediano"),
+    "COMPOSICAO": ("custos_composicoes_mensal", "composicoes", "composicao_codigo", "grupo", "custo_total"),
+}
+
+
+def upgrade() -> None:
+    # Uma linha por (tipo, nível, local, regime, mês, categoria). Nível 'UF' (local = UF),
+    # 'REGIAO' (local = macrorregião) ou 'BRASIL' (local = 'BR').
+    op.create_table(
+        "cubo_precos_mensal",
+        sa.Column("tipo_item", sa.String(length=20), nullable=False),
+        sa.Column("nivel", sa.String(length=10), nullable=False),
+        sa.Column("local", sa.String(length=20), nullable=False),
+        sa.Column("regiao", sa.String(length=20), nullable=True),
+        sa.Column("categoria", sa.Text(), nullable=False),
+        sa.Column("data_referencia", sa.Date(), nullable=False),
+        sa.Column("regime", sa.String(length=50), nullable=False),
+        sa.Column("preco_medio", sa.Numeric(precision=14, scale=4), nullable=True),
+        sa.Column("preco_mediano", sa.Numeric(precision=14, scale=4), nullable=True),
+        sa.Column("preco_min", sa.Numeric(precision=14, scale=2), nullable=True),
+        sa.Column("preco_max", sa.Numeric(precision=14, scale=2), nullable=True),
+        sa.Column("qtd_precos", sa.Integer(), nullable=False),
+        sa.Column("qtd_itens", sa.Integer(), nullable=False),
+        sa.Column("updated_at", sa.TIMESTAMP(timezone=True), server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint("tipo_item", "nivel", "local", "regime", "data_referencia", "categoria"),
+    )
+    # Detalhamento de uma macrorregião: as UFs dela
+    op.create_index(
+        "idx_cubo_precos_regiao",
+        "cubo_precos_mensal",
+        ["tipo_item", "regiao", "nivel", "regime", "data_referencia"],
+    )
+
+    # Carga inicial, com todos os meses já carregados
+    ufs = [uf for regiao in MACRORREGIOES.values() for uf in regiao]
+    regioes = [regiao for regiao, membros in MACRORREGIOES.items() for _ in membros]
+    mapa = ", ".join(f"('{uf}', '{regiao}')" for uf, regiao in zip(ufs, regioes))
+    for tipo_item, (table_val, table_item, col_item, col_group, val_name) in SOURCES.items():
+        categoria = f"""
+            CASE
+                WHEN i.{col_group} IS NULL OR TRIM(i.{col_group}) = '' OR UPPER(TRIM(i.{col_group})) = 'NAO_CLASSIFICADO' THEN 'GERAL'
+                ELSE UPPER(TRIM(i.{col_group}))
+            END"""
+        op.execute(f"""
+            INSERT INTO cubo_precos_mensal (
+                tipo_item, nivel, local, regiao, categoria, data_referencia, regime,
+                preco_medio, preco_mediano, preco_min, preco_max, qtd_precos, qtd_itens
+            )
+            SELECT '{tipo_item}',
+                   CASE WHEN GROUPING(p.uf) = 0 THEN 'UF' WHEN GROUPING(r.regiao) = 0 THEN 'REGIAO' ELSE 'BRASIL' END,
+                   CASE WHEN GROUPING(p.uf) = 0 THEN p.uf WHEN GROUPING(r.regiao) = 0 THEN r.regiao ELSE 'BR' END,
+                   r.regiao, {categoria}, p.data_referencia, p.regime,
+                   AVG(p.{val_name}), percentile_cont(0.5) WITHIN GROUP (ORDER BY p.{val_name}),
+                   MIN(p.{val_name}), MAX(p.{val_name}), COUNT(p.{val_name}), COUNT(DISTINCT i.codigo)
+            FROM {table_val} p
+            JOIN {table_item} i ON i.codigo = p.{col_item}
+            JOIN (VALUES {mapa}) AS r(uf, regiao) ON r.uf = p.uf
+            GROUP BY p.data_referencia, p.regime, {categoria}, GROUPING SETS ((r.regiao, p.uf), (r.regiao), ())
+        """)
+
+
+def downgrade() -> None:
+    op.drop_index("idx_cubo_precos_regiao", table_name="cubo_precos_mensal")
+    op.drop_table("cubo_precos_mensal")
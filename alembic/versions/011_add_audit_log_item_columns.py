@@ -0,0 +1,65 @@
+"""Add generated item columns and keyset indexes to sinapi_audit_log.
+
+Revision ID: 011
+Revises: 010
+Create Date: 2026-10-18
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "011"
+down_revision: Union[str, None] = "010"
+branch_labels: Union[str, None] = None
+depends_on: Union[str, None] = None
+
+# Chave do item no record_pk: 'codigo' (tabelas insumos/composicoes) ou a coluna da tabela mensal
+ITEM_KEY = "COALESCE(record_pk->>'codigo', record_pk->>'insumo_codigo', record_pk->>'composicao_codigo')"
+
+
+def upgrade() -> None:
+    # Colunas geradas a partir do record_pk gravado pelo toolkit: nenhuma mudança na carga.
+    # Valores fora do formato esperado viram NULL em vez de falhar o INSERT.
+    op.execute(f"""
+        ALTER TABLE sinapi_audit_log
+            ADD COLUMN item_codigo integer GENERATED ALWAYS AS (
+                CASE WHEN {ITEM_KEY} ~ '^[0-9]{{1,9}}$' THEN ({ITEM_KEY})::integer END
+            ) STORED,
+            ADD COLUMN tipo_item varchar(20) GENERATED ALWAYS AS (
+                CASE
+                    WHEN record_pk ? 'codigo' THEN
+                        CASE
+                            WHEN table_name IN ('insumos', 'sandbox_insumos') THEN 'INSUMO'
+                            WHEN table_name IN ('composicoes', 'sandbox_composicoes') THEN 'COMPOSICAO'
+                        END
+                    WHEN record_pk ? 'insumo_codigo' THEN 'INSUMO'
+                    WHEN record_pk ? 'composicao_codigo' THEN 'COMPOSICAO'
+                END
+            ) STORED,
+            ADD COLUMN data_referencia date GENERATED ALWAYS AS (
+                CASE WHEN record_pk->>'data_referencia' ~ '^[0-9]{{4}}[-./](0[1-9]|1[0-2])'
+                     THEN make_date(substr(record_pk->>'data_referencia', 1, 4)::integer,
+                                    substr(record_pk->>'data_referencia', 6, 2)::integer, 1)
+                END
+            ) STORED
+    """)
+    # Histórico de um item, do mais recente para o mais antigo, paginado por (created_at, id)
+    op.create_index(
+        "idx_audit_item",
+        "sinapi_audit_log",
+        ["tipo_item", "item_codigo", "created_at", "id"],
+    )
+    # O mesmo, restrito a um mês de referência
+    op.create_index(
+        "idx_audit_item_data",
+        "sinapi_audit_log",
+        ["tipo_item", "item_codigo", "data_referencia", "created_at", "id"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("idx_audit_item_data", table_name="sinapi_audit_log")
+    op.drop_index("idx_audit_item", table_name="sinapi_audit_log")
+    op.drop_column("sinapi_audit_log", "data_referencia")
+    op.drop_column("sinapi_audit_log", "tipo_item")
+    op.drop_column("sinapi_audit_log", "item_codigo")
@@ -0,0 +1,43 @@
+"""Add generated composicao_codigo column and keyset index to sinapi_audit_log.
+
+Revision ID: 012
+Revises: 011
+Create Date: 2026-10-18
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "012"
+down_revision: Union[str, None] = "011"
+branch_labels: Union[str, None] = None
+depends_on: Union[str, None] = None
+
+
+def upgrade() -> None:
+    # Linhas de estrutura (ex.: composicao_insumos) têm 'composicao_codigo' e 'insumo_codigo'
+    # no record_pk; a migração 011 as registra sob o insumo (item_codigo). Esta coluna guarda
+    # a composição delas, só quando ela não é o próprio item (tipo_item <> 'COMPOSICAO'),
+    # para o histórico da composição sem repetir as linhas de item_codigo.
+    op.execute("""
+        ALTER TABLE sinapi_audit_log
+            ADD COLUMN composicao_codigo integer GENERATED ALWAYS AS (
+                CASE
+                    WHEN record_pk ? 'codigo' AND table_name IN ('composicoes', 'sandbox_composicoes') THEN NULL
+                    WHEN (record_pk ? 'codigo' OR record_pk ? 'insumo_codigo')
+                         AND record_pk->>'composicao_codigo' ~ '^[0-9]{1,9}$'
+                    THEN (record_pk->>'composicao_codigo')::integer
+                END
+            ) STORED
+    """)
+    op.create_index(
+        "idx_audit_composicao",
+        "sinapi_audit_log",
+        ["composicao_codigo", "created_at", "id"],
+        postgresql_where=sa.text("composicao_codigo IS NOT NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("idx_audit_composicao", table_name="sinapi_audit_log")
+    op.drop_column("sinapi_audit_log", "composicao_codigo")
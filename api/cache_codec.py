@@ -0,0 +1,153 @@
+"""
+Codec dos valores armazenados no cache Redis.
+
+Cada valor gravado é composto por 1 byte de cabeçalho seguido do payload:
+
+    bits 7-4: versão do formato (atualmente 1)
+    bits 3-2: serializador (0 = json, 1 = orjson, 2 = msgpack)
+    bits 1-0: compressão   (0 = nenhuma, 1 = zlib, 2 = zstd, 3 = lz4)
+
+Com a versão 1 o cabeçalho fica entre 0x10 e 0x1F, faixa que nunca inicia um
+texto JSON válido. Assim, entradas antigas gravadas como JSON puro (sem
+cabeçalho) continuam sendo lidas durante a transição.
+
+Os serializadores e compressores binários são dependências opcionais: se a
+biblioteca configurada não estiver instalada, o codec recai em `json`/`zlib`.
+"""
+
+import json
+import zlib
+import logging
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depende do ambiente
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - depende do ambiente
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - depende do ambiente
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # pragma: no cover - depende do ambiente
+    lz4_frame = None
+
+FORMAT_VERSION = 1
+
+SERIALIZER_JSON = 0
+SERIALIZER_ORJSON = 1
+SERIALIZER_MSGPACK = 2
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+COMPRESSION_LZ4 = 3
+
+_SERIALIZERS = {"json": SERIALIZER_JSON, "orjson": SERIALIZER_ORJSON, "msgpack": SERIALIZER_MSGPACK}
+_COMPRESSIONS = {"none": COMPRESSION_NONE, "zlib": COMPRESSION_ZLIB, "zstd": COMPRESSION_ZSTD, "lz4": COMPRESSION_LZ4}
+
+_json_encoder = None
+
+
+def _default(obj):
+    """Fallback para tipos não suportados nativamente (Decimal, Row, etc.)."""
+    global _json_encoder
+    if _json_encoder is None:
+        from .cache_utils import CustomJSONEncoder
+        _json_encoder = CustomJSONEncoder()
+    return _json_encoder.default(obj)
+
+
+def _available_serializer(name: str) -> int:
+    serializer = _SERIALIZERS.get(name, SERIALIZER_JSON)
+    if serializer == SERIALIZER_ORJSON and orjson is None:
+        return SERIALIZER_JSON
+    if serializer == SERIALIZER_MSGPACK and msgpack is None:
+        return SERIALIZER_JSON
+    return serializer
+
+
+def _available_compression(name: str) -> int:
+    compression = _COMPRESSIONS.get(name, COMPRESSION_ZLIB)
+    if compression == COMPRESSION_ZSTD and zstandard is None:
+        return COMPRESSION_ZLIB
+    if compression == COMPRESSION_LZ4 and lz4_frame is None:
+        return COMPRESSION_ZLIB
+    return compression
+
+
+def _serialize(value, serializer: int) -> bytes:
+    if serializer == SERIALIZER_ORJSON:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    if serializer == SERIALIZER_MSGPACK:
+        return msgpack.packb(value, default=_default, use_bin_type=True)
+    return json.dumps(value, default=_default).encode("utf-8")
+
+
+def _deserialize(payload: bytes, serializer: int):
+    if serializer == SERIALIZER_ORJSON:
+        return orjson.loads(payload)
+    if serializer == SERIALIZER_MSGPACK:
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+    return json.loads(payload)
+
+
+def _compress(payload: bytes, compression: int) -> bytes:
+    if compression == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor(level=settings.CACHE_COMPRESSION_LEVEL).compress(payload)
+    if compression == COMPRESSION_LZ4:
+        return lz4_frame.compress(payload)
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(payload, settings.CACHE_COMPRESSION_LEVEL)
+    return payload
+
+
+def _decompress(payload: bytes, compression: int) -> bytes:
+    if compression == COMPRESSION_ZSTD:
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if compression == COMPRESSION_LZ4:
+        return lz4_frame.decompress(payload)
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompress(payload)
+    return payload
+
+
+def encode(value) -> bytes:
+    """
+    Serializa um valor para gravação no Redis, comprimindo o payload quando ele
+    ultrapassa `CACHE_COMPRESSION_MIN_BYTES`.
+    """
+    serializer = _available_serializer(settings.CACHE_SERIALIZER)
+    payload = _serialize(value, serializer)
+    compression = COMPRESSION_NONE
+    if len(payload) >= settings.CACHE_COMPRESSION_MIN_BYTES:
+        compression = _available_compression(settings.CACHE_COMPRESSION)
+        payload = _compress(payload, compression)
+    header = (FORMAT_VERSION << 4) | (serializer << 2) | compression
+    return bytes((header,)) + payload
+
+
+def decode(raw):
+    """
+    Desserializa um valor lido do Redis. Aceita tanto o formato com cabeçalho
+    quanto o JSON texto legado (bytes ou str).
+    """
+    if isinstance(raw, str):
+        return json.loads(raw)
+    header = raw[0]
+    if header >> 4 != FORMAT_VERSION:
+        return json.loads(raw)
+    serializer = (header >> 2) & 0b11
+    compression = header & 0b11
+    return _deserialize(_decompress(raw[1:], compression), serializer)
@@ -1,12 +1,22 @@
+import os
 import json
-import redis
+import inspect
+import hashlib
+import time
+import fnmatch
 import functools
 import logging
 import decimal
 import datetime
+import threading
+from collections import OrderedDict, Counter
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from typing import Optional
 from .config import settings
 from .sandbox_utils import is_sandbox_mode
+from . import cache_codec
+from .redis_pool import get_redis_client, get_pubsub_client
 
 logger = logging.getLogger(__name__)
 
@@ -24,19 +34,276 @@ class CustomJSONEncoder(json.JSONEncoder):
             return obj.__dict__
         return super().default(obj)
 
-# Cliente Redis centralizado
-redis_client = redis.Redis(
-    host=settings.REDIS_HOST, 
-    port=settings.REDIS_PORT, 
-    db=0, 
-    decode_responses=True
-)
+# Cliente Redis compartilhado (pool, timeouts e disjuntor em `redis_pool`)
+redis_client = get_redis_client()
+
+_MISS = object()
+_SWR_FIELD = "__swr_fresh_until__"
+_STALE_L1_TTL = 1
+
+class LocalCache:
+    """
+    Cache L1 em memória, local a cada processo (worker uvicorn ou Celery).
+    Limitado por número de entradas (LRU) e por TTL. Os valores são compartilhados
+    entre as chamadas e devem ser tratados como somente-leitura.
+    """
+    def __init__(self, max_items: int, ttl: int):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return _MISS
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return _MISS
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: int = None):
+        if self.max_items <= 0:
+            return
+        ttl = min(ttl, self.ttl) if ttl else self.ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+    def evict(self, pattern: str) -> int:
+        """Remove as entradas cujas chaves correspondem ao padrão glob (mesma sintaxe do SCAN MATCH)."""
+        with self._lock:
+            keys = [k for k in self._data if fnmatch.fnmatchcase(k, pattern)]
+            for k in keys:
+                del self._data[k]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+local_cache = LocalCache(max_items=settings.CACHE_L1_MAX_ITEMS, ttl=settings.CACHE_L1_TTL)
+
+_listener_started = False
+_listener_lock = threading.Lock()
+
+def _invalidation_listener():
+    """
+    Escuta o canal de invalidação no Redis e remove do L1 as chaves anunciadas
+    por qualquer worker (ou pela task de ETL). Em caso de queda da conexão,
+    limpa o L1 inteiro, pois mensagens podem ter sido perdidas.
+    """
+    while True:
+        try:
+            pubsub = get_pubsub_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(settings.CACHE_INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                pattern = message.get("data") if isinstance(message, dict) else None
+                if isinstance(pattern, bytes):
+                    pattern = pattern.decode("utf-8")
+                if pattern:
+                    evicted = local_cache.evict(pattern)
+                    logger.debug(f"L1 invalidado via pub/sub: {evicted} chaves para '{pattern}'")
+        except Exception as e:
+            logger.warning(f"Listener de invalidação do cache desconectado: {e}")
+            local_cache.clear()
+        time.sleep(5)
+
+def _ensure_invalidation_listener():
+    global _listener_started
+    if _listener_started or settings.CACHE_L1_MAX_ITEMS <= 0:
+        return
+    with _listener_lock:
+        if _listener_started:
+            return
+        _listener_started = True
+        threading.Thread(target=_invalidation_listener, name="cache-invalidation", daemon=True).start()
+
+def _mode_suffix() -> str:
+    return "sandbox" if is_sandbox_mode() else "prod"
+
+def _generation_key(uf: str = None, data_referencia: str = None) -> str:
+    key = f"cache:gen:{_mode_suffix()}"
+    if uf and data_referencia:
+        key += f":{uf.upper()}:{data_referencia[:7]}"
+    return key
+
+def get_generation_state(uf: str = None, data_referencia: str = None) -> tuple:
+    """
+    Retorna `(geração, atualizado_em)` do modo atual (global) ou de uma fatia
+    (UF, data_referencia). `atualizado_em` é o epoch do último incremento, ou
+    `None` se a geração nunca foi incrementada. O par fica no L1 por
+    `CACHE_GENERATION_TTL` segundos e é removido de todos os workers pelo
+    pub/sub quando a geração muda. Se o Redis não responder, retorna
+    `(None, None)`: a geração é desconhecida e o cache não deve ser usado.
+    """
+    return _read_generation(_generation_key(uf, data_referencia))
+
+def _read_generation(key: str) -> tuple:
+    state = local_cache.get(key)
+    if state is not _MISS:
+        return state
+    try:
+        generation, updated_at = redis_client.mget([key, f"{key}:ts"])
+        state = (int(generation or 0), float(updated_at) if updated_at else None)
+    except Exception as e:
+        # Sem a geração não há como saber se as entradas são atuais: não cair para a geração 0
+        logger.warning(f"Erro ao ler geração do cache '{key}': {e}")
+        return None, None
+    local_cache.set(key, state, settings.CACHE_GENERATION_TTL)
+    return state
+
+def get_generation(uf: str = None, data_referencia: str = None) -> int:
+    """
+    Retorna a geração de dados vigente do modo atual (global) ou de uma fatia
+    (UF, data_referencia). A geração compõe as chaves de cache: quando é
+    incrementada, as chaves antigas deixam de ser consultadas e expiram sozinhas.
+    `None` se o Redis não responder (ver `get_generation_state`).
+    """
+    return get_generation_state(uf, data_referencia)[0]
+
+def bump_generation(uf: str = None, data_referencia: str = None) -> None:
+    """
+    Invalida em O(1) o cache de uma fatia (UF, data_referencia) e o cache global
+    do modo atual, incrementando seus contadores de geração. Funções cacheadas
+    por fatia (`sliced=True`) de outras UFs/meses não são afetadas.
+    """
+    keys = [_generation_key()]
+    if uf and data_referencia:
+        keys.append(_generation_key(uf, data_referencia))
+    if data_referencia:
+        _record_reference_month(data_referencia)
+    _increment_generations(keys)
+
+def _increment_generations(keys: list) -> None:
+    now = time.time()
+    for key in keys:
+        local_cache.evict(key)
+        try:
+            pipe = redis_client.pipeline(transaction=True)
+            pipe.incr(key)
+            pipe.set(f"{key}:ts", now)
+            pipe.publish(settings.CACHE_INVALIDATION_CHANNEL, key)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Erro ao incrementar geração do cache '{key}': {e}")
+    logger.info(f"Geração do cache incrementada: {', '.join(keys)}")
+
+def _months_key() -> str:
+    return f"cache:months:{_mode_suffix()}"
+
+def _record_reference_month(data_referencia: str) -> None:
+    # Todos os membros têm score 0, então o ZSET fica em ordem lexicográfica ('AAAA-MM')
+    try:
+        redis_client.zadd(_months_key(), {data_referencia[:7]: 0})
+    except Exception as e:
+        logger.warning(f"Erro ao registrar mês de referência '{data_referencia}': {e}")
+    local_cache.evict(_months_key())
+
+def get_latest_reference_month() -> str:
+    """
+    Retorna o mês de referência ('AAAA-MM') mais recente já carregado pelo ETL
+    no modo atual. Sem registro no Redis, assume o mês corrente do calendário.
+    """
+    key = _months_key()
+    latest = local_cache.get(key)
+    if latest is not _MISS:
+        return latest
+    latest = datetime.date.today().strftime("%Y-%m")
+    try:
+        members = redis_client.zrange(key, -1, -1)
+        if members:
+            member = members[0]
+            latest = member.decode("utf-8") if isinstance(member, bytes) else member
+    except Exception as e:
+        logger.warning(f"Erro ao ler o mês de referência mais recente: {e}")
+    local_cache.set(key, latest, settings.CACHE_GENERATION_TTL)
+    return latest
+
+def reference_month_ttl(db, arguments: dict, ttl: int) -> int:
+    """
+    Política de TTL para `cache_result(ttl_policy=...)` baseada no mês consultado
+    (`data_referencia` ou, em intervalos, `data_fim`). Meses anteriores ao mais
+    recente carregado estão fechados e recebem `CACHE_CLOSED_MONTH_TTL`, já que
+    correções neles passam pela invalidação por geração. O mês mais recente,
+    que ainda pode ser recarregado ou retificado, recebe no máximo
+    `CACHE_LIVE_MONTH_TTL`.
+    """
+    reference = arguments.get("data_referencia") or arguments.get("data_fim")
+    try:
+        month = datetime.datetime.strptime(str(reference)[:7], "%Y-%m").strftime("%Y-%m")
+    except ValueError:
+        return ttl
+    if month < get_latest_reference_month():
+        return max(ttl, settings.CACHE_CLOSED_MONTH_TTL)
+    return min(ttl, settings.CACHE_LIVE_MONTH_TTL)
+
+_popularity_buffer = Counter()
+_popularity_lock = threading.Lock()
+_popularity_flushed_at = time.monotonic()
+
+def _popularity_key(kind: str, day: datetime.date) -> str:
+    return f"cache:popular:{_mode_suffix()}:{kind}:{day:%Y%m%d}"
+
+def track_popularity(kind: str, codigo: int) -> None:
+    """
+    Conta um acesso a um item (ex.: kind="composicao") para o ranking de
+    popularidade usado no aquecimento do cache. Os acessos são acumulados em
+    memória e enviados ao Redis em lote a cada `CACHE_POPULARITY_FLUSH_INTERVAL`
+    segundos, num sorted set diário que expira após `CACHE_POPULARITY_DAYS` dias.
+    """
+    global _popularity_flushed_at
+    with _popularity_lock:
+        _popularity_buffer[(kind, codigo)] += 1
+        if time.monotonic() - _popularity_flushed_at < settings.CACHE_POPULARITY_FLUSH_INTERVAL:
+            return
+        pending = dict(_popularity_buffer)
+        _popularity_buffer.clear()
+        _popularity_flushed_at = time.monotonic()
+
+    today = datetime.date.today()
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for (item_kind, item_codigo), count in pending.items():
+            key = _popularity_key(item_kind, today)
+            pipe.zincrby(key, count, item_codigo)
+            pipe.expire(key, settings.CACHE_POPULARITY_DAYS * 86400)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Erro ao registrar popularidade no Redis: {e}")
+
+def get_popular(kind: str, top_n: int, days: int = None) -> list:
+    """Retorna os `top_n` códigos mais acessados nos últimos `days` dias, do mais ao menos popular."""
+    days = days or settings.CACHE_POPULARITY_DAYS
+    today = datetime.date.today()
+    keys = [_popularity_key(kind, today - datetime.timedelta(days=i)) for i in range(days)]
+    try:
+        ranking = redis_client.zunion(keys, withscores=True)
+    except Exception as e:
+        logger.warning(f"Erro ao ler popularidade no Redis: {e}")
+        return []
+    ranking = sorted(ranking, key=lambda item: item[1], reverse=True)[:top_n]
+    return [int(member) for member, _ in ranking]
 
 def invalidate_cache(pattern: str):
     """
     Invalida todas as chaves de cache que correspondem a um padrão.
     Ex: invalidate_cache("cache:get_insumo_by_codigo:*") limpa cache de insumo.
+    Remove também as entradas do L1 local e publica o padrão para os demais workers.
     """
+    local_cache.evict(pattern)
+    try:
+        redis_client.publish(settings.CACHE_INVALIDATION_CHANNEL, pattern)
+    except Exception as e:
+        logger.warning(f"Erro ao publicar invalidação do cache '{pattern}': {e}")
     try:
         cursor = 0
         deleted = 0
@@ -54,46 +321,710 @@ def invalidate_cache(pattern: str):
         logger.warning(f"Erro ao invalidar cache com padrão '{pattern}': {e}")
         return 0
 
-def cache_result(ttl: int = settings.CACHE_DEFAULT_TTL):
+def _row_to_dict(row):
+    if hasattr(row, '_mapping'):
+        return dict(row._mapping)
+    # RowMapping (ex.: `[r._mapping for r in result]`) não é serializável pelo codec
+    if isinstance(row, Mapping) and not isinstance(row, dict):
+        return dict(row)
+    return row
+
+def _to_serializable(result):
+    """Converte resultado (Row, RowMapping ou lista deles) para dict serializável."""
+    if result is None:
+        return None
+    if isinstance(result, list):
+        return [_row_to_dict(row) for row in result]
+    return _row_to_dict(result)
+
+class CacheStats:
+    """
+    Contadores de uso do cache de uma função decorada, por worker: hits no L1
+    e no Redis, valores velhos servidos, misses, tempo de cálculo e bytes gravados.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.l1_hits = 0
+        self.redis_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.computations = 0
+        self.compute_seconds = 0.0
+        self.payload_bytes = 0
+
+    def record_hit(self, source: str, fresh: bool = True):
+        with self._lock:
+            if source == "l1":
+                self.l1_hits += 1
+            else:
+                self.redis_hits += 1
+            if not fresh:
+                self.stale_hits += 1
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def record_compute(self, seconds: float, payload_bytes: int):
+        with self._lock:
+            self.computations += 1
+            self.compute_seconds += seconds
+            self.payload_bytes += payload_bytes
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            hits = self.l1_hits + self.redis_hits
+            total = hits + self.misses
+            return {
+                "l1_hits": self.l1_hits,
+                "redis_hits": self.redis_hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "hit_ratio": round(hits / total, 4) if total else None,
+                "computations": self.computations,
+                "avg_compute_ms": round(self.compute_seconds / self.computations * 1000, 2) if self.computations else None,
+                "avg_payload_bytes": round(self.payload_bytes / self.computations) if self.computations else None,
+            }
+
+_stats = {}
+
+def get_cache_stats() -> dict:
+    """Retorna os contadores de cache de todas as funções decoradas neste worker."""
+    return {name: stats.snapshot() for name, stats in sorted(_stats.items())}
+
+# Argumentos cuja caixa não altera o resultado (as queries aplicam UPPER/ILIKE)
+_UPPER_ARGS = {"uf", "regime", "classificacao", "grupo"}
+_LOWER_ARGS = {"q"}
+
+def _normalize_arg(name: str, value) -> str:
+    if isinstance(value, str):
+        if name in _UPPER_ARGS:
+            value = value.upper()
+        elif name in _LOWER_ARGS:
+            value = value.lower()
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        # Listas de códigos são usadas em filtros IN: ordem e repetições não importam
+        value = ",".join(map(str, sorted(set(value), key=str)))
+    text_value = str(value)
+    if len(text_value) > settings.CACHE_KEY_MAX_ARG_LENGTH:
+        text_value = "h" + hashlib.sha1(text_value.encode("utf-8")).hexdigest()[:16]
+    return text_value
+
+def build_cache_key(func_name: str, bound_arguments: dict, generation: int, namespace_generation: int = None) -> str:
+    """
+    Monta a chave canônica de cache a partir dos argumentos já associados à
+    assinatura da função (com defaults aplicados e sem a sessão do banco), de
+    modo que chamadas posicionais e nomeadas compartilhem a mesma entrada.
+    """
+    parts = ":".join(f"{name}={_normalize_arg(name, value)}" for name, value in bound_arguments.items())
+    generations = f"g{generation}" if namespace_generation is None else f"g{generation}:n{namespace_generation}"
+    return f"cache:{func_name}:{_mode_suffix()}:{generations}:{parts}"
+
+class FrequencySketch:
+    """
+    Count-min sketch com envelhecimento, usado como filtro de admissão no
+    estilo TinyLFU: estima quantas vezes uma chave foi vista recentemente
+    usando memória fixa. A cada `width * 10` incrementos todos os contadores
+    são divididos por dois, para que a popularidade antiga se dissipe.
+    """
+    DEPTH = 4
+
+    def __init__(self, width: int):
+        self.width = 1 << max(width - 1, 1).bit_length()
+        self._mask = self.width - 1
+        self._rows = [bytearray(self.width) for _ in range(self.DEPTH)]
+        self._additions = 0
+        self._sample_size = self.width * 10
+        self._lock = threading.Lock()
+
+    def _indexes(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        return [int.from_bytes(digest[i * 4:(i + 1) * 4], "little") & self._mask for i in range(self.DEPTH)]
+
+    def increment(self, key: str) -> int:
+        """Conta uma ocorrência da chave e retorna a frequência estimada."""
+        indexes = self._indexes(key)
+        with self._lock:
+            estimate = 255
+            for row, index in zip(self._rows, indexes):
+                if row[index] < 255:
+                    row[index] += 1
+                estimate = min(estimate, row[index])
+            self._additions += 1
+            if self._additions >= self._sample_size:
+                self._rows = [bytearray(b >> 1 for b in row) for row in self._rows]
+                self._additions //= 2
+        return estimate
+
+    def estimate(self, key: str) -> int:
+        indexes = self._indexes(key)
+        with self._lock:
+            return min(row[index] for row, index in zip(self._rows, indexes))
+
+# Registra a entrada no índice do namespace (ZSET chave -> expiração, HASH chave -> bytes)
+# e mantém o total de bytes do namespace, descontando o tamanho anterior da mesma chave.
+_NAMESPACE_RECORD_SCRIPT = """
+local old = redis.call('hget', KEYS[2], ARGV[1])
+if old then
+    redis.call('decrby', KEYS[3], old)
+end
+redis.call('hset', KEYS[2], ARGV[1], ARGV[2])
+redis.call('zadd', KEYS[1], ARGV[3], ARGV[1])
+return redis.call('incrby', KEYS[3], ARGV[2])
+"""
+
+class CacheNamespace:
+    """
+    Agrupa as entradas de cache de um conjunto de funções (ex.: "search",
+    "bi"), com orçamento de memória no Redis, índice próprio das chaves e, se
+    `admission=True`, um filtro de admissão que só grava chaves vistas mais de
+    uma vez (`CACHE_ADMISSION_MIN_FREQUENCY`).
+
+    O índice permite medir e esvaziar o namespace sem SCAN. Quando o total de
+    bytes passa do orçamento, as entradas mais próximas de expirar são removidas
+    primeiro (o que também descarta do índice as que já expiraram).
+    """
+    def __init__(self, name: str, admission: bool = False):
+        self.name = name
+        self.admission = admission
+        self.sketch = FrequencySketch(settings.CACHE_ADMISSION_SKETCH_WIDTH) if admission else None
+        self.functions = []
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    @property
+    def budget(self) -> int:
+        return settings.CACHE_NAMESPACE_BUDGETS.get(self.name, settings.CACHE_NAMESPACE_DEFAULT_BUDGET)
+
+    def _redis_key(self, suffix: str) -> str:
+        return f"cache:ns:{_mode_suffix()}:{self.name}:{suffix}"
+
+    def generation(self) -> int:
+        return _read_generation(self._redis_key("gen"))[0]
+
+    def admit(self, key: str) -> bool:
+        if self.sketch is None:
+            return True
+        admitted = self.sketch.increment(key) >= settings.CACHE_ADMISSION_MIN_FREQUENCY
+        with self._lock:
+            if admitted:
+                self.admitted += 1
+            else:
+                self.rejected += 1
+        return admitted
+
+    def record_write(self, key: str, size: int, expire: int) -> None:
+        try:
+            total = redis_client.eval(
+                _NAMESPACE_RECORD_SCRIPT, 3,
+                self._redis_key("keys"), self._redis_key("sizes"), self._redis_key("bytes"),
+                key, size, int(time.time() + expire),
+            )
+            if int(total) > self.budget:
+                self.enforce_budget(int(total))
+        except Exception as e:
+            logger.warning(f"Erro ao contabilizar o namespace de cache '{self.name}': {e}")
+
+    def record_writes(self, sizes: dict, expire: int) -> None:
+        """Versão em lote de `record_write` (`{chave: tamanho}`), num único pipeline."""
+        try:
+            keys = (self._redis_key("keys"), self._redis_key("sizes"), self._redis_key("bytes"))
+            pipe = redis_client.pipeline(transaction=False)
+            for key, size in sizes.items():
+                pipe.eval(_NAMESPACE_RECORD_SCRIPT, 3, *keys, key, size, int(time.time() + expire))
+            total = max(int(t) for t in pipe.execute())
+            if total > self.budget:
+                self.enforce_budget(total)
+        except Exception as e:
+            logger.warning(f"Erro ao contabilizar o namespace de cache '{self.name}': {e}")
+
+    def enforce_budget(self, total: int) -> None:
+        """Remove entradas até o namespace ocupar no máximo 90% do orçamento."""
+        target = int(self.budget * 0.9)
+        while total > target:
+            popped = redis_client.zpopmin(self._redis_key("keys"), settings.CACHE_NAMESPACE_EVICTION_BATCH)
+            if not popped:
+                break
+            keys = [member for member, _ in popped]
+            sizes = redis_client.hmget(self._redis_key("sizes"), keys)
+            freed = sum(int(size or 0) for size in sizes)
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.unlink(*keys)
+            pipe.hdel(self._redis_key("sizes"), *keys)
+            pipe.decrby(self._redis_key("bytes"), freed)
+            pipe.execute()
+            total -= freed
+            with self._lock:
+                self.evicted += len(keys)
+        logger.info(f"Namespace de cache '{self.name}' reduzido para {total} bytes (orçamento {self.budget})")
+
+    def purge(self) -> int:
+        """
+        Esvazia o namespace: incrementa sua geração (as chaves antigas deixam de
+        ser consultadas imediatamente, em todos os workers) e remove as entradas
+        indexadas em lotes, sem SCAN. Retorna o número de chaves removidas.
+        """
+        _increment_generations([self._redis_key("gen")])
+        deleted = 0
+        try:
+            while True:
+                popped = redis_client.zpopmin(self._redis_key("keys"), settings.CACHE_NAMESPACE_EVICTION_BATCH)
+                if not popped:
+                    break
+                redis_client.unlink(*[member for member, _ in popped])
+                deleted += len(popped)
+            redis_client.delete(self._redis_key("sizes"), self._redis_key("bytes"))
+        except Exception as e:
+            logger.warning(f"Erro ao esvaziar o namespace de cache '{self.name}': {e}")
+        logger.info(f"Namespace de cache '{self.name}' esvaziado: {deleted} chaves")
+        return deleted
+
+    def snapshot(self) -> dict:
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.zcard(self._redis_key("keys"))
+            pipe.get(self._redis_key("bytes"))
+            keys, used = pipe.execute()
+        except Exception as e:
+            logger.warning(f"Erro ao ler o namespace de cache '{self.name}': {e}")
+            keys, used = None, None
+        hits = misses = 0
+        for name in self.functions:
+            counters = _stats[name].snapshot()
+            hits += counters["l1_hits"] + counters["redis_hits"]
+            misses += counters["misses"]
+        with self._lock:
+            return {
+                "keys": keys,
+                "bytes": int(used or 0) if keys is not None else None,
+                "budget_bytes": self.budget,
+                "functions": sorted(self.functions),
+                "hits": hits,
+                "misses": misses,
+                "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None,
+                "admission": self.admission,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "evicted": self.evicted,
+            }
+
+_namespaces = {}
+
+def get_namespace(name: str, admission: bool = False) -> CacheNamespace:
+    namespace = _namespaces.get(name)
+    if namespace is None:
+        namespace = _namespaces[name] = CacheNamespace(name, admission)
+    elif admission and not namespace.admission:
+        namespace.admission = True
+        namespace.sketch = FrequencySketch(settings.CACHE_ADMISSION_SKETCH_WIDTH)
+    return namespace
+
+def get_namespace_stats() -> dict:
+    """Retorna, por namespace, chaves e bytes no Redis, orçamento e contadores deste worker."""
+    return {name: namespace.snapshot() for name, namespace in sorted(_namespaces.items())}
+
+def purge_namespace(name: str) -> int:
+    """Esvazia um namespace de cache. Lança `KeyError` se ele não existir."""
+    return _namespaces[name].purge()
+
+def _read_cache(key: str, ttl: int, stats: CacheStats = None):
+    """
+    Lê a chave no L1 e depois no Redis. Retorna `(valor, fresco)`, ou
+    `(_MISS, False)` se não houver valor. Entradas com stale-while-revalidate
+    ficam num envelope com o instante em que deixam de ser frescas.
+    """
+    local_val = local_cache.get(key)
+    if local_val is not _MISS:
+        logger.debug(f"Cache L1 HIT for {key}")
+        if stats:
+            stats.record_hit("l1")
+        return local_val, True
+
+    try:
+        cached_val = redis_client.get(key)
+        if cached_val:
+            logger.debug(f"Cache HIT for {key}")
+            return _decode_entry(key, cached_val, ttl, stats)
+    except Exception as e:
+        logger.warning(f"Erro ao ler cache no Redis: {e}")
+    return _MISS, False
+
+def _decode_entry(key: str, cached_val: bytes, ttl: int, stats: CacheStats = None):
+    """Decodifica uma entrada lida do Redis, repopula o L1 e retorna `(valor, fresco)`."""
+    value = cache_codec.decode(cached_val)
+    fresh = True
+    if isinstance(value, dict) and _SWR_FIELD in value:
+        fresh_until = value[_SWR_FIELD]
+        value = value["data"]
+        fresh = time.time() < fresh_until
+        # Valor velho fica no L1 por pouco tempo, apenas enquanto o refresh acontece
+        local_cache.set(key, value, ttl if fresh else _STALE_L1_TTL)
+    else:
+        local_cache.set(key, value, ttl)
+    if stats:
+        stats.record_hit("redis", fresh)
+    return value, fresh
+
+def _read_many(keys: list, ttl: int, stats: CacheStats = None) -> dict:
+    """
+    Lê várias chaves: primeiro no L1 e, para as demais, com um único MGET no
+    Redis. Retorna `{chave: valor}` só das entradas frescas; as velhas são
+    tratadas como ausentes e recalculadas pelo chamador.
+    """
+    found = {}
+    remote = []
+    for key in keys:
+        value = local_cache.get(key)
+        if value is _MISS:
+            remote.append(key)
+            continue
+        found[key] = value
+        if stats:
+            stats.record_hit("l1")
+    if not remote:
+        return found
+    try:
+        cached_vals = redis_client.mget(remote)
+    except Exception as e:
+        logger.warning(f"Erro ao ler cache no Redis: {e}")
+        return found
+    for key, cached_val in zip(remote, cached_vals):
+        if cached_val:
+            value, fresh = _decode_entry(key, cached_val, ttl, stats)
+            if fresh:
+                found[key] = value
+    return found
+
+def _write_cache(key: str, value, ttl: int, stale_ttl: int = None, namespace: CacheNamespace = None) -> int:
+    """
+    Grava o valor no L1 e no Redis, se admitido pelo namespace. Retorna o
+    tamanho do payload codificado (0 se não foi gravado).
+    """
+    if namespace is not None and not namespace.admit(key):
+        logger.debug(f"Cache: chave não admitida no namespace '{namespace.name}': {key}")
+        return 0
+    local_cache.set(key, value, ttl)
+    payload = value
+    expire = ttl
+    if stale_ttl:
+        payload = {_SWR_FIELD: time.time() + ttl, "data": value}
+        expire = ttl + stale_ttl
+    try:
+        encoded = cache_codec.encode(payload)
+        redis_client.set(key, encoded, ex=expire)
+        logger.debug(f"Cache MISS for {key}. Stored result.")
+    except Exception as e:
+        logger.warning(f"Erro ao salvar no cache Redis: {e}")
+        return 0
+    if namespace is not None:
+        namespace.record_write(key, len(encoded), expire)
+    return len(encoded)
+
+def _write_many(entries: dict, ttl: int, stale_ttl: int = None, namespace: CacheNamespace = None) -> int:
+    """
+    Versão em lote de `_write_cache`: grava `{chave: valor}` no L1 e no Redis
+    num único pipeline. Retorna o total de bytes gravados.
+    """
+    expire = ttl + stale_ttl if stale_ttl else ttl
+    pipe = redis_client.pipeline(transaction=False)
+    sizes = {}
+    for key, value in entries.items():
+        if namespace is not None and not namespace.admit(key):
+            continue
+        local_cache.set(key, value, ttl)
+        payload = {_SWR_FIELD: time.time() + ttl, "data": value} if stale_ttl else value
+        try:
+            encoded = cache_codec.encode(payload)
+        except Exception as e:
+            logger.warning(f"Erro ao codificar valor para o cache Redis ({key}): {e}")
+            continue
+        pipe.set(key, encoded, ex=expire)
+        sizes[key] = len(encoded)
+    if not sizes:
+        return 0
+    try:
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Erro ao salvar no cache Redis: {e}")
+        return 0
+    if namespace is not None:
+        namespace.record_writes(sizes, expire)
+    return sum(sizes.values())
+
+def _compute_and_store(func, args, kwargs, key: str, ttl: int, stale_ttl: int = None, stats: CacheStats = None, namespace: CacheNamespace = None):
+    start = time.perf_counter()
+    value = _to_serializable(func(*args, **kwargs))
+    elapsed = time.perf_counter() - start
+    payload_bytes = _write_cache(key, value, ttl, stale_ttl, namespace)
+    if stats:
+        stats.record_compute(elapsed, payload_bytes)
+    return value
+
+# Libera a trava apenas se ainda pertencer a quem a criou (evita apagar a trava de outro worker após expirar)
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def _acquire_compute_lock(key: str):
+    """
+    Tenta obter a trava distribuída de cálculo da chave. Retorna o token da trava,
+    `None` se outro worker já estiver calculando, ou `True` se o Redis estiver
+    indisponível (o cálculo segue sem coordenação entre workers).
+    """
+    token = f"{os.getpid()}:{threading.get_ident()}:{time.monotonic()}"
+    try:
+        if redis_client.set(f"lock:{key}", token, nx=True, px=int(settings.CACHE_LOCK_TIMEOUT * 1000)):
+            return token
+        return None
+    except Exception as e:
+        logger.warning(f"Erro ao obter trava de cálculo no Redis: {e}")
+        return True
+
+def _release_compute_lock(key: str, token):
+    if not isinstance(token, str):
+        return
+    try:
+        redis_client.eval(_RELEASE_LOCK_SCRIPT, 1, f"lock:{key}", token)
+    except Exception as e:
+        logger.warning(f"Erro ao liberar trava de cálculo no Redis: {e}")
+
+def _wait_for_remote(key: str, ttl: int):
+    """Aguarda outro worker publicar o valor da chave, até o timeout da trava."""
+    deadline = time.monotonic() + settings.CACHE_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(settings.CACHE_LOCK_POLL_INTERVAL)
+        value, _ = _read_cache(key, ttl)
+        if value is not _MISS:
+            return value
+        try:
+            if not redis_client.exists(f"lock:{key}"):
+                break
+        except Exception:
+            break
+    return _MISS
+
+def _compute_single_flight(func, args, kwargs, key: str, ttl: int, stale_ttl: int = None, stats: CacheStats = None, namespace: CacheNamespace = None):
+    """
+    Calcula o valor de uma chave ausente garantindo uma única execução
+    concorrente: dentro do processo, as demais threads aguardam o Future do
+    líder; entre workers, uma trava curta no Redis elege quem executa a query
+    enquanto os outros aguardam o valor aparecer no cache.
+    """
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inflight[key] = future
+
+    if not leader:
+        logger.debug(f"Cache single-flight: aguardando cálculo em andamento de {key}")
+        try:
+            return future.result(timeout=settings.CACHE_LOCK_TIMEOUT)
+        except FutureTimeoutError:
+            # O líder pode esperar outro worker e depois calcular: passado o timeout, calcula por conta própria
+            logger.warning(f"Cache single-flight: líder de {key} excedeu {settings.CACHE_LOCK_TIMEOUT}s, calculando localmente")
+            return _compute_and_store(func, args, kwargs, key, ttl, stale_ttl, stats, namespace)
+
+    try:
+        token = _acquire_compute_lock(key)
+        if token is None:
+            value = _wait_for_remote(key, ttl)
+            if value is not _MISS:
+                future.set_result(value)
+                return value
+            # O outro worker não concluiu a tempo: calcula localmente
+            token = _acquire_compute_lock(key)
+
+        try:
+            value = _compute_and_store(func, args, kwargs, key, ttl, stale_ttl, stats, namespace)
+        finally:
+            _release_compute_lock(key, token)
+        future.set_result(value)
+        return value
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+_refresh_executor = ThreadPoolExecutor(max_workers=settings.CACHE_REFRESH_WORKERS, thread_name_prefix="cache-refresh")
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+def _refresh_in_background(func, args, kwargs, key: str, ttl: int, stale_ttl: int, stats: CacheStats = None, namespace: CacheNamespace = None):
+    """
+    Recalcula uma entrada velha fora da requisição. A sessão do banco da
+    requisição (args[0]) é fechada ao fim dela, então o refresh abre a sua.
+    """
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def refresh():
+        from .database import SessionLocal
+        db = SessionLocal()
+        try:
+            token = _acquire_compute_lock(key)
+            if token is None:
+                return  # outro worker já está atualizando esta chave
+            try:
+                _compute_and_store(func, (db, *args[1:]), kwargs, key, ttl, stale_ttl, stats, namespace)
+                logger.debug(f"Cache REFRESH for {key}")
+            finally:
+                _release_compute_lock(key, token)
+        except Exception as e:
+            logger.warning(f"Erro ao atualizar cache em segundo plano para {key}: {e}")
+        finally:
+            db.close()
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    try:
+        _refresh_executor.submit(refresh)
+    except Exception as e:
+        logger.warning(f"Erro ao agendar atualização do cache para {key}: {e}")
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+def cache_result(
+    ttl: int = settings.CACHE_DEFAULT_TTL,
+    stale_ttl: int = None,
+    sliced: bool = False,
+    ttl_policy=None,
+    namespace: str = None,
+    admission: bool = False,
+):
     """
     Decorator para cachear resultados de funções analíticas.
     Converte Rows do SQLAlchemy em dicts para serialização JSON.
+
+    A leitura passa primeiro pelo L1 em memória (`local_cache`) e só então
+    pelo Redis; um hit no Redis repopula o L1 do worker. Misses concorrentes
+    para a mesma chave são coalescidos em um único cálculo (single-flight).
+
+    Com `stale_ttl`, o valor é fresco por `ttl` segundos e, depois disso, ainda
+    é servido por mais `stale_ttl` segundos enquanto é recalculado em segundo
+    plano (stale-while-revalidate). Só após `ttl + stale_ttl` o chamador espera.
+
+    A chave inclui a geração de dados (ver `get_generation`): a global do modo
+    ou, com `sliced=True`, a da fatia dada pelos argumentos `uf` e
+    `data_referencia` da função. Os argumentos são normalizados por
+    `build_cache_key`, e o uso do cache é contabilizado em `get_cache_stats()`.
+
+    `ttl_policy(db, argumentos, ttl)` permite ajustar o TTL por chamada, a partir
+    dos argumentos da função (ex.: meses fechados recebem TTLs longos).
+
+    `namespace` agrupa as entradas sob um orçamento de memória e um índice
+    próprio (ver `CacheNamespace`); `admission=True` liga o filtro de admissão
+    do namespace, indicado para funções com argumentos livres (buscas textuais,
+    listas arbitrárias de códigos) que geram muitas chaves de uso único.
+
+    A função decorada expõe `cache_key(...)` e, para consultas por `codigo`,
+    `get_many(db, fetch, codigos, ...)`, a variante em lote sobre as mesmas chaves.
     """
     def decorator(func):
+        signature = inspect.signature(func)
+        stats = _stats.setdefault(func.__name__, CacheStats())
+        cache_namespace = get_namespace(namespace, admission) if namespace else None
+        if cache_namespace is not None:
+            cache_namespace.functions.append(func.__name__)
+
+        def bind_arguments(args, kwargs) -> dict:
+            # O primeiro parâmetro ('db: Session') não faz parte da chave
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return dict(list(bound.arguments.items())[1:])
+
+        def generations_for(arguments: dict) -> tuple:
+            if sliced:
+                generation = get_generation(arguments.get("uf"), arguments.get("data_referencia"))
+            else:
+                generation = get_generation()
+            namespace_generation = cache_namespace.generation() if cache_namespace is not None else None
+            return generation, namespace_generation
+
+        def generations_known(generations: tuple) -> bool:
+            return generations[0] is not None and (cache_namespace is None or generations[1] is not None)
+
+        def key_for(arguments: dict) -> str:
+            """Chave da chamada, ou `None` se alguma geração não pôde ser lida."""
+            generations = generations_for(arguments)
+            if not generations_known(generations):
+                return None
+            return build_cache_key(func.__name__, arguments, *generations)
+
+        def cache_key(*args, **kwargs) -> str:
+            return key_for(bind_arguments(args, kwargs))
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            # Gerar chave de cache baseada nos argumentos (exceto a sessão do DB)
-            # args[0] costuma ser 'db: Session'
-            cache_args = args[1:]
-            sandbox_suffix = "sandbox" if is_sandbox_mode() else "prod"
-            
-            key = f"cache:{func.__name__}:{sandbox_suffix}:{':'.join(map(str, cache_args))}:{':'.join(f'{k}={v}' for k, v in kwargs.items())}"
-            
-            try:
-                cached_val = redis_client.get(key)
-                if cached_val:
-                    logger.debug(f"Cache HIT for {key}")
-                    return json.loads(cached_val)
-            except Exception as e:
-                logger.warning(f"Erro ao ler cache no Redis: {e}")
-
-            # Executa a função real
-            result = func(*args, **kwargs)
-
-            # Converte resultado (Row ou List[Row]) para dict serializável
-            serializable_result = None
-            if result is not None:
-                if isinstance(result, list):
-                    serializable_result = [dict(row._mapping) if hasattr(row, '_mapping') else row for row in result]
-                else:
-                    serializable_result = dict(result._mapping) if hasattr(result, '_mapping') else result
+            _ensure_invalidation_listener()
+            arguments = bind_arguments(args, kwargs)
+            key = key_for(arguments)
+            if key is None:
+                # Geração desconhecida (Redis indisponível): calcula sem ler nem gravar o cache
+                stats.record_miss()
+                return _to_serializable(func(*args, **kwargs))
+            effective_ttl = ttl_policy(args[0] if args else None, arguments, ttl) if ttl_policy else ttl
 
-            try:
-                redis_client.set(key, json.dumps(serializable_result, cls=CustomJSONEncoder), ex=ttl)
-                logger.debug(f"Cache MISS for {key}. Stored result.")
-            except Exception as e:
-                logger.warning(f"Erro ao salvar no cache Redis: {e}")
+            value, fresh = _read_cache(key, effective_ttl, stats)
+            if value is not _MISS:
+                if not fresh:
+                    logger.debug(f"Cache STALE for {key}. Refreshing in background.")
+                    _refresh_in_background(func, args, kwargs, key, effective_ttl, stale_ttl, stats, cache_namespace)
+                return value
+
+            stats.record_miss()
+            return _compute_single_flight(func, args, kwargs, key, effective_ttl, stale_ttl, stats, cache_namespace)
+
+        def get_many(db, fetch, codigos: list, **kwargs) -> dict:
+            """
+            Versão em lote para funções com argumento `codigo`: retorna
+            `{codigo: valor}` (`None` para os inexistentes), com as mesmas chaves,
+            TTL e namespace das chamadas unitárias. As entradas em cache são lidas
+            com um único MGET e as demais buscadas de uma vez por
+            `fetch(db, codigos_faltantes, **kwargs)`, que retorna `{codigo: valor}`.
+            """
+            _ensure_invalidation_listener()
+            codigos = list(dict.fromkeys(codigos))
+            if not codigos:
+                return {}
+            template = bind_arguments((db,), {**kwargs, "codigo": codigos[0]})
+            generations = generations_for(template)
+            if not generations_known(generations):
+                fetched = fetch(db, codigos, **kwargs)
+                return {codigo: _to_serializable(fetched.get(codigo)) for codigo in codigos}
+            keys = {codigo: build_cache_key(func.__name__, {**template, "codigo": codigo}, *generations) for codigo in codigos}
+            effective_ttl = ttl_policy(db, template, ttl) if ttl_policy else ttl
+
+            cached = _read_many(list(keys.values()), effective_ttl, stats)
+            result = {codigo: cached[key] for codigo, key in keys.items() if key in cached}
+            missing = [codigo for codigo in codigos if codigo not in result]
+            if missing:
+                for _ in missing:
+                    stats.record_miss()
+                start = time.perf_counter()
+                fetched = fetch(db, missing, **kwargs)
+                elapsed = time.perf_counter() - start
+                values = {codigo: _to_serializable(fetched.get(codigo)) for codigo in missing}
+                payload_bytes = _write_many({keys[c]: v for c, v in values.items()}, effective_ttl, stale_ttl, cache_namespace)
+                stats.record_compute(elapsed, payload_bytes)
+                result.update(values)
+            return {codigo: result[codigo] for codigo in codigos}
 
-            return serializable_result
+        wrapper.cache_key = cache_key
+        wrapper.get_many = get_many
+        wrapper.cache_stats = stats
         return wrapper
     return decorator
@@ -18,8 +18,10 @@ import os
 # Configurações para o Celery
 # Utiliza REDIS_HOST do ambiente ou fallback para o nome único da stack
 redis_host = os.getenv("REDIS_HOST", "autosinapi_redis")
-broker_url = f'redis://{redis_host}:6379/0'
-result_backend = f'redis://{redis_host}:6379/0'
+redis_port = os.getenv("REDIS_PORT", "6379")
+redis_db = os.getenv("REDIS_DB", "0")
+broker_url = f'redis://{redis_host}:{redis_port}/{redis_db}'
+result_backend = f'redis://{redis_host}:{redis_port}/{redis_db}'
 
 # --- Limites de Concorrência e Sobrecarga ---
 # Máximo 1 tarefa por worker (ETL do SINAPI é pesada e consome muita RAM)
@@ -11,6 +11,8 @@ valores padrão definidos para facilitar o desenvolvimento e a implantação.
 O arquivo `.env` é lido automaticamente.
 """
 
+from typing import Dict, List
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 from .sandbox_utils import get_sandbox_table_name
@@ -51,10 +53,100 @@ class Settings(BaseSettings):
     def TABLE_MANUTENCOES_HISTORICO(self) -> str:
         return get_sandbox_table_name("manutencoes_historico")
 
+    @property
+    def TABLE_COMPOSICAO_FECHAMENTO(self) -> str:
+        return get_sandbox_table_name("composicao_fechamento")
+
+    @property
+    def TABLE_COMPOSICAO_FECHAMENTO_ESTADO(self) -> str:
+        return get_sandbox_table_name("composicao_fechamento_estado")
+
+    @property
+    def TABLE_CUSTOS_CALCULADOS(self) -> str:
+        return get_sandbox_table_name("custos_composicoes_calculados")
+
+    @property
+    def TABLE_CUBO_PRECOS(self) -> str:
+        return get_sandbox_table_name("cubo_precos_mensal")
+
+    # Profundidade máxima da estrutura de composições considerada no fechamento transitivo
+    BOM_MAX_DEPTH: int = 10
+    # Explosão do BOM, hora-homem e onde-usado pelo grafo em memória (`api.graph`);
+    # desativado, essas funções leem o fechamento transitivo no PostgreSQL
+    GRAPH_ENGINE_ENABLED: bool = True
+    # Busca por descrição ranqueada por similaridade (pg_trgm/unaccent); desligada, usa ILIKE
+    SEARCH_TRIGRAM_ENABLED: bool = True
+    # Limites das faixas de preço nas facetas das buscas
+    SEARCH_PRICE_BUCKETS: List[float] = [10, 50, 100, 500, 1000, 5000]
+    # Número máximo de códigos por requisição nas consultas em lote
+    BULK_MAX_CODES: int = 5000
+    # Número máximo de insumos alterados em uma simulação de preços
+    SIMULATION_MAX_ALTERACOES: int = 500
+    # Roll-up de custos: diferença relativa a partir da qual o custo calculado diverge do oficial
+    ROLLUP_TOLERANCE: float = 0.01
+
     # --- Configurações de Cache ---
     REDIS_HOST: str = "redis"
     REDIS_PORT: int = 6379
+    REDIS_DB: int = 0
+    REDIS_MAX_CONNECTIONS: int = 50
+    # Timeouts curtos: o Redis é um acelerador, não pode segurar a requisição
+    REDIS_SOCKET_CONNECT_TIMEOUT: float = 0.25
+    REDIS_SOCKET_TIMEOUT: float = 0.5
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30
+    # Disjuntor: após N falhas seguidas, o Redis é ignorado pelo período de espera
+    REDIS_CIRCUIT_FAILURE_THRESHOLD: int = 5
+    REDIS_CIRCUIT_RESET_TIMEOUT: float = 30.0
     CACHE_DEFAULT_TTL: int = 86400  # 24 horas
+    # Cache L1 em memória por worker, à frente do Redis (0 desativa)
+    CACHE_L1_MAX_ITEMS: int = 2048
+    CACHE_L1_TTL: int = 60  # segundos; limita a janela de divergência entre workers
+    CACHE_INVALIDATION_CHANNEL: str = "autosinapi:cache:invalidate"
+    CACHE_GENERATION_TTL: int = 5  # segundos que a geração de dados fica no L1
+    CACHE_KEY_MAX_ARG_LENGTH: int = 64  # argumentos maiores entram na chave como hash
+    # Política de TTL por mês de referência: o mês mais recente pode ser recarregado ou
+    # retificado; meses anteriores são imutáveis e dependem só da invalidação por geração.
+    CACHE_LIVE_MONTH_TTL: int = 3600
+    CACHE_CLOSED_MONTH_TTL: int = 30 * 86400
+    # Namespaces do cache: orçamento de memória no Redis (bytes, medidos pelo payload gravado)
+    # e filtro de admissão (TinyLFU) para funções com argumentos livres
+    CACHE_NAMESPACE_BUDGETS: Dict[str, int] = {
+        "lookup": 128 * 1024 * 1024,
+        "bi": 512 * 1024 * 1024,
+        "search": 64 * 1024 * 1024,
+        "abc": 64 * 1024 * 1024,
+    }
+    CACHE_NAMESPACE_DEFAULT_BUDGET: int = 64 * 1024 * 1024
+    CACHE_NAMESPACE_EVICTION_BATCH: int = 100
+    CACHE_ADMISSION_MIN_FREQUENCY: int = 2  # só grava chaves vistas pelo menos N vezes
+    CACHE_ADMISSION_SKETCH_WIDTH: int = 65536
+    # Aquecimento do cache pós-ETL, guiado pela popularidade observada na API
+    CACHE_POPULARITY_DAYS: int = 7
+    CACHE_POPULARITY_FLUSH_INTERVAL: float = 10.0
+    CACHE_WARM_TOP_N: int = 200
+    CACHE_WARM_REGIMES: str = "NAO_DESONERADO,DESONERADO"
+    CACHE_WARM_MAX_QUERIES_PER_SECOND: float = 2.0
+    # Proteção contra stampede: trava de cálculo por chave e intervalo de espera dos demais
+    CACHE_LOCK_TIMEOUT: float = 30.0
+    CACHE_LOCK_POLL_INTERVAL: float = 0.05
+    # Stale-while-revalidate: janela extra em que o valor vencido ainda é servido
+    CACHE_STALE_TTL: int = 3600
+    CACHE_REFRESH_WORKERS: int = 2
+    # Codec dos valores no Redis (ver api/cache_codec.py)
+    CACHE_SERIALIZER: str = "orjson"  # orjson | msgpack | json
+    CACHE_COMPRESSION: str = "zstd"  # zstd | lz4 | zlib | none
+    CACHE_COMPRESSION_MIN_BYTES: int = 4096
+    CACHE_COMPRESSION_LEVEL: int = 3
+
+    # --- Cache HTTP (ETag / Cache-Control dos GETs públicos) ---
+    HTTP_CACHE_MAX_AGE: int = 300  # último mês carregado ou sem data de referência
+    HTTP_CACHE_CLOSED_MONTH_MAX_AGE: int = 86400  # meses anteriores ao último carregado
+    # Cache de resposta HTTP (rotas marcadas com @http_cache.cached_response)
+    HTTP_RESPONSE_CACHE_TTL: int = 3600
+    HTTP_RESPONSE_CACHE_GZIP_MIN_BYTES: int = 1024
+    # Cache de resposta do Kong (plugin proxy-cache), esvaziado pelo ETL via Admin API ("" desativa)
+    KONG_ADMIN_URL: str = "http://kong:8001"
+    KONG_PURGE_TIMEOUT: float = 2.0
 
     # --- Constantes de Negócio ---
     # Centraliza valores padrão usados nas queries.
@@ -1,13 +1,19 @@
 import pandas as pd
 import calendar
+import logging
 from sqlalchemy.orm import Session
 from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
 from typing import List, Optional
 from datetime import datetime, date
 
 # Importa a instância única de configurações
 from .config import settings
-from .cache_utils import cache_result
+from .cache_utils import cache_result, reference_month_ttl
+from . import graph as composition_graph
+from .pagination import decode_cursor
+
+logger = logging.getLogger(__name__)
 
 def _get_date_range(data_referencia: str):
     """
@@ -22,7 +28,7 @@ def _get_date_range(data_referencia: str):
     except (ValueError, TypeError):
         return None, None
 
-@cache_result(ttl=3600)
+@cache_result(ttl=3600, namespace="lookup")
 def get_global_stats(db: Session) -> dict:
     """
     Retorna a volumetria global do banco de dados.
@@ -38,7 +44,7 @@ def get_global_stats(db: Session) -> dict:
         stats[key] = db.execute(q).scalar()
     return stats
 
-@cache_result(ttl=86400)
+@cache_result(ttl=86400, namespace="lookup")
 def get_available_filters(db: Session) -> dict:
     """
     Retorna os UFs, Regimes e Datas de Referência disponíveis no banco de dados.
@@ -52,7 +58,7 @@ def get_available_filters(db: Session) -> dict:
 
 # --- Seção 1: Funções de Busca Direta (CRUD) ---
 
-@cache_result(ttl=3600)
+@cache_result(ttl=3600, sliced=True, ttl_policy=reference_month_ttl, namespace="lookup")
 def get_insumo_by_codigo(
     db: Session, codigo: int, uf: str, data_referencia: str, regime: str
 ) -> Optional[dict]:
@@ -73,31 +79,119 @@ def get_insumo_by_codigo(
     }).first()
     return result._mapping if result else None
 
-@cache_result(ttl=3600)
+def _search_clauses(column: str, ranked: bool, by_relevance: bool = True) -> dict:
+    """
+    Trechos SQL da busca por descrição. A busca ranqueada ignora acentos e
+    caixa e tolera erros de digitação (similaridade de trigramas, sobre os
+    índices GIN da migração 006); a outra é o ILIKE original. Com
+    `by_relevance=False` (paginação por cursor) a relevância é retornada mas
+    não ordena os resultados.
+    """
+    if not ranked:
+        return {"match": f"{column} ILIKE :query", "relevancia": "", "order": ""}
+    normalized = f"f_unaccent(lower({column}))"
+    termo = "f_unaccent(lower(:termo))"
+    return {
+        "match": f"({normalized} LIKE '%' || {termo} || '%' OR {termo} <% {normalized})",
+        "relevancia": f", word_similarity({termo}, {normalized}) AS relevancia",
+        "order": "relevancia DESC, " if by_relevance else "",
+    }
+
+def _page_clauses(alias: str, cursor: Optional[str]) -> tuple:
+    """
+    Paginação da busca: `OFFSET`/`LIMIT` ou, com `cursor` (vazio na primeira
+    página), busca por chave a partir do `(descricao, codigo)` da última linha
+    da página anterior, sobre os índices da migração 007. Retorna
+    `(trechos, parâmetros)`; cursores inválidos levantam `ValueError`.
+    """
+    if cursor is None:
+        return {"seek": "", "page": "OFFSET :skip LIMIT :limit"}, {}
+    after = decode_cursor(cursor, 2)
+    if after is None:
+        return {"seek": "", "page": "LIMIT :limit"}, {}
+    seek = f"AND ({alias}.descricao, {alias}.codigo) > (:after_descricao, :after_codigo)"
+    return {"seek": seek, "page": "LIMIT :limit"}, {"after_descricao": str(after[0]), "after_codigo": int(after[1])}
+
+def _run_search(db: Session, template: str, column: str, params: dict, cursor: Optional[str] = None) -> list:
+    """
+    Executa a busca `template` (com os campos `match`, `relevancia`, `order`,
+    `seek` e `page`) no modo ranqueado e, se ele estiver desativado ou o banco
+    não tiver as extensões `pg_trgm`/`unaccent`, no modo ILIKE.
+    """
+    page, page_params = _page_clauses(column.split(".")[0], cursor)
+    params = {**params, **page_params}
+    by_relevance = cursor is None
+    if settings.SEARCH_TRIGRAM_ENABLED:
+        try:
+            clauses = {**_search_clauses(column, True, by_relevance), **page}
+            return db.execute(text(template.format(**clauses)), params).fetchall()
+        except DBAPIError as e:
+            db.rollback()
+            logger.warning(f"Busca por similaridade indisponível, usando ILIKE: {e}")
+    clauses = {**_search_clauses(column, False), **page}
+    return db.execute(text(template.format(**clauses)), params).fetchall()
+
+def _fetch_insumos_by_codigos(
+    db: Session, codigos: List[int], uf: str, data_referencia: str, regime: str
+) -> dict:
+    start_date, end_date = _get_date_range(data_referencia)
+    query = text(f"""
+        SELECT i.codigo, i.descricao, i.unidade, i.classificacao, i.status,
+               p.preco_mediano, p.origem_preco,
+               i.created_at, i.updated_at, i.sinapi_versao
+        FROM {settings.TABLE_INSUMOS} AS i
+        JOIN {settings.TABLE_PRECOS_INSUMOS} AS p ON i.codigo = p.insumo_codigo
+        WHERE i.codigo = ANY(:codigos) AND i.status = :status AND p.uf = :uf
+          AND p.data_referencia >= :start_date AND p.data_referencia <= :end_date
+          AND p.regime = :regime
+    """)
+    result = db.execute(query, {
+        "codigos": list(codigos), "uf": uf.upper(), "start_date": start_date, "end_date": end_date,
+        "regime": regime.upper(), "status": settings.DEFAULT_ITEM_STATUS
+    }).fetchall()
+    return {r.codigo: dict(r._mapping) for r in result}
+
+def get_insumos_by_codigos(
+    db: Session, codigos: List[int], uf: str, data_referencia: str, regime: str
+) -> dict:
+    """
+    Versão em lote de `get_insumo_by_codigo`: `{codigo: insumo}`, com `None`
+    para os códigos não encontrados. Compartilha o cache da consulta unitária.
+    """
+    return get_insumo_by_codigo.get_many(
+        db, _fetch_insumos_by_codigos, codigos, uf=uf, data_referencia=data_referencia, regime=regime
+    )
+
+@cache_result(ttl=3600, sliced=True, ttl_policy=reference_month_ttl, namespace="search", admission=True)
 def search_insumos_by_descricao(
     db: Session, q: str, uf: str, data_referencia: str, regime: str, skip: int, limit: int,
-    classificacao: str = None
+    classificacao: str = None, cursor: str = None
 ) -> List[dict]:
+    """
+    Busca por descrição. Sem `cursor`, pagina por `skip`/`limit` ordenando pela
+    relevância; com `cursor`, pagina por chave em `(descricao, codigo)`.
+    """
     start_date, end_date = _get_date_range(data_referencia)
-    query = text(f"""
-        SELECT i.codigo, i.descricao, i.unidade, i.classificacao, i.status, p.preco_mediano, p.origem_preco
+    base = f"""
+        SELECT i.codigo, i.descricao, i.unidade, i.classificacao, i.status, p.preco_mediano, p.origem_preco{{relevancia}}
         FROM {settings.TABLE_INSUMOS} AS i
         JOIN {settings.TABLE_PRECOS_INSUMOS} AS p ON i.codigo = p.insumo_codigo
-        WHERE i.descricao ILIKE :query AND i.status = :status AND p.uf = :uf
+        WHERE {{match}} AND i.status = :status AND p.uf = :uf
           AND p.data_referencia >= :start_date AND p.data_referencia <= :end_date
           AND p.regime = :regime
           {'AND UPPER(i.classificacao) = UPPER(:classificacao)' if classificacao else ''}
-        ORDER BY i.descricao OFFSET :skip LIMIT :limit
-    """)
-    result = db.execute(query, {
-        "query": f"%{q}%", "uf": uf.upper(), "start_date": start_date, "end_date": end_date,
+          {{seek}}
+        ORDER BY {{order}}i.descricao, i.codigo {{page}}
+    """
+    result = _run_search(db, base, "i.descricao", {
+        "query": f"%{q}%", "termo": q, "uf": uf.upper(), "start_date": start_date, "end_date": end_date,
         "regime": regime.upper(), "status": settings.DEFAULT_ITEM_STATUS,
         "skip": skip, "limit": limit,
         **({"classificacao": classificacao} if classificacao else {})
-    }).fetchall()
+    }, cursor=cursor)
     return [r._mapping for r in result]
 
-@cache_result(ttl=3600)
+@cache_result(ttl=3600, sliced=True, ttl_policy=reference_month_ttl, namespace="lookup")
 def get_composicao_by_codigo(
     db: Session, codigo: int, uf: str, data_referencia: str, regime: str
 ) -> Optional[dict]:
@@ -118,84 +212,235 @@ def get_composicao_by_codigo(
     }).first()
     return result._mapping if result else None
 
-@cache_result(ttl=3600)
+def _fetch_composicoes_by_codigos(
+    db: Session, codigos: List[int], uf: str, data_referencia: str, regime: str
+) -> dict:
+    start_date, end_date = _get_date_range(data_referencia)
+    query = text(f"""
+        SELECT c.codigo, c.descricao, c.unidade, c.grupo, c.status,
+               p.custo_total, p.percentual_mo,
+               c.created_at, c.updated_at, c.sinapi_versao
+        FROM {settings.TABLE_COMPOSICOES} AS c
+        JOIN {settings.TABLE_CUSTOS_COMPOSICOES} AS p ON c.codigo = p.composicao_codigo
+        WHERE c.codigo = ANY(:codigos) AND c.status = :status AND p.uf = :uf
+          AND p.data_referencia >= :start_date AND p.data_referencia <= :end_date
+          AND p.regime = :regime
+    """)
+    result = db.execute(query, {
+        "codigos": list(codigos), "uf": uf.upper(), "start_date": start_date, "end_date": end_date,
+        "regime": regime.upper(), "status": settings.DEFAULT_ITEM_STATUS
+    }).fetchall()
+    return {r.codigo: dict(r._mapping) for r in result}
+
+def get_composicoes_by_codigos(
+    db: Session, codigos: List[int], uf: str, data_referencia: str, regime: str
+) -> dict:
+    """
+    Versão em lote de `get_composicao_by_codigo`: `{codigo: composição}`, com
+    `None` para os códigos não encontrados. Compartilha o cache da consulta unitária.
+    """
+    return get_composicao_by_codigo.get_many(
+        db, _fetch_composicoes_by_codigos, codigos, uf=uf, data_referencia=data_referencia, regime=regime
+    )
+
+@cache_result(ttl=3600, sliced=True, ttl_policy=reference_month_ttl, namespace="search", admission=True)
 def search_composicoes_by_descricao(
     db: Session, q: str, uf: str, data_referencia: str, regime: str, skip: int, limit: int,
-    grupo: str = None
+    grupo: str = None, cursor: str = None
 ) -> List[dict]:
+    """
+    Busca por descrição. Sem `cursor`, pagina por `skip`/`limit` ordenando pela
+    relevância; com `cursor`, pagina por chave em `(descricao, codigo)`.
+    """
     start_date, end_date = _get_date_range(data_referencia)
-    query = text(f"""
-        SELECT c.codigo, c.descricao, c.unidade, c.grupo, c.status, p.custo_total, p.percentual_mo
+    base = f"""
+        SELECT c.codigo, c.descricao, c.unidade, c.grupo, c.status, p.custo_total, p.percentual_mo{{relevancia}}
         FROM {settings.TABLE_COMPOSICOES} AS c
         JOIN {settings.TABLE_CUSTOS_COMPOSICOES} AS p ON c.codigo = p.composicao_codigo
-        WHERE c.descricao ILIKE :query AND c.status = :status AND p.uf = :uf
+        WHERE {{match}} AND c.status = :status AND p.uf = :uf
           AND p.data_referencia >= :start_date AND p.data_referencia <= :end_date
           AND p.regime = :regime
           {'AND UPPER(c.grupo) = UPPER(:grupo)' if grupo else ''}
-        ORDER BY c.descricao OFFSET :skip LIMIT :limit
-    """)
-    result = db.execute(query, {
-        "query": f"%{q}%", "uf": uf.upper(), "start_date": start_date, "end_date": end_date,
+          {{seek}}
+        ORDER BY {{order}}c.descricao, c.codigo {{page}}
+    """
+    result = _run_search(db, base, "c.descricao", {
+        "query": f"%{q}%", "termo": q, "uf": uf.upper(), "start_date": start_date, "end_date": end_date,
         "regime": regime.upper(), "status": settings.DEFAULT_ITEM_STATUS,
         "skip": skip, "limit": limit,
         **({"grupo": grupo} if grupo else {})
-    }).fetchall()
+    }, cursor=cursor)
     return [r._mapping for r in result]
 
+def _price_bucket_label(bucket: int, bounds: list) -> str:
+    """Rótulo da faixa de preço `bucket` de `width_bucket(preco, bounds)`."""
+    if bucket == 0:
+        return f"ate {bounds[0]:g}"
+    if bucket >= len(bounds):
+        return f"acima de {bounds[-1]:g}"
+    return f"{bounds[bucket - 1]:g}-{bounds[bucket]:g}"
+
+def _search_facets(db: Session, template: str, column: str, params: dict, categoria: str) -> dict:
+    """
+    Executa a consulta de facetas de uma busca (`template` com as colunas
+    `categoria`, `unidade` e `preco` do conjunto encontrado) e monta as
+    contagens por categoria, unidade e faixa de preço. Todas saem de uma
+    única passada, com `GROUPING SETS`.
+    """
+    bounds = [float(b) for b in settings.SEARCH_PRICE_BUCKETS]
+    facet_template = f"""
+        SELECT categoria, unidade, faixa,
+               GROUPING(categoria) AS sem_categoria, GROUPING(unidade) AS sem_unidade, GROUPING(faixa) AS sem_faixa,
+               COUNT(*) AS total
+        FROM (
+            SELECT categoria, unidade, width_bucket(preco, CAST(:faixas AS numeric[])) AS faixa
+            FROM ({template}) AS encontrados
+        ) AS m
+        GROUP BY GROUPING SETS ((categoria), (unidade), (faixa), ())
+    """
+    rows = _run_search(db, facet_template, column, {**params, "faixas": bounds})
+    facetas = {"total": 0, categoria: [], "unidade": [], "faixa_preco": []}
+    for r in rows:
+        if r.sem_categoria and r.sem_unidade and r.sem_faixa:
+            facetas["total"] = r.total
+        elif not r.sem_categoria:
+            facetas[categoria].append({"valor": r.categoria, "total": r.total})
+        elif not r.sem_unidade:
+            facetas["unidade"].append({"valor": r.unidade, "total": r.total})
+        else:
+            valor = _price_bucket_label(r.faixa, bounds) if r.faixa is not None else None
+            facetas["faixa_preco"].append({"valor": valor, "total": r.total, "faixa": r.faixa})
+    for key in (categoria, "unidade"):
+        facetas[key].sort(key=lambda f: (-f["total"], f["valor"] or ""))
+    facetas["faixa_preco"].sort(key=lambda f: (f["faixa"] is None, f["faixa"] or 0))
+    for faixa in facetas["faixa_preco"]:
+        del faixa["faixa"]
+    return facetas
+
+@cache_result(ttl=3600, sliced=True, ttl_policy=reference_month_ttl, namespace="search", admission=True)
+def get_insumo_search_facets(
+    db: Session, q: str, uf: str, data_referencia: str, regime: str, classificacao: str = None
+) -> dict:
+    """
+    Contagens por classificação, unidade e faixa de preço dos insumos
+    encontrados por `search_insumos_by_descricao` com os mesmos filtros.
+    """
+    start_date, end_date = _get_date_range(data_referencia)
+    template = f"""
+        SELECT i.classificacao AS categoria, i.unidade, p.preco_mediano AS preco
+        FROM {settings.TABLE_INSUMOS} AS i
+        JOIN {settings.TABLE_PRECOS_INSUMOS} AS p ON i.codigo = p.insumo_codigo
+        WHERE {{match}} AND i.status = :status AND p.uf = :uf
+          AND p.data_referencia >= :start_date AND p.data_referencia <= :end_date
+          AND p.regime = :regime
+          {'AND UPPER(i.classificacao) = UPPER(:classificacao)' if classificacao else ''}
+    """
+    return _search_facets(db, template, "i.descricao", {
+        "query": f"%{q}%", "termo": q, "uf": uf.upper(), "start_date": start_date, "end_date": end_date,
+        "regime": regime.upper(), "status": settings.DEFAULT_ITEM_STATUS,
+        **({"classificacao": classificacao} if classificacao else {})
+    }, "classificacao")
+
+@cache_result(ttl=3600, sliced=True, ttl_policy=reference_month_ttl, namespace="search", admission=True)
+def get_composicao_search_facets(
+    db: Session, q: str, uf: str, data_referencia: str, regime: str, grupo: str = None
+) -> dict:
+    """
+    Contagens por grupo, unidade e faixa de custo das composições encontradas
+    por `search_composicoes_by_descricao` com os mesmos filtros.
+    """
+    start_date, end_date = _get_date_range(data_referencia)
+    template = f"""
+        SELECT c.grupo AS categoria, c.unidade, p.custo_total AS preco
+        FROM {settings.TABLE_COMPOSICOES} AS c
+        JOIN {settings.TABLE_CUSTOS_COMPOSICOES} AS p ON c.codigo = p.composicao_codigo
+        WHERE {{match}} AND c.status = :status AND p.uf = :uf
+          AND p.data_referencia >= :start_date AND p.data_referencia <= :end_date
+          AND p.regime = :regime
+          {'AND UPPER(c.grupo) = UPPER(:grupo)' if grupo else ''}
+    """
+    return _search_facets(db, template, "c.descricao", {
+        "query": f"%{q}%", "termo": q, "uf": uf.upper(), "start_date": start_date, "end_date": end_date,
+        "regime": regime.upper(), "status": settings.DEFAULT_ITEM_STATUS,
+        **({"grupo": grupo} if grupo else {})
+    }, "grupo")
+
 # --- Seção 2: Funções de BI ---
 
-@cache_result(ttl=86400)
+def _get_graph(db: Session):
+    """
+    Grafo em memória da estrutura das composições, ou `None` se desativado ou
+    indisponível; nesse caso as funções de BI leem o fechamento transitivo.
+    """
+    if not settings.GRAPH_ENGINE_ENABLED:
+        return None
+    try:
+        return composition_graph.get_graph(db)
+    except Exception as e:
+        logger.warning(f"Grafo de composições indisponível, usando o fechamento no banco: {e}")
+        return None
+
+def _bom_source(db: Session, codigo: int):
+    """
+    Itens do BOM completo da composição como fonte SQL `b(item_codigo, tipo_item,
+    coeficiente_total, nivel)`: explodidos pelo grafo em memória (enviados como
+    arrays) ou lidos do fechamento transitivo.
+    """
+    graph = _get_graph(db)
+    if graph is not None:
+        try:
+            itens = graph.explode(codigo)
+        except composition_graph.CompositionCycleError as e:
+            logger.warning(f"{e}. Usando o fechamento no banco, limitado a {settings.BOM_MAX_DEPTH} níveis.")
+        else:
+            source = """unnest(CAST(:tipos AS text[]), CAST(:itens AS integer[]),
+                          CAST(:coeficientes AS float8[]), CAST(:niveis AS integer[]))
+                   AS b(tipo_item, item_codigo, coeficiente_total, nivel)"""
+            return source, {
+                "tipos": [i[0] for i in itens], "itens": [i[1] for i in itens],
+                "coeficientes": [i[2] for i in itens], "niveis": [i[3] for i in itens],
+            }
+    source = f"""(SELECT item_codigo, tipo_item, coeficiente_total, nivel_min AS nivel
+                   FROM {settings.TABLE_COMPOSICAO_FECHAMENTO} WHERE composicao_codigo = :codigo) AS b"""
+    return source, {"codigo": codigo}
+
+@cache_result(ttl=86400, stale_ttl=settings.CACHE_STALE_TTL, sliced=True, ttl_policy=reference_month_ttl, namespace="bi")
 def get_composicao_bom(
     db: Session, codigo: int, uf: str, data_referencia: str, regime: str
 ) -> List[dict]:
     start_date, end_date = _get_date_range(data_referencia)
+    # Os itens já vêm com o coeficiente acumulado em todos os níveis; o SQL só agrega descrições e preços
+    source, params = _bom_source(db, codigo)
     query = text(f"""
-    WITH RECURSIVE composicao_completa (item_codigo, tipo_item, coeficiente_total, nivel) AS (
-        SELECT item_codigo, tipo_item, coeficiente, 1 FROM {settings.VIEW_COMPOSICAO_ITENS}
-        WHERE composicao_pai_codigo = :codigo
-        UNION ALL
-        SELECT vis.item_codigo, vis.tipo_item, rec.coeficiente_total * vis.coeficiente, rec.nivel + 1
-        FROM {settings.VIEW_COMPOSICAO_ITENS} AS vis
-        JOIN composicao_completa AS rec ON vis.composicao_pai_codigo = rec.item_codigo
-        WHERE rec.tipo_item = 'COMPOSICAO' AND rec.nivel < 10
-    )
-    SELECT cc.item_codigo, cc.tipo_item, MIN(cc.nivel) as nivel, COALESCE(i.descricao, c.descricao) AS descricao,
-           COALESCE(i.unidade, c.unidade) AS unidade, SUM(cc.coeficiente_total) as coeficiente_total,
+    SELECT b.item_codigo, b.tipo_item, b.nivel, COALESCE(i.descricao, c.descricao) AS descricao,
+           COALESCE(i.unidade, c.unidade) AS unidade, b.coeficiente_total,
            COALESCE(pi.preco_mediano, pc.custo_total) AS custo_unitario,
-           SUM(cc.coeficiente_total * COALESCE(pi.preco_mediano, pc.custo_total)) AS custo_impacto_total
-    FROM composicao_completa cc
-    LEFT JOIN {settings.TABLE_INSUMOS} i ON cc.item_codigo = i.codigo AND cc.tipo_item = 'INSUMO'
-    LEFT JOIN {settings.TABLE_COMPOSICOES} c ON cc.item_codigo = c.codigo AND cc.tipo_item = 'COMPOSICAO'
-    LEFT JOIN {settings.TABLE_PRECOS_INSUMOS} pi ON cc.item_codigo = pi.insumo_codigo AND pi.uf = :uf 
+           b.coeficiente_total * COALESCE(pi.preco_mediano, pc.custo_total) AS custo_impacto_total
+    FROM {source}
+    LEFT JOIN {settings.TABLE_INSUMOS} i ON b.item_codigo = i.codigo AND b.tipo_item = 'INSUMO'
+    LEFT JOIN {settings.TABLE_COMPOSICOES} c ON b.item_codigo = c.codigo AND b.tipo_item = 'COMPOSICAO'
+    LEFT JOIN {settings.TABLE_PRECOS_INSUMOS} pi ON b.item_codigo = pi.insumo_codigo AND pi.uf = :uf 
       AND pi.data_referencia >= :start_date AND pi.data_referencia <= :end_date AND pi.regime = :regime
-    LEFT JOIN {settings.TABLE_CUSTOS_COMPOSICOES} pc ON cc.item_codigo = pc.composicao_codigo AND pc.uf = :uf 
+    LEFT JOIN {settings.TABLE_CUSTOS_COMPOSICOES} pc ON b.item_codigo = pc.composicao_codigo AND pc.uf = :uf 
       AND pc.data_referencia >= :start_date AND pc.data_referencia <= :end_date AND pc.regime = :regime
-    GROUP BY 1, 2, 4, 5, 7 ORDER BY nivel, descricao;
+    ORDER BY nivel, descricao;
     """)
-    result = db.execute(query, {"codigo": codigo, "uf": uf.upper(), "start_date": start_date, "end_date": end_date, "regime": regime.upper()}).fetchall()
+    result = db.execute(query, {**params, "uf": uf.upper(), "start_date": start_date, "end_date": end_date, "regime": regime.upper()}).fetchall()
     return [dict(r._mapping) for r in result]
 
-@cache_result(ttl=86400)
+@cache_result(ttl=86400, stale_ttl=settings.CACHE_STALE_TTL, sliced=True, ttl_policy=reference_month_ttl, namespace="abc", admission=True)
 def get_abc_curve_for_composicoes(
     db: Session, codigos: List[int], uf: str, data_referencia: str, regime: str, top_n: int = 50
 ) -> List[dict]:
     start_date, end_date = _get_date_range(data_referencia)
     query = text(f"""
-WITH RECURSIVE composicao_completa (item_codigo, tipo_item, coeficiente_total, nivel) AS (
-        SELECT codigo, 'COMPOSICAO', 1.0, 1 FROM {settings.TABLE_COMPOSICOES} WHERE codigo IN :codigos
-        UNION ALL
-        SELECT vis.item_codigo, vis.tipo_item, rec.coeficiente_total * vis.coeficiente, rec.nivel + 1
-        FROM {settings.VIEW_COMPOSICAO_ITENS} AS vis
-        JOIN composicao_completa AS rec ON vis.composicao_pai_codigo = rec.item_codigo
-        WHERE rec.tipo_item = 'COMPOSICAO' AND rec.nivel < 10
-    )
-    SELECT i.codigo, i.descricao, i.unidade, SUM(cc.coeficiente_total * p.preco_mediano) AS custo_impacto_total
-    FROM composicao_completa cc
-    JOIN {settings.TABLE_INSUMOS} i ON cc.item_codigo = i.codigo
+    SELECT i.codigo, i.descricao, i.unidade, SUM(f.coeficiente_total * p.preco_mediano) AS custo_impacto_total
+    FROM {settings.TABLE_COMPOSICAO_FECHAMENTO} f
+    JOIN {settings.TABLE_INSUMOS} i ON f.item_codigo = i.codigo
     JOIN {settings.TABLE_PRECOS_INSUMOS} p ON i.codigo = p.insumo_codigo
-    WHERE cc.tipo_item = 'INSUMO' AND p.uf = :uf AND p.data_referencia >= :start_date AND p.data_referencia <= :end_date AND p.regime = :regime
+    WHERE f.composicao_codigo IN :codigos AND f.tipo_item = 'INSUMO' AND p.uf = :uf AND p.data_referencia >= :start_date AND p.data_referencia <= :end_date AND p.regime = :regime
     GROUP BY i.codigo, i.descricao, i.unidade
-    HAVING SUM(cc.coeficiente_total * p.preco_mediano) > 0
+    HAVING SUM(f.coeficiente_total * p.preco_mediano) > 0
     ORDER BY custo_impacto_total DESC
     """)
     result = db.execute(query, {"codigos": tuple(codigos), "uf": uf.upper(), "start_date": start_date, "end_date": end_date, "regime": regime.upper()}).fetchall()
@@ -211,7 +456,7 @@ WITH RECURSIVE composicao_completa (item_codigo, tipo_item, coeficiente_total, n
         item['classe_abc'] = 'A' if item['percentual_acumulado'] <= 80 else ('B' if item['percentual_acumulado'] <= 95 else 'C')
     return insumos[:top_n]
 
-@cache_result(ttl=86400)
+@cache_result(ttl=86400, ttl_policy=reference_month_ttl, namespace="bi")
 def get_custo_historico(
     db: Session, tipo_item: str, codigo: int, uf: str, regime: str, data_inicio: str, data_fim: str
 ) -> List[dict]:
@@ -224,33 +469,30 @@ def get_custo_historico(
     result = db.execute(query, {"c": codigo, "uf": uf.upper(), "r": regime.upper(), "s": s_date, "e": e_date}).fetchall()
     return [dict(r._mapping) for r in result]
 
-@cache_result(ttl=86400)
+@cache_result(ttl=86400, stale_ttl=settings.CACHE_STALE_TTL, namespace="bi")
 def get_composicao_man_hours(db: Session, codigo: int):
     """
     Calcula o total de Hora/Homem para uma composição, somando os coeficientes
     de todos os insumos de mão de obra (unidade 'H') em todos os níveis.
     """
+    graph = _get_graph(db)
+    if graph is not None:
+        try:
+            return {'total_hora_homem': graph.man_hours(codigo)}
+        except composition_graph.CompositionCycleError as e:
+            logger.warning(f"{e}. Usando o fechamento no banco, limitado a {settings.BOM_MAX_DEPTH} níveis.")
     query = text(f"""
-    WITH RECURSIVE composicao_completa (item_codigo, tipo_item, coeficiente_total, nivel) AS (
-        SELECT item_codigo, tipo_item, coeficiente, 1 FROM {settings.VIEW_COMPOSICAO_ITENS}
-        WHERE composicao_pai_codigo = :codigo
-        UNION ALL
-        SELECT vis.item_codigo, vis.tipo_item, rec.coeficiente_total * vis.coeficiente, rec.nivel + 1
-        FROM {settings.VIEW_COMPOSICAO_ITENS} AS vis
-        JOIN composicao_completa AS rec ON vis.composicao_pai_codigo = rec.item_codigo
-        WHERE rec.tipo_item = 'COMPOSICAO' AND rec.nivel < 10
-    )
-    SELECT SUM(cc.coeficiente_total) as total_hora_homem
-    FROM composicao_completa cc
-    JOIN {settings.TABLE_INSUMOS} i ON cc.item_codigo = i.codigo
-    WHERE cc.tipo_item = 'INSUMO' AND UPPER(i.unidade) = 'H';
+    SELECT SUM(f.coeficiente_total) as total_hora_homem
+    FROM {settings.TABLE_COMPOSICAO_FECHAMENTO} f
+    JOIN {settings.TABLE_INSUMOS} i ON f.item_codigo = i.codigo
+    WHERE f.composicao_codigo = :codigo AND f.tipo_item = 'INSUMO' AND UPPER(i.unidade) = 'H';
     """)
     result = db.execute(query, {"codigo": codigo}).first()
     if result is None or result.total_hora_homem is None:
         return {'total_hora_homem': 0.0}
     return dict(result._mapping)
 
-@cache_result(ttl=86400)
+@cache_result(ttl=86400, sliced=True, ttl_policy=reference_month_ttl, namespace="bi")
 def get_candidatos_otimizacao(
     db: Session, codigo: int, uf: str, data_referencia: str, regime: str, top_n: int = 5
 ) -> List[dict]:
@@ -263,7 +505,7 @@ def get_candidatos_otimizacao(
     insumos.sort(key=lambda x: float(x.get('custo_impacto_total') or 0), reverse=True)
     return insumos[:top_n]
 
-@cache_result(ttl=86400)
+@cache_result(ttl=86400, namespace="bi")
 def get_manutencoes_historico(db: Session, codigo: int, tipo_item: str) -> List[dict]:
     """
     Retorna o histórico de manutenção (ativações/desativações) de um item.
@@ -279,7 +521,7 @@ def get_manutencoes_historico(db: Session, codigo: int, tipo_item: str) -> List[
     result = db.execute(query, {"codigo": codigo, "tipo_item": tipo_item}).fetchall()
     return [dict(r._mapping) for r in result]
 
-@cache_result(ttl=86400)
+@cache_result(ttl=86400, stale_ttl=settings.CACHE_STALE_TTL, sliced=True, ttl_policy=reference_month_ttl, namespace="bi")
 def get_abc_by_classificacao(
     db: Session, codigos: List[int], uf: str, data_referencia: str, regime: str
 ) -> List[dict]:
@@ -289,25 +531,17 @@ def get_abc_by_classificacao(
     """
     start_date, end_date = _get_date_range(data_referencia)
     query = text(f"""
-    WITH RECURSIVE composicao_completa (item_codigo, tipo_item, coeficiente_total, nivel) AS (
-        SELECT codigo, 'COMPOSICAO', 1.0, 1 FROM {settings.TABLE_COMPOSICOES} WHERE codigo IN :codigos
-        UNION ALL
-        SELECT vis.item_codigo, vis.tipo_item, rec.coeficiente_total * vis.coeficiente, rec.nivel + 1
-        FROM {settings.VIEW_COMPOSICAO_ITENS} as vis
-        JOIN composicao_completa as rec ON vis.composicao_pai_codigo = rec.item_codigo
-        WHERE rec.tipo_item = 'COMPOSICAO' AND rec.nivel < 10
-    )
     SELECT i.classificacao,
-           SUM(cc.coeficiente_total * p.preco_mediano) as custo_total,
+           SUM(f.coeficiente_total * p.preco_mediano) as custo_total,
            COUNT(DISTINCT i.codigo) as total_insumos
-    FROM composicao_completa cc
-    JOIN {settings.TABLE_INSUMOS} i ON cc.item_codigo = i.codigo
+    FROM {settings.TABLE_COMPOSICAO_FECHAMENTO} f
+    JOIN {settings.TABLE_INSUMOS} i ON f.item_codigo = i.codigo
     JOIN {settings.TABLE_PRECOS_INSUMOS} p ON i.codigo = p.insumo_codigo
-    WHERE cc.tipo_item = 'INSUMO' AND p.uf = :uf
+    WHERE f.composicao_codigo IN :codigos AND f.tipo_item = 'INSUMO' AND p.uf = :uf
       AND p.data_referencia >= :start_date AND p.data_referencia <= :end_date AND p.regime = :regime
       AND i.classificacao IS NOT NULL AND i.classificacao != ''
     GROUP BY i.classificacao
-    HAVING SUM(cc.coeficiente_total * p.preco_mediano) > 0
+    HAVING SUM(f.coeficiente_total * p.preco_mediano) > 0
     ORDER BY custo_total DESC;
     """)
     result = db.execute(query, {"codigos": tuple(codigos), "uf": uf.upper(), "start_date": start_date, "end_date": end_date, "regime": regime.upper()}).fetchall()
@@ -317,18 +551,36 @@ def get_abc_by_classificacao(
         item['percentual'] = (float(item['custo_total'] or 0) / total_geral * 100) if total_geral > 0 else 0
     return categorias
 
-@cache_result(ttl=86400)
+@cache_result(ttl=86400, stale_ttl=settings.CACHE_STALE_TTL, ttl_policy=reference_month_ttl, namespace="bi")
 def get_tendencias(
     db: Session, uf: str, regime: str, data_referencia: str, agrupar_por: str = 'classificacao', meses: int = 12, codigos: List[int] = None
 ) -> List[dict]:
     """
     Retorna a evolução mensal do preço/custo médio agrupado por classificação, grupo ou item individual.
+    Os agrupamentos por classificação e grupo são lidos do cubo de preços
+    (`maintenance.refresh_cubo_precos`); itens individuais, ou um cubo ainda não
+    calculado, agregam os preços brutos.
     """
     s_date, e_date = _get_date_range(data_referencia)
     from dateutil.relativedelta import relativedelta
     end_date = e_date
     start_date = s_date - relativedelta(months=meses)
-    
+
+    if agrupar_por in ('classificacao', 'grupo') and not codigos:
+        result = db.execute(text(f"""
+            SELECT categoria AS classificacao, TO_CHAR(data_referencia, 'YYYY-MM') AS mes,
+                   preco_medio, qtd_itens AS qtd_insumos
+            FROM {settings.TABLE_CUBO_PRECOS}
+            WHERE tipo_item = :tipo_item AND nivel = 'UF' AND local = :uf AND regime = :regime
+              AND data_referencia >= :start_date AND data_referencia <= :end_date
+            ORDER BY categoria, data_referencia
+        """), {
+            "tipo_item": 'COMPOSICAO' if agrupar_por == 'grupo' else 'INSUMO', "uf": uf.upper(),
+            "regime": regime.upper(), "start_date": start_date, "end_date": end_date
+        }).fetchall()
+        if result:
+            return [dict(r._mapping) for r in result]
+
     if agrupar_por == 'grupo':
         table_val = settings.TABLE_CUSTOS_COMPOSICOES
         table_item = settings.TABLE_COMPOSICOES
@@ -386,6 +638,48 @@ def get_tendencias(
     result = db.execute(query, params).fetchall()
     return [dict(r._mapping) for r in result]
 
+def _cubo_rows(db: Session, where: str, params: dict) -> List[dict]:
+    query = text(f"""
+        SELECT nivel, local, regiao, categoria, TO_CHAR(data_referencia, 'YYYY-MM') AS mes,
+               preco_medio, preco_mediano, preco_min, preco_max, qtd_precos, qtd_itens
+        FROM {settings.TABLE_CUBO_PRECOS}
+        WHERE tipo_item = :tipo_item AND regime = :regime
+          AND data_referencia >= :start_date AND data_referencia <= :end_date
+          {'AND categoria = UPPER(TRIM(:categoria))' if params.get("categoria") else ''}
+          AND {where}
+        ORDER BY local, categoria, data_referencia
+    """)
+    return [dict(r._mapping) for r in db.execute(query, params).fetchall()]
+
+@cache_result(ttl=86400, stale_ttl=settings.CACHE_STALE_TTL, ttl_policy=reference_month_ttl, namespace="bi")
+def get_cubo_drilldown(
+    db: Session, tipo_item: str, data_referencia: str, regime: str, nivel: str = 'BRASIL',
+    local: str = None, categoria: str = None, meses: int = 0
+) -> dict:
+    """
+    Detalhamento regional do cubo de preços: os agregados do nó (Brasil, uma
+    macrorregião ou uma UF) e os dos seus filhos (macrorregiões do Brasil, UFs
+    da macrorregião), por categoria e mês, dos `meses` anteriores até
+    `data_referencia`.
+    """
+    s_date, end_date = _get_date_range(data_referencia)
+    from dateutil.relativedelta import relativedelta
+    nivel = nivel.upper()
+    local = 'BR' if nivel == 'BRASIL' else local.upper()
+    params = {
+        "tipo_item": 'COMPOSICAO' if tipo_item == 'composicao' else 'INSUMO', "regime": regime.upper(),
+        "start_date": s_date - relativedelta(months=meses), "end_date": end_date,
+        "nivel": nivel, "local": local, **({"categoria": categoria} if categoria else {})
+    }
+    agregado = _cubo_rows(db, "nivel = :nivel AND local = :local", params)
+    if nivel == 'BRASIL':
+        detalhamento = _cubo_rows(db, "nivel = 'REGIAO'", params)
+    elif nivel == 'REGIAO':
+        detalhamento = _cubo_rows(db, "nivel = 'UF' AND regiao = :local", params)
+    else:
+        detalhamento = []
+    return {"tipo_item": tipo_item, "nivel": nivel, "local": local, "agregado": agregado, "detalhamento": detalhamento}
+
 def get_precos_all_ufs(
     db: Session, tipo_item: str, codigo: int, data_referencia: str, regime: str
 ) -> List[dict]:
@@ -410,7 +704,7 @@ def get_precos_all_ufs(
     }).fetchall()
     return [dict(r._mapping) for r in result]
 
-@cache_result(ttl=86400)
+@cache_result(ttl=86400, stale_ttl=settings.CACHE_STALE_TTL, sliced=True, ttl_policy=reference_month_ttl, namespace="bi")
 def get_composicao_produtividade(
     db: Session, codigo: int, uf: str, data_referencia: str, regime: str
 ) -> dict:
@@ -451,61 +745,193 @@ def get_composicao_produtividade(
         "custo_por_hh": round(custo_por_hh, 2) if custo_por_hh is not None else None,
     }
 
-@cache_result(ttl=86400)
+def _price_deltas_from_closure(db: Session, deltas: dict) -> dict:
+    """Variação de custo das composições pelo fechamento transitivo (sem o grafo em memória)."""
+    query = text(f"""
+        SELECT f.composicao_codigo, SUM(f.coeficiente_total * d.delta) AS variacao
+        FROM {settings.TABLE_COMPOSICAO_FECHAMENTO} f
+        JOIN unnest(CAST(:codigos AS integer[]), CAST(:deltas AS float8[])) AS d(codigo, delta)
+          ON f.item_codigo = d.codigo
+        WHERE f.tipo_item = 'INSUMO'
+        GROUP BY f.composicao_codigo
+    """)
+    params = {"codigos": list(deltas.keys()), "deltas": list(deltas.values())}
+    return {r.composicao_codigo: float(r.variacao or 0) for r in db.execute(query, params).fetchall()}
+
+def simulate_price_changes(
+    db: Session, alteracoes: List[dict], uf: str, data_referencia: str, regime: str
+) -> List[dict]:
+    """
+    Simulação "e se": aplica as alterações de preço de insumos (`codigo` com
+    `variacao_percentual` ou novo `preco`) sobre os preços da fatia e retorna as
+    composições afetadas com o custo atual e o simulado. As variações são
+    propagadas só pelos ancestrais dos insumos alterados (ver
+    `graph.CompositionGraph.propagate_price_deltas`).
+    """
+    start_date, end_date = _get_date_range(data_referencia)
+    if not start_date or not alteracoes:
+        return []
+    params = {"uf": uf.upper(), "regime": regime.upper(), "start_date": start_date, "end_date": end_date}
+
+    codigos = [a["codigo"] for a in alteracoes]
+    precos = dict(db.execute(text(f"""
+        SELECT insumo_codigo, preco_mediano FROM {settings.TABLE_PRECOS_INSUMOS}
+        WHERE insumo_codigo = ANY(:codigos) AND uf = :uf AND regime = :regime
+          AND data_referencia >= :start_date AND data_referencia <= :end_date
+    """), {**params, "codigos": codigos}).fetchall())
+    deltas = {}
+    for alteracao in alteracoes:
+        atual = precos.get(alteracao["codigo"])
+        if alteracao.get("preco") is not None:
+            deltas[alteracao["codigo"]] = float(alteracao["preco"]) - float(atual or 0)
+        elif atual is not None and alteracao.get("variacao_percentual") is not None:
+            deltas[alteracao["codigo"]] = float(atual) * float(alteracao["variacao_percentual"]) / 100
+    deltas = {codigo: delta for codigo, delta in deltas.items() if delta}
+    if not deltas:
+        return []
+
+    variacoes = None
+    graph = _get_graph(db)
+    if graph is not None:
+        try:
+            afetadas, valores = graph.propagate_price_deltas(deltas)
+            variacoes = dict(zip(afetadas.tolist(), valores.tolist()))
+        except composition_graph.CompositionCycleError as e:
+            logger.warning(f"{e}. Usando o fechamento no banco, limitado a {settings.BOM_MAX_DEPTH} níveis.")
+    if variacoes is None:
+        variacoes = _price_deltas_from_closure(db, deltas)
+    variacoes = {codigo: v for codigo, v in variacoes.items() if abs(v) >= 0.005}
+    if not variacoes:
+        return []
+
+    atuais = db.execute(text(f"""
+        SELECT c.codigo, c.descricao, m.custo_total
+        FROM {settings.TABLE_COMPOSICOES} c
+        LEFT JOIN {settings.TABLE_CUSTOS_COMPOSICOES} m
+          ON m.composicao_codigo = c.codigo AND m.uf = :uf AND m.regime = :regime
+         AND m.data_referencia >= :start_date AND m.data_referencia <= :end_date
+        WHERE c.codigo = ANY(:codigos)
+    """), {**params, "codigos": list(variacoes.keys())}).fetchall()
+
+    impactos = []
+    for r in atuais:
+        variacao = variacoes[r.codigo]
+        custo_atual = float(r.custo_total) if r.custo_total is not None else None
+        impactos.append({
+            "composicao_codigo": r.codigo,
+            "composicao_descricao": r.descricao,
+            "custo_atual": round(custo_atual, 2) if custo_atual is not None else None,
+            "custo_simulado": round(custo_atual + variacao, 2) if custo_atual is not None else None,
+            "variacao": round(variacao, 2),
+            "variacao_percentual": round(variacao / custo_atual * 100, 2) if custo_atual else None,
+        })
+    impactos.sort(key=lambda i: abs(i["variacao"]), reverse=True)
+    return impactos
+
+@cache_result(ttl=86400, stale_ttl=settings.CACHE_STALE_TTL, namespace="bi")
 def get_onde_usado(
     db: Session, codigo: int, tipo_item: str = 'insumo'
 ) -> List[dict]:
     """
-    Query reversa recursiva: encontra todas as composições que usam um insumo
-    (ou subcomposição) em qualquer nível hierárquico.
+    Query reversa: encontra todas as composições que usam um insumo (ou
+    subcomposição) em qualquer nível hierárquico, com o coeficiente acumulado
+    e o nível mais raso em que o item aparece.
     """
     item_type = 'INSUMO' if tipo_item == 'insumo' else 'COMPOSICAO'
+    graph = _get_graph(db)
+    if graph is not None:
+        try:
+            usos = graph.where_used(item_type, codigo)
+        except composition_graph.CompositionCycleError as e:
+            logger.warning(f"{e}. Usando o fechamento no banco, limitado a {settings.BOM_MAX_DEPTH} níveis.")
+        else:
+            rows = [
+                {"composicao_codigo": pai, "composicao_descricao": graph.descricoes[pai],
+                 "tipo_item": 'COMPOSICAO', "coeficiente": coeficiente, "nivel": nivel}
+                for pai, coeficiente, nivel in usos if pai in graph.descricoes
+            ]
+            return sorted(rows, key=lambda r: (r["nivel"], r["composicao_descricao"]))
     query = text(f"""
-        WITH RECURSIVE parents AS (
-            SELECT composicao_pai_codigo, coeficiente, 1 as nivel
-            FROM {settings.VIEW_COMPOSICAO_ITENS}
-            WHERE item_codigo = :codigo AND tipo_item = :item_type
-            UNION ALL
-            SELECT ci.composicao_pai_codigo, p.coeficiente * ci.coeficiente, p.nivel + 1
-            FROM {settings.VIEW_COMPOSICAO_ITENS} ci
-            JOIN parents p ON ci.item_codigo = p.composicao_pai_codigo
-            WHERE ci.tipo_item = 'COMPOSICAO' AND p.nivel < 10
-        )
-        SELECT DISTINCT c.codigo as composicao_codigo, c.descricao as composicao_descricao,
-               'COMPOSICAO' as tipo_item, p.coeficiente, p.nivel
-        FROM parents p
-        JOIN {settings.TABLE_COMPOSICOES} c ON c.codigo = p.composicao_pai_codigo
-        ORDER BY p.nivel, c.descricao
+        SELECT c.codigo as composicao_codigo, c.descricao as composicao_descricao,
+               'COMPOSICAO' as tipo_item, f.coeficiente_total as coeficiente, f.nivel_min as nivel
+        FROM {settings.TABLE_COMPOSICAO_FECHAMENTO} f
+        JOIN {settings.TABLE_COMPOSICOES} c ON c.codigo = f.composicao_codigo
+        WHERE f.item_codigo = :codigo AND f.tipo_item = :item_type
+        ORDER BY nivel, c.descricao
     """)
     result = db.execute(query, {"codigo": codigo, "item_type": item_type}).fetchall()
     return [dict(r._mapping) for r in result]
 
 
-@cache_result(ttl=3600)
+@cache_result(ttl=3600, namespace="audit")
 def get_audit_events(
-    db: Session, tipo_item: str, codigo: int, data_referencia: str = None
+    db: Session, tipo_item: str, codigo: int, data_referencia: str = None,
+    limit: int = 100, cursor: str = None
 ) -> List[dict]:
     """
-    Retorna o histórico de auditoria para um item específico.
-    Cruzar record_pk com o código do item.
+    Retorna o histórico de auditoria de um item, do evento mais recente para o
+    mais antigo. Filtra pelas colunas `tipo_item`, `item_codigo` e
+    `data_referencia` geradas a partir de `record_pk` (migração 011) e pagina
+    por chave em `(created_at, id)` a partir do `cursor` da página anterior.
+    O histórico de uma composição inclui as linhas da sua estrutura, que têm
+    o insumo como item e a composição em `composicao_codigo` (migração 012).
+    Datas e cursores inválidos levantam `ValueError`.
     """
-    query_str = """
-        SELECT id, table_name, record_pk, operation, 
-               old_values, new_values, sinapi_versao, 
+    params = {"tipo_item": 'COMPOSICAO' if tipo_item == 'composicao' else 'INSUMO', "codigo": codigo, "limit": limit}
+    filters = ""
+    if data_referencia:
+        start_date, _ = _get_date_range(data_referencia)
+        if start_date is None:
+            raise ValueError(f"data_referencia inválida: {data_referencia!r} (use AAAA-MM)")
+        filters += " AND data_referencia = :data_referencia"
+        params["data_referencia"] = start_date
+    after = decode_cursor(cursor, 2)
+    if after is not None:
+        filters += " AND (created_at, id) < (CAST(:after_created_at AS timestamptz), :after_id)"
+        params.update(after_created_at=str(after[0]), after_id=int(after[1]))
+
+    keys = ["tipo_item = :tipo_item AND item_codigo = :codigo"]
+    if params["tipo_item"] == 'COMPOSICAO':
+        keys.append("composicao_codigo = :codigo")
+    # Um ramo por chave, cada um lido em ordem pelo seu índice; as chaves são disjuntas
+    branches = " UNION ALL ".join(f"""(
+        SELECT id, table_name, record_pk, operation,
+               old_values, new_values, sinapi_versao,
                motivo_manutencao, created_at
         FROM sinapi_audit_log
-        WHERE (record_pk->>'codigo' = :codigo OR 
-               record_pk->>'insumo_codigo' = :codigo OR 
-               record_pk->>'composicao_codigo' = :codigo)
+        WHERE {key}{filters}
+        ORDER BY created_at DESC, id DESC
+        LIMIT :limit
+    )""" for key in keys)
+    query = text(f"""
+        SELECT * FROM ({branches}) AS eventos
+        ORDER BY created_at DESC, id DESC
+        LIMIT :limit
+    """)
+    result = db.execute(query, params).fetchall()
+    return [dict(r._mapping) for r in result]
+
+
+def get_rollup_divergencias(
+    db: Session, uf: str, data_referencia: str, regime: str, limit: int = 100
+) -> List[dict]:
     """
-    params = {"codigo": str(codigo)}
-    
-    if data_referencia:
-        query_str += " AND record_pk->>'data_referencia' = :data_ref"
-        params["data_ref"] = data_referencia
-    
-    query_str += " ORDER BY created_at DESC LIMIT 100"
-    
-    query = text(query_str)
+    Retorna as composições cujo custo recalculado pelo roll-up diverge do
+    oficial na fatia informada, das maiores diferenças relativas para as menores.
+    """
+    start_date, _ = _get_date_range(data_referencia)
+    if not start_date:
+        return []
+    query = text(f"""
+        SELECT r.composicao_codigo, c.descricao, r.custo_calculado, r.custo_oficial,
+               r.diferenca, r.diferenca_percentual, r.mao_de_obra, r.material,
+               r.equipamento, r.total_hh, r.itens_sem_preco
+        FROM {settings.TABLE_CUSTOS_CALCULADOS} r
+        LEFT JOIN {settings.TABLE_COMPOSICOES} c ON c.codigo = r.composicao_codigo
+        WHERE r.uf = :uf AND r.data_referencia = :data_referencia AND r.regime = :regime AND r.divergente
+        ORDER BY ABS(r.diferenca_percentual) DESC NULLS LAST, r.composicao_codigo
+        LIMIT :limit
+    """)
+    params = {"uf": uf.upper(), "data_referencia": start_date, "regime": regime.upper(), "limit": limit}
     result = db.execute(query, params).fetchall()
     return [dict(r._mapping) for r in result]
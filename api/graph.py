@@ -0,0 +1,335 @@
+# api/graph.py
+"""
+Grafo em memória da estrutura das composições.
+
+A estrutura (`composicao_insumos` + `composicao_subcomposicoes`, via a view
+unificada) é carregada uma vez por worker em arrays NumPy no formato CSR,
+nos dois sentidos:
+
+- direto (composição -> itens), para a explosão do BOM e o total de hora-homem;
+- reverso (item -> composições que o usam), para o "onde é usado" e a
+  simulação de variações de preço (`propagate_price_deltas`).
+
+Os coeficientes ficam em float64 e a explosão propaga, nível a nível, o
+coeficiente acumulado de todos os caminhos, sem SQL recursivo. Na carga, o
+grafo é percorrido em ordem topológica para medir a profundidade de cada
+composição e encontrar ciclos. Nada é truncado: explosões que alcançam um ciclo
+levantam `CompositionCycleError`, e composições com mais de `BOM_MAX_DEPTH`
+níveis são explodidas por inteiro e listadas em `diagnostics()`.
+
+O grafo é recarregado quando a geração de dados (ver `cache_utils`) muda; a
+troca é atômica (uma referência) e, durante a recarga, os demais threads
+continuam usando o grafo anterior.
+"""
+
+import time
+import logging
+import threading
+
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from .config import settings
+from .cache_utils import get_generation
+from .sandbox_utils import is_sandbox_mode
+
+logger = logging.getLogger(__name__)
+
+COMPOSICAO = "COMPOSICAO"
+INSUMO = "INSUMO"
+
+# Categoria de cada insumo pela unidade, como em `crud.get_composicao_produtividade`
+CATEGORIA_MATERIAL = 0
+CATEGORIA_MAO_DE_OBRA = 1
+CATEGORIA_EQUIPAMENTO = 2
+_EQUIPMENT_UNITS = {"CHP", "CHI", "EQ"}
+
+
+class CompositionCycleError(Exception):
+    """A composição contém (direta ou indiretamente) um ciclo na estrutura."""
+    def __init__(self, codigo: int, ciclo: list):
+        super().__init__(f"Composição {codigo} contém um ciclo na estrutura: {ciclo}")
+        self.codigo = codigo
+        self.ciclo = ciclo
+
+
+def _csr(rows: np.ndarray, cols: np.ndarray, weights: np.ndarray, size: int):
+    order = np.argsort(rows, kind="stable")
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+    return indptr, cols[order].astype(np.int32), weights[order]
+
+
+def _peel(src: np.ndarray, dst: np.ndarray, size: int) -> np.ndarray:
+    """
+    Remove os nós em camadas: primeiro os sem arestas de saída (src -> dst),
+    depois os que só apontavam para nós já removidos, e assim por diante.
+    Retorna a camada de cada nó (1 = primeira); 0 indica que o nó nunca sai,
+    ou seja, alcança um ciclo.
+    """
+    pending = np.bincount(src, minlength=size).astype(np.int64)
+    rev_indptr, rev_indices, _ = _csr(dst, src, np.zeros(len(src)), size)
+    levels = np.zeros(size, dtype=np.int32)
+    frontier = np.nonzero(pending == 0)[0]
+    level = 0
+    while frontier.size:
+        level += 1
+        levels[frontier] = level
+        offsets, _ = _gather(rev_indptr, frontier)
+        if not offsets.size:
+            break
+        predecessors = rev_indices[offsets]
+        np.subtract.at(pending, predecessors, 1)
+        candidates = np.unique(predecessors)
+        frontier = candidates[(pending[candidates] == 0) & (levels[candidates] == 0)]
+    return levels
+
+
+def _gather(indptr: np.ndarray, nodes: np.ndarray):
+    """Posições, nos arrays CSR, das arestas de saída de `nodes` (e quantas por nó)."""
+    starts = indptr[nodes]
+    counts = indptr[nodes + 1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64), counts
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+    return offsets, counts
+
+
+class CompositionGraph:
+    """
+    Estrutura das composições em CSR. Os nós são as composições (índices
+    `0..n_composicoes-1`) seguidas dos insumos.
+    """
+    def __init__(self, edges, descricoes: dict = None, unidades: dict = None, generation: int = 0):
+        """
+        `edges`: iterável de `(composicao_pai_codigo, item_codigo, tipo_item, coeficiente)`.
+        `descricoes`: descrição por código de composição; `unidades`: unidade por código de insumo.
+        """
+        start = time.perf_counter()
+        self.generation = generation
+        descricoes = descricoes or {}
+        unidades = unidades or {}
+        edges = list(edges)
+
+        composicoes = {int(p) for p, _, _, _ in edges} | {int(c) for _, c, t, _ in edges if t == COMPOSICAO}
+        composicoes |= {int(c) for c in descricoes}
+        insumos = {int(c) for _, c, t, _ in edges if t == INSUMO}
+        self.n_composicoes = len(composicoes)
+        self.codes = np.array(sorted(composicoes) + sorted(insumos), dtype=np.int64)
+        self._index = {(COMPOSICAO, c): i for i, c in enumerate(self.codes[:self.n_composicoes].tolist())}
+        self._index.update({(INSUMO, c): i + self.n_composicoes for i, c in enumerate(self.codes[self.n_composicoes:].tolist())})
+        size = len(self.codes)
+
+        parents = np.array([self._index[(COMPOSICAO, int(p))] for p, _, _, _ in edges], dtype=np.int64)
+        children = np.array([self._index[(t, int(c))] for _, c, t, _ in edges], dtype=np.int64)
+        # Coeficiente nulo não contribui para o total (como o SUM do SQL)
+        weights = np.array([float(w) if w is not None else 0.0 for _, _, _, w in edges], dtype=np.float64)
+        self.fwd_indptr, self.fwd_indices, self.fwd_coef = _csr(parents, children, weights, size)
+        self.rev_indptr, self.rev_indices, self.rev_coef = _csr(children, parents, weights, size)
+
+        self.descricoes = {int(k): v for k, v in descricoes.items()}
+        self.categoria = np.full(size, CATEGORIA_MATERIAL, dtype=np.int8)
+        for codigo, unidade in unidades.items():
+            node = self._index.get((INSUMO, int(codigo)))
+            unidade = (unidade or "").strip().upper()
+            if node is None:
+                continue
+            if unidade == "H":
+                self.categoria[node] = CATEGORIA_MAO_DE_OBRA
+            elif unidade in _EQUIPMENT_UNITS:
+                self.categoria[node] = CATEGORIA_EQUIPAMENTO
+        self.is_labor = self.categoria == CATEGORIA_MAO_DE_OBRA
+
+        self._analyze(parents, children)
+        self.n_edges = len(edges)
+        self.load_seconds = time.perf_counter() - start
+
+    def _analyze(self, parents: np.ndarray, children: np.ndarray):
+        """
+        Mede a profundidade do BOM de cada composição e encontra os ciclos,
+        removendo as composições em camadas (ver `_peel`).
+        """
+        n = self.n_composicoes
+        sub = children < n
+        sub_parents, sub_children = parents[sub], children[sub]
+        self.depth = _peel(sub_parents, sub_children, n)
+        # Membros de ciclo não saem nem a partir das folhas nem a partir do topo
+        self.in_cycle = (self.depth == 0) & (_peel(sub_children, sub_parents, n) == 0)
+        # Composições sem itens não têm BOM: profundidade 0
+        self.depth[np.diff(self.fwd_indptr[:n + 1]) == 0] = 0
+
+    def node(self, tipo_item: str, codigo: int):
+        return self._index.get((tipo_item, int(codigo)))
+
+    def _propagate(self, indptr, indices, weights, start: int, codigo: int):
+        """
+        Propaga o coeficiente acumulado a partir de `start`, nível a nível.
+        Retorna `(nós, coeficiente_total, nivel_min)` de todos os nós alcançados.
+        Levanta `CompositionCycleError` ao alcançar um ciclo.
+        """
+        total = {}
+        nivel = {}
+        frontier_nodes = np.array([start], dtype=np.int64)
+        frontier_coef = np.array([1.0])
+        level = 0
+        while frontier_nodes.size:
+            offsets, counts = _gather(indptr, frontier_nodes)
+            if not offsets.size:
+                break
+            level += 1
+            reached = indices[offsets]
+            contribution = weights[offsets] * np.repeat(frontier_coef, counts)
+            frontier_nodes, inverse = np.unique(reached, return_inverse=True)
+            frontier_coef = np.bincount(inverse, weights=contribution)
+            composicoes = frontier_nodes[frontier_nodes < self.n_composicoes]
+            if self.in_cycle[composicoes].any():
+                raise CompositionCycleError(codigo, self.codes[composicoes[self.in_cycle[composicoes]]].tolist())
+            for node, coef in zip(frontier_nodes.tolist(), frontier_coef.tolist()):
+                total[node] = total.get(node, 0.0) + coef
+                nivel.setdefault(node, level)
+        nodes = np.fromiter(total.keys(), dtype=np.int64, count=len(total))
+        return nodes, np.fromiter(total.values(), dtype=np.float64, count=len(total)), np.array([nivel[n] for n in nodes.tolist()], dtype=np.int32)
+
+    def explode(self, codigo: int) -> list:
+        """
+        BOM completo da composição: `[(tipo_item, item_codigo, coeficiente_total, nivel), ...]`,
+        somando o coeficiente de todos os caminhos até cada item.
+        """
+        start = self.node(COMPOSICAO, codigo)
+        if start is None:
+            return []
+        nodes, totals, niveis = self._propagate(self.fwd_indptr, self.fwd_indices, self.fwd_coef, start, codigo)
+        return [
+            (COMPOSICAO if node < self.n_composicoes else INSUMO, int(self.codes[node]), coef, int(nivel))
+            for node, coef, nivel in zip(nodes.tolist(), totals.tolist(), niveis.tolist())
+        ]
+
+    def man_hours(self, codigo: int) -> float:
+        """Soma dos coeficientes acumulados dos insumos de mão de obra (unidade 'H')."""
+        start = self.node(COMPOSICAO, codigo)
+        if start is None:
+            return 0.0
+        nodes, totals, _ = self._propagate(self.fwd_indptr, self.fwd_indices, self.fwd_coef, start, codigo)
+        return float(totals[self.is_labor[nodes]].sum()) if nodes.size else 0.0
+
+    def where_used(self, tipo_item: str, codigo: int) -> list:
+        """
+        Composições que usam o item em qualquer nível:
+        `[(composicao_codigo, coeficiente_total, nivel), ...]`.
+        """
+        start = self.node(tipo_item, codigo)
+        if start is None:
+            return []
+        nodes, totals, niveis = self._propagate(self.rev_indptr, self.rev_indices, self.rev_coef, start, codigo)
+        return [(int(self.codes[n]), coef, int(nivel)) for n, coef, nivel in zip(nodes.tolist(), totals.tolist(), niveis.tolist())]
+
+    def propagate_price_deltas(self, deltas: dict):
+        """
+        Propaga variações de preço de insumos (`{insumo_codigo: variação}`) para
+        as composições que os usam, em qualquer nível. Só o subgrafo ancestral
+        dos insumos é visitado, em ordem topológica (profundidade crescente), de
+        modo que cada composição repassa sua variação já completa aos pais.
+        Retorna `(codigos, variacoes)` das composições afetadas.
+        """
+        starts = [(self.node(INSUMO, codigo), float(delta)) for codigo, delta in deltas.items()]
+        starts = [(node, delta) for node, delta in starts if node is not None and delta]
+        if not starts:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        start_nodes = np.array([node for node, _ in starts], dtype=np.int64)
+        start_deltas = np.array([delta for _, delta in starts])
+
+        # Ancestrais dos insumos alterados, pelo grafo reverso
+        affected = np.empty(0, dtype=np.int64)
+        frontier = start_nodes
+        while frontier.size:
+            offsets, _ = _gather(self.rev_indptr, frontier)
+            frontier = np.setdiff1d(self.rev_indices[offsets], affected)
+            affected = np.union1d(affected, frontier)
+        if not affected.size:
+            return affected, np.empty(0)
+        if (self.depth[affected] == 0).any():
+            ciclo = affected[self.in_cycle[affected]]
+            raise CompositionCycleError(int(self.codes[start_nodes[0]]), self.codes[ciclo].tolist())
+
+        variacao = np.zeros(len(affected))
+        offsets, counts = _gather(self.rev_indptr, start_nodes)
+        np.add.at(variacao, np.searchsorted(affected, self.rev_indices[offsets]),
+                  self.rev_coef[offsets] * np.repeat(start_deltas, counts))
+        depths = self.depth[affected]
+        for depth in np.unique(depths).tolist():
+            layer = np.nonzero(depths == depth)[0]
+            offsets, counts = _gather(self.rev_indptr, affected[layer])
+            if offsets.size:
+                np.add.at(variacao, np.searchsorted(affected, self.rev_indices[offsets]),
+                          self.rev_coef[offsets] * np.repeat(variacao[layer], counts))
+        return self.codes[affected], variacao
+
+    def diagnostics(self) -> dict:
+        """Tamanho do grafo, profundidade máxima e composições em ciclo ou acima de `BOM_MAX_DEPTH`."""
+        comp_codes = self.codes[:self.n_composicoes]
+        too_deep = comp_codes[self.depth > settings.BOM_MAX_DEPTH]
+        cyclic = comp_codes[self.in_cycle]
+        return {
+            "geracao": self.generation,
+            "composicoes": self.n_composicoes,
+            "insumos": len(self.codes) - self.n_composicoes,
+            "arestas": self.n_edges,
+            "profundidade_maxima": int(self.depth.max()) if self.n_composicoes else 0,
+            "limite_profundidade": settings.BOM_MAX_DEPTH,
+            "acima_do_limite": too_deep.tolist(),
+            "em_ciclo": cyclic.tolist(),
+            "carga_segundos": round(self.load_seconds, 3),
+        }
+
+
+def load_graph(db: Session, generation: int = 0) -> CompositionGraph:
+    """Carrega a estrutura das composições do banco para um `CompositionGraph`."""
+    edges = db.execute(text(f"""
+        SELECT composicao_pai_codigo, item_codigo, tipo_item, coeficiente
+        FROM {settings.VIEW_COMPOSICAO_ITENS}
+    """)).fetchall()
+    descricoes = dict(db.execute(text(f"SELECT codigo, descricao FROM {settings.TABLE_COMPOSICOES}")).fetchall())
+    unidades = dict(db.execute(text(f"SELECT codigo, unidade FROM {settings.TABLE_INSUMOS}")).fetchall())
+    graph = CompositionGraph(edges, descricoes, unidades, generation)
+    report = graph.diagnostics()
+    if report["em_ciclo"]:
+        logger.warning(f"Estrutura de composições com ciclos: {report['em_ciclo'][:20]}")
+    if report["acima_do_limite"]:
+        logger.warning(
+            f"{len(report['acima_do_limite'])} composições com mais de {settings.BOM_MAX_DEPTH} níveis: "
+            f"{report['acima_do_limite'][:20]}"
+        )
+    logger.info(
+        f"Grafo de composições carregado: {report['composicoes']} composições, "
+        f"{report['arestas']} arestas em {report['carga_segundos']}s"
+    )
+    return graph
+
+
+_graphs = {}
+_load_lock = threading.Lock()
+
+
+def get_graph(db: Session) -> CompositionGraph:
+    """
+    Retorna o grafo do modo atual, recarregando-o se a geração de dados mudou.
+    Se outro thread já estiver recarregando, devolve o grafo anterior, assim
+    como quando a geração não pode ser lida (Redis indisponível).
+    """
+    mode = "sandbox" if is_sandbox_mode() else "prod"
+    generation = get_generation()
+    graph = _graphs.get(mode)
+    if graph is not None and (graph.generation == generation or generation is None):
+        return graph
+    if not _load_lock.acquire(blocking=graph is None):
+        return graph
+    try:
+        current = _graphs.get(mode)
+        if current is not None and current.generation == generation:
+            return current
+        _graphs[mode] = load_graph(db, generation)
+        return _graphs[mode]
+    finally:
+        _load_lock.release()
@@ -0,0 +1,304 @@
+"""
+Cache HTTP da API pública.
+
+Este módulo concentra os mecanismos de cache no nível HTTP, complementares ao
+cache de funções de `cache_utils`:
+
+- `conditional_requests`: middleware que emite `ETag`, `Last-Modified` e
+  `Cache-Control` para os GETs públicos e responde `304 Not Modified` a
+  requisições condicionais (`If-None-Match` / `If-Modified-Since`) sem
+  executar a rota, ou seja, sem tocar o PostgreSQL nem serializar a resposta.
+
+- `cached_response` + `response_cache`: cache opcional, por rota, da resposta
+  HTTP já codificada (e de sua variante gzip). Em um hit a rota inteira é
+  pulada, inclusive a validação do `response_model` e a serialização JSON.
+
+- `purge_gateway_cache`: esvazia o cache de resposta do Kong (plugin
+  proxy-cache da rota `public-read-route` em `kong/kong.yml`), chamado pelo
+  ETL ao concluir uma carga.
+
+Os validadores derivam da geração de dados mantida em `cache_utils`, que é
+incrementada a cada carga de ETL ou retificação. Enquanto a geração não muda,
+a mesma URL produz sempre a mesma resposta, o que permite ETags fortes. A
+variante gzip do cache de resposta tem ETag próprio (`gzip_etag`).
+"""
+
+import gzip
+import json
+import hashlib
+import logging
+import urllib.request
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Match
+
+from .config import settings
+from .cache_utils import get_generation_state, get_latest_reference_month, local_cache, redis_client, track_popularity, _MISS
+from .sandbox_utils import is_sandbox_mode
+
+logger = logging.getLogger(__name__)
+
+PUBLIC_PREFIX = "/api/v1/public/"
+# Rotas públicas cujo conteúdo não depende apenas da geração de dados
+_EXCLUDED_PREFIXES = ("/api/v1/public/health", "/api/v1/public/data/geo")
+
+
+def _is_cacheable(request: Request) -> bool:
+    path = request.url.path
+    return (
+        request.method in ("GET", "HEAD")
+        and path.startswith(PUBLIC_PREFIX)
+        and not path.startswith(_EXCLUDED_PREFIXES)
+    )
+
+
+def _normalized_query(request: Request) -> str:
+    return "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+
+
+def build_etag(request: Request, generation: int) -> str:
+    """ETag forte: hash do modo, da geração de dados, do caminho e da query normalizada."""
+    mode = "sandbox" if is_sandbox_mode() else "prod"
+    raw = f"{mode}:{generation}:{request.url.path}?{_normalized_query(request)}"
+    return f'"{hashlib.sha1(raw.encode("utf-8")).hexdigest()[:32]}"'
+
+
+def _is_closed_month(request: Request) -> bool:
+    """
+    Indica se a requisição se refere a um mês anterior ao mais recente carregado
+    pelo ETL (dado que não muda mais), com o mesmo critério de
+    `cache_utils.reference_month_ttl`.
+    """
+    reference = request.query_params.get("data_referencia") or request.query_params.get("data_fim")
+    if not reference:
+        return False
+    try:
+        month = datetime.strptime(reference[:7], "%Y-%m").strftime("%Y-%m")
+    except ValueError:
+        return False
+    return month < get_latest_reference_month()
+
+
+def cache_control_for(request: Request) -> str:
+    max_age = settings.HTTP_CACHE_CLOSED_MONTH_MAX_AGE if _is_closed_month(request) else settings.HTTP_CACHE_MAX_AGE
+    return f"public, max-age={max_age}"
+
+
+def gzip_etag(etag: str) -> str:
+    """ETag da variante gzip do cache de resposta: um ETag forte identifica também a codificação."""
+    return f'{etag[:-1]}-gz"'
+
+
+def _matching_etag(if_none_match: str, etags: tuple):
+    """Retorna o ETag de `etags` presente em `If-None-Match`, ou `None`."""
+    candidates = {c.strip().removeprefix("W/") for c in if_none_match.split(",")}
+    # Comparação fraca (RFC 9110): ignora o prefixo W/ adicionado por proxies.
+    # "*" não conta: o 304 sai antes da rota, sem saber se o recurso existe.
+    return next((etag for etag in etags if etag in candidates), None)
+
+
+def _not_modified_since(if_modified_since: str, last_modified: datetime) -> bool:
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    return last_modified.replace(microsecond=0) <= since
+
+
+async def conditional_requests(request: Request, call_next):
+    """
+    Middleware de requisições condicionais para os GETs públicos.
+
+    Uma resposta 200 recebe `ETag`, `Last-Modified` e `Cache-Control`; meses já
+    fechados recebem um `max-age` longo. Se o cliente reenviar o validador e a
+    geração de dados não tiver mudado, responde 304 sem executar a rota.
+    """
+    if not _is_cacheable(request):
+        return await call_next(request)
+
+    # Geração e último mês carregado podem ir ao Redis (L1 expirado): fora do event loop
+    generation, updated_at = await run_in_threadpool(get_generation_state)
+    if generation is None:
+        # Geração desconhecida (Redis indisponível): sem validadores nem 304
+        return await call_next(request)
+    etag = build_etag(request, generation)
+    headers = {"ETag": etag, "Cache-Control": await run_in_threadpool(cache_control_for, request)}
+    last_modified = None
+    if updated_at:
+        last_modified = datetime.fromtimestamp(updated_at, tz=timezone.utc)
+        headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        # As duas variantes só mudam com a geração: vale o validador de qualquer uma
+        matched = _matching_etag(if_none_match, (etag, gzip_etag(etag)))
+        not_modified = matched is not None
+        if matched:
+            headers["ETag"] = matched
+    else:
+        not_modified = bool(if_modified_since and last_modified and _not_modified_since(if_modified_since, last_modified))
+    if not_modified:
+        if _match_cached_route(request)[0] is not None:
+            headers["Vary"] = "Accept-Encoding"
+        return Response(status_code=304, headers=headers)
+
+    response = await call_next(request)
+    if response.status_code == 200:
+        if response.headers.get("content-encoding") == "gzip":
+            headers["ETag"] = gzip_etag(etag)
+        for name, value in headers.items():
+            response.headers.setdefault(name, value)
+    return response
+
+
+def cached_response(ttl: int = None, popularity: str = None):
+    """
+    Marca uma rota para o cache de resposta HTTP (ver `response_cache`).
+    Deve ficar abaixo do decorator de rota do FastAPI:
+
+        @app.get(...)
+        @http_cache.cached_response(popularity="composicao")
+        def rota(...): ...
+
+    `popularity` mantém a contagem de acessos (`track_popularity`) do
+    `codigo` da rota mesmo quando a resposta vem do cache.
+    """
+    def decorator(endpoint):
+        endpoint._response_cache_ttl = ttl or settings.HTTP_RESPONSE_CACHE_TTL
+        endpoint._response_cache_popularity = popularity
+        return endpoint
+    return decorator
+
+
+def _match_cached_route(request: Request):
+    for route in request.app.router.routes:
+        match, child_scope = route.matches(request.scope)
+        if match == Match.FULL:
+            endpoint = getattr(route, "endpoint", None)
+            if getattr(endpoint, "_response_cache_ttl", None):
+                return endpoint, child_scope.get("path_params", {})
+            return None, None
+    return None, None
+
+
+def _response_key(request: Request, body: bytes, generation: int) -> str:
+    mode = "sandbox" if is_sandbox_mode() else "prod"
+    digest = hashlib.sha1(f"{_normalized_query(request)}\n".encode("utf-8") + body).hexdigest()
+    return f"resp:{mode}:g{generation}:{request.method}:{request.url.path}:{digest}"
+
+
+# Cabeçalhos da rota que fazem parte da resposta e são guardados com o corpo
+_STORED_HEADERS = ("x-next-cursor",)
+
+
+def _read_stored(key: str, want_gzip: bool):
+    """
+    Lê a resposta armazenada (L1 e depois Redis). Retorna `(corpo, gzip?,
+    cabeçalhos)` ou `(None, False, {})`.
+    """
+    entry = local_cache.get(key)
+    if entry is _MISS:
+        plain, gzipped, headers = redis_client.mget([key, f"{key}:gz", f"{key}:h"])
+        if plain is None:
+            return None, False, {}
+        entry = (plain, gzipped, json.loads(headers) if headers else {})
+        local_cache.set(key, entry)
+    plain, gzipped, headers = entry
+    if want_gzip and gzipped is not None:
+        return gzipped, True, headers
+    return plain, False, headers
+
+
+def _store(key: str, body: bytes, ttl: int, headers: dict = None):
+    gzipped = gzip.compress(body, compresslevel=6) if len(body) >= settings.HTTP_RESPONSE_CACHE_GZIP_MIN_BYTES else None
+    local_cache.set(key, (body, gzipped, headers or {}), ttl)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.set(key, body, ex=ttl)
+    if gzipped is not None:
+        pipe.set(f"{key}:gz", gzipped, ex=ttl)
+    if headers:
+        pipe.set(f"{key}:h", json.dumps(headers), ex=ttl)
+    pipe.execute()
+
+
+async def response_cache(request: Request, call_next):
+    """
+    Middleware do cache de resposta para as rotas marcadas com `cached_response`.
+
+    A chave combina a geração de dados, o método, o caminho, a query
+    normalizada e o corpo da requisição. Em um hit os bytes armazenados são
+    devolvidos diretamente (em gzip, se o cliente aceitar); em um miss a
+    resposta 200 da rota é gravada no L1 e no Redis.
+    """
+    if request.method not in ("GET", "POST"):
+        return await call_next(request)
+    endpoint, path_params = _match_cached_route(request)
+    if endpoint is None:
+        return await call_next(request)
+
+    generation, _ = await run_in_threadpool(get_generation_state)
+    if generation is None:
+        return await call_next(request)
+    body = await request.body()
+    key = _response_key(request, body, generation)
+    want_gzip = "gzip" in request.headers.get("accept-encoding", "")
+
+    try:
+        stored, is_gzip, stored_headers = await run_in_threadpool(_read_stored, key, want_gzip)
+    except Exception as e:
+        logger.warning(f"Erro ao ler cache de resposta: {e}")
+        stored, is_gzip, stored_headers = None, False, {}
+
+    if stored is not None:
+        if endpoint._response_cache_popularity and "codigo" in path_params:
+            await run_in_threadpool(track_popularity, endpoint._response_cache_popularity, int(path_params["codigo"]))
+        headers = {**stored_headers, "X-Cache": "HIT", "Vary": "Accept-Encoding"}
+        if is_gzip:
+            headers["Content-Encoding"] = "gzip"
+        return Response(content=stored, media_type="application/json", headers=headers)
+
+    response = await call_next(request)
+    # HIT e MISS de uma rota cacheada variam com o Accept-Encoding (variante gzip)
+    response.headers["Vary"] = "Accept-Encoding"
+    if response.status_code != 200 or response.headers.get("content-encoding"):
+        return response
+
+    content = b"".join([chunk async for chunk in response.body_iterator])
+    kept_headers = {name: response.headers[name] for name in _STORED_HEADERS if name in response.headers}
+    try:
+        await run_in_threadpool(_store, key, content, endpoint._response_cache_ttl, kept_headers)
+    except Exception as e:
+        logger.warning(f"Erro ao salvar cache de resposta: {e}")
+    headers = dict(response.headers)
+    headers.pop("content-length", None)
+    headers["X-Cache"] = "MISS"
+    return Response(content=content, status_code=200, headers=headers, media_type=response.media_type)
+
+
+def purge_gateway_cache(uf: str = None, data_referencia: str = None) -> bool:
+    """
+    Esvazia o cache de resposta do Kong após uma carga de dados.
+
+    As chaves do plugin proxy-cache são hashes opacos da requisição, então não
+    é possível remover apenas as respostas da UF/mês carregados: o cache do
+    gateway é esvaziado por inteiro (`DELETE /proxy-cache` na Admin API) e se
+    repopula com as leituras seguintes. Os argumentos só identificam a carga
+    nos logs. Retorna `True` se o Kong confirmou a limpeza.
+    """
+    if not settings.KONG_ADMIN_URL:
+        return False
+    url = f"{settings.KONG_ADMIN_URL.rstrip('/')}/proxy-cache"
+    request = urllib.request.Request(url, method="DELETE")
+    try:
+        with urllib.request.urlopen(request, timeout=settings.KONG_PURGE_TIMEOUT) as response:
+            purged = response.status in (200, 204)
+    except Exception as e:
+        logger.warning(f"Erro ao esvaziar o cache do gateway ({url}): {e}")
+        return False
+    logger.info(f"Cache do gateway esvaziado após carga de {uf or '*'} {data_referencia or '*'}")
+    return purged
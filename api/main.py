@@ -11,11 +11,10 @@ import os
 import json
 import time
 import logging
-import redis
 from celery.result import AsyncResult
 from .sandbox_utils import is_sandbox_mode
-from typing import List, Optional
-from fastapi import FastAPI, Depends, HTTPException, Query, Body, Path, Request
+from typing import List, Optional, Union
+from fastapi import FastAPI, Depends, HTTPException, Query, Body, Path, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
@@ -24,10 +23,14 @@ from sqlalchemy.orm import Session
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 
-from . import crud, schemas, config
+from . import crud, schemas, config, http_cache
+from . import graph as composition_graph
+from .pagination import NEXT_CURSOR_HEADER, next_cursor
 from .database import get_db
-from .tasks import populate_sinapi_task
-from .cache_utils import redis_client as cache_redis
+from .tasks import populate_sinapi_task, rollup_custos_task
+from .maintenance import MACRORREGIOES
+from .redis_pool import get_redis_client
+from .cache_utils import redis_client as cache_redis, get_cache_stats, get_namespace_stats, purge_namespace, track_popularity
 
 # Carrega as configurações uma vez
 settings = config.settings
@@ -64,12 +67,19 @@ app = FastAPI(
     version="1.0.0",
 )
 
+# Cache de resposta (rotas com @http_cache.cached_response) e requisições condicionais
+# (ETag/304) nos GETs públicos. Registrados antes do CORS para que as respostas servidas
+# por eles também recebam os cabeçalhos de CORS; o 304 é avaliado antes do cache de resposta.
+app.middleware("http")(http_cache.response_cache)
+app.middleware("http")(http_cache.conditional_requests)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=settings.ALLOWED_ORIGINS.split(",") if settings.ALLOWED_ORIGINS != "*" else ["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 # Serve static GeoJSON data
@@ -112,8 +122,8 @@ def health_check(db: Session = Depends(get_db)):
     status_code = 200 if checks["status"] == "healthy" else 503
     return JSONResponse(content=checks, status_code=status_code)
 
-# Conexão direta com Redis para lock de tarefas (idempotência)
-redis_client = redis.Redis(host=os.getenv("REDIS_HOST", "redis"), port=6379, db=0)
+# Conexão com Redis para lock de tarefas (idempotência), sobre o pool compartilhado
+redis_client = get_redis_client()
 
 @app.get("/api/v1/public/stats", tags=["Public"])
 def get_database_stats(db: Session = Depends(get_db)):
@@ -123,6 +133,7 @@ def get_database_stats(db: Session = Depends(get_db)):
     return crud.get_global_stats(db)
 
 @app.get("/api/v1/public/filters", tags=["Public"])
+@http_cache.cached_response()
 def get_filters(
     tipo: str = Query(None, description="Filtrar por tipo: 'insumo' (retorna classificacoes) ou 'composicao' (retorna grupos)."),
     db: Session = Depends(get_db)
@@ -131,11 +142,12 @@ def get_filters(
     Retorna os filtros dinâmicos disponíveis no banco.
     Opcionalmente filtra por tipo para retornar classificações ou grupos.
     """
+    # O resultado vem do cache L1 compartilhado: monta um novo dict em vez de alterá-lo
     result = crud.get_available_filters(db)
     if tipo == 'insumo':
-        result.pop('grupos', None)
+        return {k: v for k, v in result.items() if k != 'grupos'}
     elif tipo == 'composicao':
-        result.pop('classificacoes', None)
+        return {k: v for k, v in result.items() if k != 'classificacoes'}
     return result
 
 # --- Endpoints de Administração ---
@@ -196,6 +208,80 @@ def get_task_status(task_id: str):
         "result": str(result.result) if result.ready() else None
     }
 
+@app.get("/api/v1/admin/cache/stats", tags=["Admin"])
+def read_cache_stats():
+    """
+    Retorna os contadores de cache por função deste worker: hits no L1 e no
+    Redis, misses, taxa de acerto, tempo médio de cálculo e tamanho médio do payload.
+    """
+    return {"pid": os.getpid(), "functions": get_cache_stats()}
+
+@app.get("/api/v1/admin/graph", tags=["Admin"])
+def read_graph_diagnostics(db: Session = Depends(get_db)):
+    """
+    Diagnóstico do grafo de composições em memória deste worker: tamanho,
+    profundidade máxima e composições em ciclo ou acima de `BOM_MAX_DEPTH` níveis.
+    """
+    return {"pid": os.getpid(), **composition_graph.get_graph(db).diagnostics()}
+
+@app.get("/api/v1/admin/cache/namespaces", tags=["Admin"])
+def read_cache_namespaces():
+    """
+    Retorna, por namespace de cache, o número de chaves e os bytes ocupados no
+    Redis, o orçamento configurado e os contadores deste worker (taxa de acerto,
+    chaves admitidas/rejeitadas pelo filtro de admissão e despejadas).
+    """
+    return {"pid": os.getpid(), "namespaces": get_namespace_stats()}
+
+@app.delete("/api/v1/admin/cache/namespaces/{namespace}", tags=["Admin"])
+def delete_cache_namespace(namespace: str):
+    """
+    Esvazia um namespace de cache sem SCAN: incrementa a geração do namespace e
+    remove as chaves registradas no seu índice.
+    """
+    try:
+        deleted = purge_namespace(namespace)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Namespace de cache '{namespace}' não encontrado.")
+    return {"namespace": namespace, "deleted": deleted}
+
+@app.post("/api/v1/admin/rollup", status_code=202, tags=["Admin"])
+def trigger_cost_rollup(
+    uf: str = Body(..., example="SP", min_length=2, max_length=2),
+    data_referencia: str = Body(..., example="2025-09", description="Data de referência no formato AAAA-MM."),
+    regime: str = Body("NAO_DESONERADO", example="NAO_DESONERADO")
+):
+    """
+    Dispara o roll-up de custos de todas as composições de (UF, mês, regime),
+    comparando o custo recalculado com o oficial. Roda em segundo plano.
+    """
+    try:
+        datetime.strptime(data_referencia, "%Y-%m")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="data_referencia deve estar no formato AAAA-MM.")
+    try:
+        task = rollup_custos_task.delay(uf.upper(), data_referencia, regime.upper())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Falha ao enfileirar tarefa: {str(e)}")
+    return {
+        "message": "Roll-up de custos iniciado com sucesso.",
+        "task_id": task.id,
+        "sandbox": is_sandbox_mode()
+    }
+
+@app.get("/api/v1/admin/rollup/divergencias", tags=["Admin"])
+def read_rollup_divergences(
+    uf: str = Query(..., min_length=2, max_length=2),
+    data_referencia: str = Query(..., description="Data de referência no formato AAAA-MM. Ex: 2025-09"),
+    regime: str = Query("NAO_DESONERADO", description="Regime de custo."),
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_db)
+):
+    """
+    Lista as composições cujo custo recalculado no último roll-up da fatia
+    diverge do custo oficial além de `ROLLUP_TOLERANCE`.
+    """
+    return crud.get_rollup_divergencias(db, uf=uf, data_referencia=data_referencia, regime=regime, limit=limit)
 
 
 @app.get("/", tags=["Root"])
@@ -221,20 +307,58 @@ def read_insumo_by_codigo(
         raise HTTPException(status_code=404, detail="Insumo não encontrado para os filtros especificados.")
     return db_insumo
 
-@app.get("/api/v1/public/insumos", response_model=List[schemas.Insumo], tags=["Insumos"])
+@app.post("/api/v1/public/insumos/lote", response_model=schemas.InsumosEmLote, tags=["Insumos"])
+def read_insumos_by_codigos(
+    codigos: List[int] = Body(..., description="Lista de códigos de insumos.", example=[88316, 370]),
+    uf: str = Query(..., description="Unidade Federativa (UF). Ex: SP", min_length=2, max_length=2),
+    data_referencia: str = Query(..., description="Data de referência no formato AAAA-MM. Ex: 2025-09"),
+    regime: str = Query("NAO_DESONERADO", description="Regime de preço."),
+    db: Session = Depends(get_db)
+):
+    """
+    Obtém vários insumos e seus preços para um mesmo contexto em uma única
+    requisição. Os códigos não encontrados são listados em `nao_encontrados`.
+    """
+    if len(codigos) > settings.BULK_MAX_CODES:
+        raise HTTPException(status_code=400, detail=f"Máximo de {settings.BULK_MAX_CODES} códigos por requisição.")
+    resultado = crud.get_insumos_by_codigos(db, codigos=codigos, uf=uf, data_referencia=data_referencia, regime=regime)
+    return {
+        "itens": {codigo: item for codigo, item in resultado.items() if item is not None},
+        "nao_encontrados": [codigo for codigo, item in resultado.items() if item is None],
+    }
+
+@app.get("/api/v1/public/insumos", response_model=Union[List[schemas.Insumo], schemas.BuscaInsumos], tags=["Insumos"])
+@http_cache.cached_response()
 def search_insumos(
+    response: Response,
     q: str = Query(..., min_length=3, description="Termo para buscar na descrição do insumo."),
     uf: str = Query(..., description="Unidade Federativa (UF). Ex: SP", min_length=2, max_length=2),
     data_referencia: str = Query(..., description="Data de referência no formato AAAA-MM. Ex: 2025-09"),
     regime: str = Query("NAO_DESONERADO", description="Regime de preço."),
     classificacao: str = Query(None, description="Filtrar por classificação do insumo. Ex: AGREGADOS, ACO, CONCRETO"),
-    skip: int = 0, limit: int = 100, db: Session = Depends(get_db)
+    skip: int = 0, limit: int = 100,
+    cursor: Optional[str] = Query(None, description="Paginação por cursor: vazio na primeira página, depois o valor do cabeçalho X-Next-Cursor."),
+    facetas: bool = Query(False, description="Inclui as contagens por categoria, unidade e faixa de preço do conjunto encontrado."),
+    db: Session = Depends(get_db)
 ):
     """
     Busca insumos pela descrição e retorna seus preços para um determinado contexto.
-    Opcionalmente filtra por classificação.
+    Opcionalmente filtra por classificação. A busca ignora acentos e ordena
+    os resultados pela `relevancia` (similaridade com o termo). Com `cursor`,
+    pagina por chave em ordem de descrição, com custo constante por página.
+    Com `facetas=true`, a resposta traz `itens` e as `facetas` da busca.
     """
-    insumos = crud.search_insumos_by_descricao(db, q=q, uf=uf, data_referencia=data_referencia, regime=regime, skip=skip, limit=limit, classificacao=classificacao)
+    try:
+        insumos = crud.search_insumos_by_descricao(db, q=q, uf=uf, data_referencia=data_referencia, regime=regime, skip=skip, limit=limit, classificacao=classificacao, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if cursor is not None:
+        proximo = next_cursor(insumos, limit, "descricao", "codigo")
+        if proximo:
+            response.headers[NEXT_CURSOR_HEADER] = proximo
+    if facetas:
+        contagens = crud.get_insumo_search_facets(db, q=q, uf=uf, data_referencia=data_referencia, regime=regime, classificacao=classificacao)
+        return {"itens": insumos, "facetas": contagens}
     return insumos
 
 
@@ -251,31 +375,71 @@ def read_composicao_by_codigo(
     """
     Obtém uma composição específica e seu custo para um determinado contexto.
     """
+    track_popularity("composicao", codigo)
     db_composicao = crud.get_composicao_by_codigo(db, codigo=codigo, uf=uf, data_referencia=data_referencia, regime=regime)
     if db_composicao is None:
         raise HTTPException(status_code=404, detail="Composição não encontrada para os filtros especificados.")
     return db_composicao
 
-@app.get("/api/v1/public/composicoes", response_model=List[schemas.Composicao], tags=["Composições"])
+@app.post("/api/v1/public/composicoes/lote", response_model=schemas.ComposicoesEmLote, tags=["Composições"])
+def read_composicoes_by_codigos(
+    codigos: List[int] = Body(..., description="Lista de códigos de composições.", example=[92711, 88307]),
+    uf: str = Query(..., description="Unidade Federativa (UF). Ex: SP", min_length=2, max_length=2),
+    data_referencia: str = Query(..., description="Data de referência no formato AAAA-MM. Ex: 2025-09"),
+    regime: str = Query("NAO_DESONERADO", description="Regime de custo."),
+    db: Session = Depends(get_db)
+):
+    """
+    Obtém várias composições e seus custos para um mesmo contexto em uma única
+    requisição. Os códigos não encontrados são listados em `nao_encontrados`.
+    """
+    if len(codigos) > settings.BULK_MAX_CODES:
+        raise HTTPException(status_code=400, detail=f"Máximo de {settings.BULK_MAX_CODES} códigos por requisição.")
+    resultado = crud.get_composicoes_by_codigos(db, codigos=codigos, uf=uf, data_referencia=data_referencia, regime=regime)
+    return {
+        "itens": {codigo: item for codigo, item in resultado.items() if item is not None},
+        "nao_encontrados": [codigo for codigo, item in resultado.items() if item is None],
+    }
+
+@app.get("/api/v1/public/composicoes", response_model=Union[List[schemas.Composicao], schemas.BuscaComposicoes], tags=["Composições"])
+@http_cache.cached_response()
 def search_composicoes(
+    response: Response,
     q: str = Query(..., min_length=3, description="Termo para buscar na descrição da composição."),
     uf: str = Query(..., description="Unidade Federativa (UF). Ex: SP", min_length=2, max_length=2),
     data_referencia: str = Query(..., description="Data de referência no formato AAAA-MM. Ex: 2025-09"),
     regime: str = Query("NAO_DESONERADO", description="Regime de custo."),
     grupo: str = Query(None, description="Filtrar por grupo da composição. Ex: SERVICOS, ESTRUTURA, INSTALACOES"),
-    skip: int = 0, limit: int = 100, db: Session = Depends(get_db)
+    skip: int = 0, limit: int = 100,
+    cursor: Optional[str] = Query(None, description="Paginação por cursor: vazio na primeira página, depois o valor do cabeçalho X-Next-Cursor."),
+    facetas: bool = Query(False, description="Inclui as contagens por categoria, unidade e faixa de preço do conjunto encontrado."),
+    db: Session = Depends(get_db)
 ):
     """
     Busca composições pela descrição e retorna seus custos para um determinado contexto.
-    Opcionalmente filtra por grupo.
+    Opcionalmente filtra por grupo. A busca ignora acentos e ordena os
+    resultados pela `relevancia` (similaridade com o termo). Com `cursor`,
+    pagina por chave em ordem de descrição, com custo constante por página.
+    Com `facetas=true`, a resposta traz `itens` e as `facetas` da busca.
     """
-    composicoes = crud.search_composicoes_by_descricao(db, q=q, uf=uf, data_referencia=data_referencia, regime=regime, skip=skip, limit=limit, grupo=grupo)
+    try:
+        composicoes = crud.search_composicoes_by_descricao(db, q=q, uf=uf, data_referencia=data_referencia, regime=regime, skip=skip, limit=limit, grupo=grupo, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if cursor is not None:
+        proximo = next_cursor(composicoes, limit, "descricao", "codigo")
+        if proximo:
+            response.headers[NEXT_CURSOR_HEADER] = proximo
+    if facetas:
+        contagens = crud.get_composicao_search_facets(db, q=q, uf=uf, data_referencia=data_referencia, regime=regime, grupo=grupo)
+        return {"itens": composicoes, "facetas": contagens}
     return composicoes
 
 
 # --- Endpoints de Business Intelligence (BI) ---
 
 @app.get("/api/v1/public/bi/composicao/{codigo}/bom", response_model=List[schemas.ComposicaoBOMItem], tags=["Business Intelligence"])
+@http_cache.cached_response(popularity="composicao")
 def get_composition_bom(
     codigo: int,
     uf: str = Query(..., description="Unidade Federativa (UF). Ex: SP", min_length=2, max_length=2),
@@ -287,6 +451,7 @@ def get_composition_bom(
     Retorna o Bill of Materials (BOM) completo de uma composição,
     explodindo todos os níveis e calculando o impacto de custo de cada item.
     """
+    track_popularity("composicao", codigo)
     bom_items = crud.get_composicao_bom(db, codigo=codigo, uf=uf, data_referencia=data_referencia, regime=regime)
     if not bom_items:
         raise HTTPException(status_code=404, detail="Composição não encontrada ou sem estrutura para os filtros especificados.")
@@ -298,6 +463,7 @@ def get_composition_man_hours(codigo: int, db: Session = Depends(get_db)):
     Calcula o total de Hora/Homem para uma composição, somando os coeficientes
     de todos os insumos de mão de obra (unidade 'H') em todos os níveis.
     """
+    track_popularity("composicao", codigo)
     result = crud.get_composicao_man_hours(db, codigo=codigo)
     total_hh = 0.0
     if result is not None:
@@ -308,6 +474,7 @@ def get_composition_man_hours(codigo: int, db: Session = Depends(get_db)):
     return schemas.ComposicaoManHours(total_hora_homem=total_hh)
 
 @app.post("/api/v1/public/bi/curva-abc", response_model=List[schemas.CurvaABCItem], tags=["Business Intelligence"])
+@http_cache.cached_response()
 def get_abc_curve(
     codigos: List[int] = Body(..., description="Lista de códigos de composições a serem analisadas.", example=[92711, 88307]),
     uf: str = Query(..., description="Unidade Federativa (UF). Ex: SP", min_length=2, max_length=2),
@@ -325,6 +492,7 @@ def get_abc_curve(
     return abc_curve
 
 @app.get("/api/v1/public/bi/composicao/{codigo}/otimizar", response_model=List[schemas.ComposicaoBOMItem], tags=["Business Intelligence"])
+@http_cache.cached_response(popularity="composicao")
 def get_optimization_candidates(
     codigo: int,
     uf: str = Query(..., description="Unidade Federativa (UF). Ex: SP", min_length=2, max_length=2),
@@ -336,6 +504,7 @@ def get_optimization_candidates(
     """
     Retorna os N insumos de maior impacto financeiro em uma composição (Curva ABC - Foco).
     """
+    track_popularity("composicao", codigo)
     candidates = crud.get_candidatos_otimizacao(db, codigo=codigo, uf=uf, data_referencia=data_referencia, regime=regime, top_n=top_n)
     if not candidates:
         raise HTTPException(status_code=404, detail="Não foi possível calcular os candidatos para otimização.")
@@ -392,23 +561,34 @@ def get_item_maintenance_history(
 
 @app.get("/api/v1/public/bi/audit/{tipo_item}/{codigo}", response_model=List[schemas.AuditEvent], tags=["Business Intelligence"])
 def get_audit_trail(
+    response: Response,
     tipo_item: str = Path(..., description="Tipo do item: 'insumo' ou 'composicao'"),
     codigo: int = Path(..., description="Código do item."),
     data_referencia: str = Query(None, description="Filtrar por data de referência (AAAA-MM)."),
+    limit: int = Query(100, ge=1, le=1000, description="Eventos por página."),
+    cursor: Optional[str] = Query(None, description="Paginação por cursor: o valor do cabeçalho X-Next-Cursor da página anterior."),
     db: Session = Depends(get_db)
 ):
     """
-    Retorna o histórico completo de auditoria para um item.
+    Retorna o histórico completo de auditoria para um item, do evento mais recente para o mais antigo.
     Inclui retificações de preços, mudanças de status e modificações de estrutura.
+    Quando há mais eventos, o cabeçalho X-Next-Cursor traz o cursor da próxima página.
     """
     if tipo_item not in ['insumo', 'composicao']:
         raise HTTPException(status_code=400, detail="Tipo de item inválido. Use 'insumo' ou 'composicao'.")
-    audit_events = crud.get_audit_events(db, tipo_item=tipo_item, codigo=codigo, data_referencia=data_referencia)
-    if not audit_events:
+    try:
+        audit_events = crud.get_audit_events(db, tipo_item=tipo_item, codigo=codigo, data_referencia=data_referencia, limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not audit_events and not cursor:
         raise HTTPException(status_code=404, detail="Nenhum evento de auditoria encontrado para este item.")
+    proximo = next_cursor(audit_events, limit, "created_at", "id")
+    if proximo:
+        response.headers[NEXT_CURSOR_HEADER] = proximo
     return audit_events
 
 @app.post("/api/v1/public/bi/curva-abc/por-classificacao", response_model=List[schemas.AbcPorClassificacao], tags=["Business Intelligence"])
+@http_cache.cached_response()
 def get_abc_by_classificacao(
     codigos: List[int] = Body(..., description="Lista de códigos de composições a serem analisadas.", example=[92711, 88307]),
     uf: str = Query(..., description="Unidade Federativa (UF). Ex: SP", min_length=2, max_length=2),
@@ -427,6 +607,7 @@ def get_abc_by_classificacao(
     return result
 
 @app.get("/api/v1/public/bi/tendencias/por-classificacao", response_model=List[schemas.TendenciaClassificacao], tags=["Business Intelligence"])
+@http_cache.cached_response()
 def get_tendencias_classificacao(
     uf: str = Query(..., description="Unidade Federativa (UF). Ex: SP", min_length=2, max_length=2),
     data_referencia: str = Query(..., description="Data de referência final no formato AAAA-MM. Ex: 2025-09"),
@@ -452,7 +633,46 @@ def get_tendencias_classificacao(
         raise HTTPException(status_code=404, detail="Nenhum dado de tendência encontrado para os filtros especificados.")
     return result
 
+@app.get("/api/v1/public/bi/tendencias/drill-down", response_model=schemas.DrillDownPrecos, tags=["Business Intelligence"])
+@http_cache.cached_response()
+def get_tendencias_drill_down(
+    tipo_item: str = Query("insumo", description="Tipo do item: 'insumo' (por classificação) ou 'composicao' (por grupo)."),
+    data_referencia: str = Query(..., description="Data de referência final no formato AAAA-MM. Ex: 2025-09"),
+    regime: str = Query("NAO_DESONERADO", description="Regime de preço."),
+    nivel: str = Query("brasil", description="Nível consultado: 'brasil', 'regiao' ou 'uf'."),
+    local: Optional[str] = Query(None, description="Macrorregião (ex: SUDESTE) ou UF (ex: SP); não usado no nível 'brasil'."),
+    categoria: Optional[str] = Query(None, description="Filtrar por uma classificação/grupo."),
+    meses: int = Query(0, ge=0, description="Número de meses anteriores incluídos na série."),
+    db: Session = Depends(get_db)
+):
+    """
+    Detalhamento regional dos preços a partir do cubo pré-agregado: média,
+    mediana, mínimo, máximo e contagens do nível consultado e dos seus filhos
+    (Brasil -> macrorregiões -> UFs), por classificação/grupo e mês.
+    """
+    if tipo_item not in ['insumo', 'composicao']:
+        raise HTTPException(status_code=400, detail="Tipo de item inválido. Use 'insumo' ou 'composicao'.")
+    nivel = nivel.lower()
+    if nivel not in ['brasil', 'regiao', 'uf']:
+        raise HTTPException(status_code=400, detail="Nível inválido. Use 'brasil', 'regiao' ou 'uf'.")
+    if nivel == 'regiao' and (local or '').upper() not in MACRORREGIOES:
+        raise HTTPException(status_code=400, detail=f"Macrorregião inválida. Use uma de: {', '.join(MACRORREGIOES)}.")
+    if nivel == 'uf' and not any((local or '').upper() in ufs for ufs in MACRORREGIOES.values()):
+        raise HTTPException(status_code=400, detail="UF inválida.")
+    try:
+        datetime.strptime(data_referencia, "%Y-%m")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="data_referencia deve estar no formato AAAA-MM.")
+    result = crud.get_cubo_drilldown(
+        db, tipo_item=tipo_item, data_referencia=data_referencia, regime=regime,
+        nivel=nivel, local=local, categoria=categoria, meses=meses
+    )
+    if not result["agregado"]:
+        raise HTTPException(status_code=404, detail="Nenhum dado agregado encontrado para os filtros especificados.")
+    return result
+
 @app.get("/api/v1/public/bi/item/{tipo_item}/{codigo}/precos-uf", response_model=List[schemas.PrecoPorUF], tags=["Business Intelligence"])
+@http_cache.cached_response()
 def get_item_prices_all_ufs(
     tipo_item: str = Path(..., description="Tipo do item: 'insumo' ou 'composicao'"),
     codigo: int = Path(..., description="Código do item."),
@@ -483,12 +703,14 @@ def get_composition_productivity(
     Classifica os itens do BOM de uma composição em Mão de Obra, Material e Equipamento,
     retornando o total de Horas-Homem e o custo por HH como métrica de produtividade.
     """
+    track_popularity("composicao", codigo)
     result = crud.get_composicao_produtividade(db, codigo=codigo, uf=uf, data_referencia=data_referencia, regime=regime)
     if not result:
         raise HTTPException(status_code=404, detail="Não foi possível calcular a produtividade para esta composição.")
     return result
 
 @app.get("/api/v1/public/bi/insumo/{codigo}/onde-usado", response_model=List[schemas.InsumoOndeUsado], tags=["Business Intelligence"])
+@http_cache.cached_response()
 def get_insumo_where_used(
     codigo: int,
     tipo_item: str = Query("insumo", description="Tipo do item: 'insumo' ou 'composicao'"),
@@ -504,3 +726,26 @@ def get_insumo_where_used(
     if not result:
         raise HTTPException(status_code=404, detail="Nenhuma composição encontrada que utilize este item.")
     return result
+
+@app.post("/api/v1/public/bi/simulacao/precos", response_model=List[schemas.ImpactoComposicao], tags=["Business Intelligence"])
+def simulate_price_changes(
+    alteracoes: List[schemas.AlteracaoPreco] = Body(..., description="Insumos alterados, com variação percentual ou novo preço.", example=[{"codigo": 88316, "variacao_percentual": 10}]),
+    uf: str = Query(..., description="Unidade Federativa (UF). Ex: SP", min_length=2, max_length=2),
+    data_referencia: str = Query(..., description="Data de referência no formato AAAA-MM. Ex: 2025-09"),
+    regime: str = Query("NAO_DESONERADO", description="Regime de preço."),
+    db: Session = Depends(get_db)
+):
+    """
+    Simulação "e se": aplica alterações de preço a insumos e retorna as
+    composições afetadas (em qualquer nível) com o custo atual e o simulado.
+    """
+    if len(alteracoes) > settings.SIMULATION_MAX_ALTERACOES:
+        raise HTTPException(status_code=400, detail=f"Máximo de {settings.SIMULATION_MAX_ALTERACOES} insumos por simulação.")
+    if any(a.variacao_percentual is None and a.preco is None for a in alteracoes):
+        raise HTTPException(status_code=400, detail="Informe 'variacao_percentual' ou 'preco' para cada insumo.")
+    result = crud.simulate_price_changes(
+        db, alteracoes=[a.model_dump() for a in alteracoes], uf=uf, data_referencia=data_referencia, regime=regime
+    )
+    if not result:
+        raise HTTPException(status_code=404, detail="Nenhuma composição afetada pelas alterações informadas.")
+    return result
@@ -0,0 +1,248 @@
+# api/maintenance.py
+"""
+Rotinas de manutenção das estruturas derivadas do banco, executadas após cada
+carga de ETL (ver `tasks.populate_sinapi_task`).
+
+- `rebuild_composicao_fechamento`: mantém o fechamento transitivo da estrutura
+  das composições (`composicao_fechamento`), lido pelas funções de BI de
+  `crud` no lugar das antigas consultas `WITH RECURSIVE`. A reconstrução é
+  incremental: só as composições cujos itens diretos mudaram (e as que as
+  contêm, em qualquer nível) são recalculadas.
+- `ensure_month_partitions`: cria, antes da carga, as partições mensais das
+  tabelas de preços e custos (particionadas por `data_referencia` na migração
+  008); `detach_month_partitions` retira um mês inteiro sem `DELETE` em massa.
+- `refresh_cubo_precos`: recalcula o cubo pré-agregado de preços
+  (`cubo_precos_mensal`: categoria x UF/macrorregião/Brasil x mês x regime),
+  lido pelas tendências e pelo detalhamento regional de `crud`.
+"""
+
+import time
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from .config import settings
+from .sandbox_utils import is_sandbox_mode, get_sandbox_table_name
+
+logger = logging.getLogger(__name__)
+
+# Assinatura dos itens diretos de uma composição: muda se um item entra, sai ou tem o coeficiente alterado
+_SIGNATURE_SQL = """
+    md5(string_agg(tipo_item || ':' || item_codigo || ':' || COALESCE(coeficiente::text, ''),
+                   ',' ORDER BY tipo_item, item_codigo))
+"""
+
+
+# Macrorregiões do IBGE: nível intermediário do cubo de preços, entre UF e Brasil
+MACRORREGIOES = {
+    "NORTE": ("AC", "AP", "AM", "PA", "RO", "RR", "TO"),
+    "NORDESTE": ("AL", "BA", "CE", "MA", "PB", "PE", "PI", "RN", "SE"),
+    "CENTRO_OESTE": ("DF", "GO", "MT", "MS"),
+    "SUDESTE": ("ES", "MG", "RJ", "SP"),
+    "SUL": ("PR", "RS", "SC"),
+}
+
+
+def ensure_sandbox_tables(db: Session, *base_names: str) -> None:
+    """
+    Cria, no modo sandbox, as cópias (`sandbox_<tabela>`) das tabelas derivadas
+    informadas. As tabelas de produção vêm das migrações do alembic.
+    """
+    if not is_sandbox_mode():
+        return
+    for base in base_names:
+        db.execute(text(f"CREATE TABLE IF NOT EXISTS {get_sandbox_table_name(base)} (LIKE {base} INCLUDING ALL)"))
+
+
+def _changed_composicoes(db: Session) -> list:
+    """Composições cuja assinatura atual difere da registrada (novas e removidas inclusive)."""
+    query = text(f"""
+        WITH atual AS (
+            SELECT composicao_pai_codigo AS composicao_codigo, {_SIGNATURE_SQL} AS assinatura
+            FROM {settings.VIEW_COMPOSICAO_ITENS}
+            GROUP BY composicao_pai_codigo
+        )
+        SELECT COALESCE(a.composicao_codigo, e.composicao_codigo)
+        FROM atual a
+        FULL OUTER JOIN {settings.TABLE_COMPOSICAO_FECHAMENTO_ESTADO} e ON e.composicao_codigo = a.composicao_codigo
+        WHERE a.assinatura IS DISTINCT FROM e.assinatura
+    """)
+    return db.execute(query).scalars().all()
+
+
+def rebuild_composicao_fechamento(db: Session, full: bool = False) -> dict:
+    """
+    Atualiza o fechamento transitivo da estrutura das composições.
+
+    Detecta as composições alteradas comparando a assinatura dos seus itens
+    diretos com a da última reconstrução, soma a elas seus ancestrais (pelo
+    próprio fechamento) e recalcula só esse conjunto. Com `full=True`, ou na
+    primeira execução, recalcula tudo. Retorna um resumo da execução.
+    """
+    start = time.perf_counter()
+    ensure_sandbox_tables(db, "composicao_fechamento", "composicao_fechamento_estado")
+    table = settings.TABLE_COMPOSICAO_FECHAMENTO
+    state_table = settings.TABLE_COMPOSICAO_FECHAMENTO_ESTADO
+
+    if full:
+        db.execute(text(f"TRUNCATE {table}, {state_table}"))
+    changed = _changed_composicoes(db)
+    if not changed:
+        db.commit()
+        logger.info("Fechamento da estrutura de composições já atualizado.")
+        return {"alteradas": 0, "recalculadas": 0, "linhas": 0, "segundos": round(time.perf_counter() - start, 2)}
+
+    ancestors = db.execute(text(f"""
+        SELECT DISTINCT composicao_codigo FROM {table}
+        WHERE tipo_item = 'COMPOSICAO' AND item_codigo = ANY(:codigos)
+    """), {"codigos": list(changed)}).scalars().all()
+    affected = sorted(set(changed) | set(ancestors))
+
+    db.execute(text(f"DELETE FROM {table} WHERE composicao_codigo = ANY(:codigos)"), {"codigos": affected})
+    inserted = db.execute(text(f"""
+        INSERT INTO {table} (composicao_codigo, tipo_item, item_codigo, coeficiente_total, nivel_min)
+        WITH RECURSIVE fechamento (composicao_codigo, item_codigo, tipo_item, coeficiente_total, nivel) AS (
+            SELECT composicao_pai_codigo, item_codigo, tipo_item, CAST(coeficiente AS numeric), 1
+            FROM {settings.VIEW_COMPOSICAO_ITENS}
+            WHERE composicao_pai_codigo = ANY(:codigos)
+            UNION ALL
+            SELECT f.composicao_codigo, v.item_codigo, v.tipo_item, f.coeficiente_total * v.coeficiente, f.nivel + 1
+            FROM {settings.VIEW_COMPOSICAO_ITENS} v
+            JOIN fechamento f ON v.composicao_pai_codigo = f.item_codigo
+            WHERE f.tipo_item = 'COMPOSICAO' AND f.nivel < :max_depth
+        )
+        SELECT composicao_codigo, tipo_item, item_codigo, SUM(coeficiente_total), MIN(nivel)
+        FROM fechamento
+        GROUP BY composicao_codigo, tipo_item, item_codigo
+    """), {"codigos": affected, "max_depth": settings.BOM_MAX_DEPTH}).rowcount
+
+    db.execute(text(f"DELETE FROM {state_table} WHERE composicao_codigo = ANY(:codigos)"), {"codigos": list(changed)})
+    db.execute(text(f"""
+        INSERT INTO {state_table} (composicao_codigo, assinatura)
+        SELECT composicao_pai_codigo, {_SIGNATURE_SQL}
+        FROM {settings.VIEW_COMPOSICAO_ITENS}
+        WHERE composicao_pai_codigo = ANY(:codigos)
+        GROUP BY composicao_pai_codigo
+    """), {"codigos": list(changed)})
+    db.commit()
+
+    summary = {
+        "alteradas": len(changed),
+        "recalculadas": len(affected),
+        "linhas": inserted,
+        "segundos": round(time.perf_counter() - start, 2),
+    }
+    logger.info(f"Fechamento da estrutura de composições atualizado: {summary}")
+    return summary
+
+
+def _partitioned_tables() -> tuple:
+    return settings.TABLE_PRECOS_INSUMOS, settings.TABLE_CUSTOS_COMPOSICOES
+
+
+def ensure_month_partitions(db: Session, data_referencia: str) -> list:
+    """
+    Garante as partições do mês 'AAAA-MM' nas tabelas de preços e custos.
+    Tabelas não particionadas (ex.: as do sandbox) são ignoradas. Retorna os
+    nomes das partições.
+    """
+    month = f"{data_referencia}-01"
+    partitions = [
+        db.execute(text("SELECT sinapi_ensure_month_partition(:tabela, CAST(:mes AS date))"),
+                   {"tabela": table, "mes": month}).scalar()
+        for table in _partitioned_tables()
+    ]
+    db.commit()
+    partitions = [p for p in partitions if p]
+    if partitions:
+        logger.info(f"Partições de {data_referencia} disponíveis: {partitions}")
+    return partitions
+
+
+def detach_month_partitions(db: Session, data_referencia: str) -> list:
+    """
+    Desanexa as partições do mês 'AAAA-MM' das tabelas de preços e custos. Os
+    dados saem das consultas imediatamente e ficam nas tabelas avulsas
+    retornadas, que podem ser descartadas (`DROP TABLE`) ou reanexadas.
+    """
+    month = f"{data_referencia}-01"
+    detached = [
+        db.execute(text("SELECT sinapi_detach_month_partition(:tabela, CAST(:mes AS date))"),
+                   {"tabela": table, "mes": month}).scalar()
+        for table in _partitioned_tables()
+    ]
+    db.commit()
+    detached = [p for p in detached if p]
+    logger.info(f"Partições de {data_referencia} desanexadas: {detached}")
+    return detached
+
+
+def _cube_sources() -> dict:
+    # tipo_item -> (tabela de valores, tabela de itens, coluna do item, coluna da categoria, coluna do valor)
+    return {
+        "INSUMO": (settings.TABLE_PRECOS_INSUMOS, settings.TABLE_INSUMOS, "insumo_codigo", "classificacao", "preco_mediano"),
+        "COMPOSICAO": (settings.TABLE_CUSTOS_COMPOSICOES, settings.TABLE_COMPOSICOES, "composicao_codigo", "grupo", "custo_total"),
+    }
+
+
+def refresh_cubo_precos(db: Session, data_referencia: str = None) -> dict:
+    """
+    Recalcula o cubo de preços do mês 'AAAA-MM' (ou de todos os meses, sem
+    `data_referencia`). Cada UF carregada muda também os agregados da sua
+    macrorregião e do Brasil, então o mês é sempre recalculado inteiro; os três
+    níveis saem de uma única passada por tabela, com `GROUPING SETS`.
+    """
+    from .crud import _get_date_range
+
+    start = time.perf_counter()
+    ensure_sandbox_tables(db, "cubo_precos_mensal")
+    table = settings.TABLE_CUBO_PRECOS
+    params = {
+        "ufs": [uf for ufs in MACRORREGIOES.values() for uf in ufs],
+        "regioes": [regiao for regiao, ufs in MACRORREGIOES.items() for _ in ufs],
+    }
+    month_filter = ""
+    if data_referencia:
+        start_date, end_date = _get_date_range(data_referencia)
+        if start_date is None:
+            raise ValueError(f"data_referencia inválida: {data_referencia!r} (use AAAA-MM)")
+        params.update(start_date=start_date, end_date=end_date)
+        month_filter = "WHERE data_referencia >= :start_date AND data_referencia <= :end_date"
+        db.execute(text(f"DELETE FROM {table} {month_filter}"), params)
+    else:
+        db.execute(text(f"TRUNCATE {table}"))
+
+    inserted = 0
+    for tipo_item, (table_val, table_item, col_item, col_group, val_name) in _cube_sources().items():
+        categoria = f"""
+            CASE
+                WHEN i.{col_group} IS NULL OR TRIM(i.{col_group}) = '' OR UPPER(TRIM(i.{col_group})) = 'NAO_CLASSIFICADO' THEN 'GERAL'
+                ELSE UPPER(TRIM(i.{col_group}))
+            END"""
+        inserted += db.execute(text(f"""
+            INSERT INTO {table} (
+                tipo_item, nivel, local, regiao, categoria, data_referencia, regime,
+                preco_medio, preco_mediano, preco_min, preco_max, qtd_precos, qtd_itens
+            )
+            SELECT :tipo_item,
+                   CASE WHEN GROUPING(p.uf) = 0 THEN 'UF' WHEN GROUPING(r.regiao) = 0 THEN 'REGIAO' ELSE 'BRASIL' END,
+                   CASE WHEN GROUPING(p.uf) = 0 THEN p.uf WHEN GROUPING(r.regiao) = 0 THEN r.regiao ELSE 'BR' END,
+                   r.regiao, {categoria}, p.data_referencia, p.regime,
+                   AVG(p.{val_name}), percentile_cont(0.5) WITHIN GROUP (ORDER BY p.{val_name}),
+                   MIN(p.{val_name}), MAX(p.{val_name}), COUNT(p.{val_name}), COUNT(DISTINCT i.codigo)
+            FROM {table_val} p
+            JOIN {table_item} i ON i.codigo = p.{col_item}
+            JOIN unnest(CAST(:ufs AS text[]), CAST(:regioes AS text[])) AS r(uf, regiao) ON r.uf = p.uf
+            {month_filter.replace("data_referencia", "p.data_referencia")}
+            GROUP BY p.data_referencia, p.regime, {categoria}, GROUPING SETS ((r.regiao, p.uf), (r.regiao), ())
+        """), {**params, "tipo_item": tipo_item}).rowcount
+    db.commit()
+
+    summary = {
+        "data_referencia": data_referencia or "todos",
+        "linhas": inserted,
+        "segundos": round(time.perf_counter() - start, 2),
+    }
+    logger.info(f"Cubo de preços atualizado: {summary}")
+    return summary
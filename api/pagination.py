@@ -0,0 +1,50 @@
+# api/pagination.py
+"""
+Cursores opacos para paginação por chave (keyset).
+
+Em vez de `OFFSET`, a página seguinte é buscada a partir da chave de ordenação
+da última linha retornada (ex.: `(descricao, codigo)`), com uma comparação de
+tupla que o PostgreSQL resolve por busca no índice. Assim o custo de uma
+página não depende de quão funda ela é.
+
+O cursor é a chave da última linha serializada em JSON e codificada em
+base64 (URL-safe); o cliente só o repassa de volta, sem interpretá-lo.
+"""
+
+import json
+import base64
+import binascii
+
+# Cabeçalho de resposta com o cursor da próxima página
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(*values) -> str:
+    """Codifica a chave de ordenação da última linha de uma página."""
+    payload = json.dumps(list(values), separators=(",", ":"), ensure_ascii=False, default=str)
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> list:
+    """
+    Decodifica um cursor de `size` valores. Cursor vazio indica a primeira
+    página e retorna `None`. Lança `ValueError` para cursores inválidos.
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError("Cursor de paginação inválido.")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Cursor de paginação inválido.")
+    return values
+
+
+def next_cursor(rows: list, limit: int, *fields: str):
+    """Cursor da página seguinte, ou `None` se a página veio incompleta (última página)."""
+    if not rows or len(rows) < limit:
+        return None
+    last = rows[-1]
+    return encode_cursor(*(last[field] for field in fields))
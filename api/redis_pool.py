@@ -0,0 +1,181 @@
+# api/redis_pool.py
+"""
+Cliente Redis compartilhado da AutoSINAPI API.
+
+Este módulo concentra a criação das conexões com o Redis usadas pelo cache,
+pelas travas de idempotência da API e pelas tasks do Celery:
+
+- `get_redis_client()` retorna um cliente único por processo, sobre um pool de
+  conexões configurado em `config.Settings` (host, porta, banco, tamanho do
+  pool e timeouts de conexão/leitura).
+
+- O cliente passa por um `CircuitBreaker`: após `REDIS_CIRCUIT_FAILURE_THRESHOLD`
+  falhas de conexão/timeout seguidas, os comandos falham imediatamente com
+  `CircuitOpenError` durante `REDIS_CIRCUIT_RESET_TIMEOUT` segundos. Como os
+  chamadores já tratam erros do Redis recorrendo ao PostgreSQL, um incidente
+  no Redis custa microssegundos por requisição em vez de um timeout.
+
+- `get_pubsub_client()` retorna um cliente sem timeout de leitura, para
+  assinaturas pub/sub de longa duração (que ficam ociosas por design).
+"""
+
+import time
+import logging
+import threading
+
+import redis
+from redis.client import Pipeline
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+_BREAKER_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+
+class CircuitOpenError(redis.exceptions.ConnectionError):
+    """Comando recusado sem contato com o Redis porque o circuito está aberto."""
+
+
+class CircuitBreaker:
+    """
+    Disjuntor para as chamadas ao Redis. Fechado, deixa tudo passar e conta as
+    falhas seguidas; ao atingir o limite, abre e recusa as chamadas até o fim do
+    período de espera. Depois disso, uma única chamada de teste (meio-aberto)
+    decide se o circuito fecha ou volta a abrir.
+    """
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._probing or time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Redis respondeu novamente: circuito fechado.")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(
+                        f"Redis falhou {self._failures} vezes seguidas: circuito aberto por {self.reset_timeout}s."
+                    )
+                self._opened_at = time.monotonic()
+
+    def call(self, fn, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError("Circuito do Redis aberto: comando ignorado.")
+        try:
+            result = fn(*args, **kwargs)
+        except _BREAKER_ERRORS:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+class _BreakerPipeline(Pipeline):
+    """Pipeline cujo `execute` passa pelo disjuntor do cliente que o criou."""
+    breaker: CircuitBreaker = None
+
+    def execute(self, raise_on_error: bool = True):
+        return self.breaker.call(super().execute, raise_on_error)
+
+
+class BreakerRedis(redis.Redis):
+    """`redis.Redis` com todos os comandos (e pipelines) protegidos por um `CircuitBreaker`."""
+    def __init__(self, *args, breaker: CircuitBreaker, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker
+
+    def execute_command(self, *args, **options):
+        return self.breaker.call(super().execute_command, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = _BreakerPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.breaker = self.breaker
+        return pipe
+
+
+def redis_url() -> str:
+    """URL do Redis configurado (usada também pelo broker do Celery)."""
+    return f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB}"
+
+
+_lock = threading.Lock()
+_client = None
+_pubsub_client = None
+_breaker = CircuitBreaker(settings.REDIS_CIRCUIT_FAILURE_THRESHOLD, settings.REDIS_CIRCUIT_RESET_TIMEOUT)
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    return _breaker
+
+
+def get_redis_client() -> BreakerRedis:
+    """
+    Retorna o cliente Redis compartilhado do processo (binário: os valores do
+    cache usam o formato de `cache_codec`).
+    """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                pool = redis.ConnectionPool(
+                    host=settings.REDIS_HOST,
+                    port=settings.REDIS_PORT,
+                    db=settings.REDIS_DB,
+                    max_connections=settings.REDIS_MAX_CONNECTIONS,
+                    socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+                    socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                    health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+                )
+                _client = BreakerRedis(connection_pool=pool, breaker=_breaker)
+    return _client
+
+
+def get_pubsub_client() -> redis.Redis:
+    """
+    Retorna um cliente para pub/sub, sem timeout de leitura (a assinatura
+    fica ociosa entre mensagens) e fora do disjuntor.
+    """
+    global _pubsub_client
+    if _pubsub_client is None:
+        with _lock:
+            if _pubsub_client is None:
+                _pubsub_client = redis.Redis(
+                    host=settings.REDIS_HOST,
+                    port=settings.REDIS_PORT,
+                    db=settings.REDIS_DB,
+                    socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+                    socket_keepalive=True,
+                    health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+                )
+    return _pubsub_client
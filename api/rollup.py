@@ -0,0 +1,193 @@
+# api/rollup.py
+"""
+Roll-up de custos em lote das composições.
+
+Calcula, de uma vez, o custo de todas as composições de uma fatia (UF, mês,
+regime) a partir dos preços dos insumos, sobre o grafo em memória
+(`api.graph`). A estrutura é tratada como uma matriz esparsa em CSR
+(composição x item): o custo é a solução de `x = b + A x`, em que `b` traz a
+contribuição direta dos insumos e `A` os coeficientes das subcomposições.
+Como a estrutura é acíclica, `profundidade` iterações de produto
+matriz-vetor (vetorizadas com `np.bincount`) dão o resultado exato.
+
+A mesma passada separa o custo em mão de obra, material e equipamento (como
+`crud.get_composicao_produtividade`), soma as horas-homem e conta os insumos
+sem preço. O resultado é comparado com `custos_composicoes_mensal` e gravado
+em `custos_composicoes_calculados`, com as divergências marcadas.
+"""
+
+import time
+import logging
+
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from .config import settings
+from .graph import (
+    CompositionGraph, get_graph,
+    CATEGORIA_MATERIAL, CATEGORIA_MAO_DE_OBRA, CATEGORIA_EQUIPAMENTO,
+)
+from .maintenance import ensure_sandbox_tables
+
+logger = logging.getLogger(__name__)
+
+# Colunas da matriz de resultados
+_MAO_DE_OBRA, _MATERIAL, _EQUIPAMENTO, _HH, _SEM_PRECO = range(5)
+
+
+def _roll_up(rows: np.ndarray, cols: np.ndarray, weights: np.ndarray, base: np.ndarray, n: int, iterations: int):
+    """Resolve `x = base + A x` para a parte composição -> composição da matriz (colunas de `base`)."""
+    result = base.copy()
+    for _ in range(iterations):
+        upstream = np.empty_like(base)
+        for column in range(base.shape[1]):
+            upstream[:, column] = np.bincount(rows, weights=weights * result[cols, column], minlength=n)
+        result = base + upstream
+    return result
+
+
+def compute_rollup(graph: CompositionGraph, precos: dict) -> dict:
+    """
+    Calcula o custo de todas as composições do grafo a partir de `precos`
+    (preço por código de insumo). Retorna arrays alinhados por composição:
+    `codigo`, `custo`, `mao_de_obra`, `material`, `equipamento`, `total_hh`,
+    `itens_sem_preco` e `valido`.
+    """
+    n = graph.n_composicoes
+    size = len(graph.codes)
+    price = np.full(size, np.nan)
+    for node in range(n, size):
+        valor = precos.get(int(graph.codes[node]))
+        if valor is not None:
+            price[node] = float(valor)
+
+    rows = np.repeat(np.arange(size), np.diff(graph.fwd_indptr))
+    cols = graph.fwd_indices
+    weights = graph.fwd_coef
+    leaf = cols >= n
+    has_price = ~np.isnan(price[cols])
+    value = np.where(leaf & has_price, weights * np.nan_to_num(price[cols]), 0.0)
+    categoria = graph.categoria[cols]
+
+    base = np.zeros((n, 5))
+    base[:, _MAO_DE_OBRA] = np.bincount(rows[leaf], weights=np.where(categoria == CATEGORIA_MAO_DE_OBRA, value, 0.0)[leaf], minlength=n)
+    base[:, _MATERIAL] = np.bincount(rows[leaf], weights=np.where(categoria == CATEGORIA_MATERIAL, value, 0.0)[leaf], minlength=n)
+    base[:, _EQUIPAMENTO] = np.bincount(rows[leaf], weights=np.where(categoria == CATEGORIA_EQUIPAMENTO, value, 0.0)[leaf], minlength=n)
+    base[:, _HH] = np.bincount(rows[leaf], weights=np.where(categoria == CATEGORIA_MAO_DE_OBRA, weights, 0.0)[leaf], minlength=n)
+    base[:, _SEM_PRECO] = np.bincount(rows[leaf & ~has_price], minlength=n)
+
+    sub = ~leaf
+    iterations = max(int(graph.depth.max()) - 1, 0) if n else 0
+    # Insumos sem preço são contados por ocorrência na estrutura, não ponderados pelo coeficiente
+    valued = _roll_up(rows[sub], cols[sub], weights[sub], base[:, :_SEM_PRECO], n, iterations)
+    missing = _roll_up(rows[sub], cols[sub], np.ones(int(sub.sum())), base[:, _SEM_PRECO:], n, iterations)
+
+    return {
+        "codigo": graph.codes[:n],
+        "custo": valued[:, _MAO_DE_OBRA] + valued[:, _MATERIAL] + valued[:, _EQUIPAMENTO],
+        "mao_de_obra": valued[:, _MAO_DE_OBRA],
+        "material": valued[:, _MATERIAL],
+        "equipamento": valued[:, _EQUIPAMENTO],
+        "total_hh": valued[:, _HH],
+        "itens_sem_preco": missing[:, 0].astype(np.int64),
+        # Profundidade 0: composição sem itens ou que alcança um ciclo
+        "valido": graph.depth > 0,
+    }
+
+
+def compare_with_official(result: dict, oficiais: dict, tolerance: float = None) -> list:
+    """
+    Monta as linhas de resultado comparando o custo calculado com o oficial
+    (`custo_total` por código). Diverge quem passar da tolerância relativa.
+    """
+    tolerance = settings.ROLLUP_TOLERANCE if tolerance is None else tolerance
+    linhas = []
+    for i in np.nonzero(result["valido"])[0].tolist():
+        codigo = int(result["codigo"][i])
+        custo = float(result["custo"][i])
+        oficial = oficiais.get(codigo)
+        diferenca = percentual = None
+        divergente = False
+        if oficial is not None:
+            oficial = float(oficial)
+            diferenca = custo - oficial
+            percentual = diferenca / oficial * 100 if oficial else None
+            divergente = abs(diferenca) > max(abs(oficial) * tolerance, 0.01)
+        linhas.append({
+            "composicao_codigo": codigo,
+            "custo_calculado": round(custo, 4),
+            "custo_oficial": oficial,
+            "diferenca": round(diferenca, 4) if diferenca is not None else None,
+            "diferenca_percentual": round(percentual, 4) if percentual is not None else None,
+            "mao_de_obra": round(float(result["mao_de_obra"][i]), 4),
+            "material": round(float(result["material"][i]), 4),
+            "equipamento": round(float(result["equipamento"][i]), 4),
+            "total_hh": round(float(result["total_hh"][i]), 6),
+            "itens_sem_preco": int(result["itens_sem_preco"][i]),
+            "divergente": divergente,
+        })
+    return linhas
+
+
+def run_rollup(db: Session, uf: str, data_referencia: str, regime: str) -> dict:
+    """
+    Executa o roll-up de uma fatia (UF, mês 'AAAA-MM', regime) e grava o
+    resultado em `custos_composicoes_calculados`, substituindo a execução
+    anterior da mesma fatia. Retorna um resumo.
+    """
+    from .crud import _get_date_range
+
+    start = time.perf_counter()
+    uf, regime = uf.upper(), regime.upper()
+    start_date, end_date = _get_date_range(data_referencia)
+    if start_date is None:
+        raise ValueError(f"data_referencia inválida: {data_referencia!r} (use AAAA-MM)")
+    params = {"uf": uf, "regime": regime, "start_date": start_date, "end_date": end_date}
+
+    graph = get_graph(db)
+    precos = dict(db.execute(text(f"""
+        SELECT insumo_codigo, preco_mediano FROM {settings.TABLE_PRECOS_INSUMOS}
+        WHERE uf = :uf AND regime = :regime AND data_referencia >= :start_date AND data_referencia <= :end_date
+    """), params).fetchall())
+    oficiais = dict(db.execute(text(f"""
+        SELECT composicao_codigo, custo_total FROM {settings.TABLE_CUSTOS_COMPOSICOES}
+        WHERE uf = :uf AND regime = :regime AND data_referencia >= :start_date AND data_referencia <= :end_date
+    """), params).fetchall())
+
+    linhas = compare_with_official(compute_rollup(graph, precos), oficiais)
+    elapsed_compute = time.perf_counter() - start
+
+    ensure_sandbox_tables(db, "custos_composicoes_calculados")
+    table = settings.TABLE_CUSTOS_CALCULADOS
+    db.execute(text(f"""
+        DELETE FROM {table}
+        WHERE uf = :uf AND regime = :regime AND data_referencia = :start_date
+    """), params)
+    if linhas:
+        db.execute(text(f"""
+            INSERT INTO {table} (
+                composicao_codigo, uf, data_referencia, regime, custo_calculado, custo_oficial,
+                diferenca, diferenca_percentual, mao_de_obra, material, equipamento,
+                total_hh, itens_sem_preco, divergente
+            ) VALUES (
+                :composicao_codigo, :uf, :data_referencia, :regime, :custo_calculado, :custo_oficial,
+                :diferenca, :diferenca_percentual, :mao_de_obra, :material, :equipamento,
+                :total_hh, :itens_sem_preco, :divergente
+            )
+        """), [{**linha, "uf": uf, "regime": regime, "data_referencia": start_date} for linha in linhas])
+    db.commit()
+
+    summary = {
+        "uf": uf,
+        "data_referencia": data_referencia,
+        "regime": regime,
+        "composicoes": len(linhas),
+        "divergentes": sum(1 for linha in linhas if linha["divergente"]),
+        "sem_custo_oficial": sum(1 for linha in linhas if linha["custo_oficial"] is None),
+        "com_insumos_sem_preco": sum(1 for linha in linhas if linha["itens_sem_preco"]),
+        "calculo_segundos": round(elapsed_compute, 3),
+        "total_segundos": round(time.perf_counter() - start, 3),
+    }
+    logger.info(f"Roll-up de custos concluído: {summary}")
+    return summary
@@ -10,7 +10,7 @@ diretamente a partir de objetos do SQLAlchemy, facilitando a conversão dos
 resultados do banco de dados em JSON.
 """
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 from datetime import datetime
 
 # --- Traceability Mixin ---
@@ -30,6 +30,7 @@ class Insumo(TraceabilityMixin):
     classificacao: Optional[str] = None
     origem_preco: Optional[str] = None
     status: Optional[str] = None
+    relevancia: Optional[float] = None
 
     class Config:
         from_attributes = True
@@ -43,6 +44,7 @@ class Composicao(TraceabilityMixin):
     grupo: Optional[str] = None
     percentual_mo: Optional[float] = None
     status: Optional[str] = None
+    relevancia: Optional[float] = None
 
     class Config:
         from_attributes = True
@@ -137,6 +139,31 @@ class TendenciaClassificacao(BaseModel):
     class Config:
         from_attributes = True
 
+class CuboPreco(BaseModel):
+    """Schema para uma célula do cubo de preços (local x categoria x mês)."""
+    nivel: str
+    local: str
+    regiao: Optional[str] = None
+    categoria: str
+    mes: str
+    preco_medio: Optional[float] = None
+    preco_mediano: Optional[float] = None
+    preco_min: Optional[float] = None
+    preco_max: Optional[float] = None
+    qtd_precos: int
+    qtd_itens: int
+
+    class Config:
+        from_attributes = True
+
+class DrillDownPrecos(BaseModel):
+    """Schema para o detalhamento regional do cubo: o nó consultado e seus filhos."""
+    tipo_item: str
+    nivel: str
+    local: str
+    agregado: List[CuboPreco]
+    detalhamento: List[CuboPreco]
+
 class PrecoPorUF(BaseModel):
     """Schema para o preço de um item em uma UF específica."""
     uf: str
@@ -160,4 +187,57 @@ class InsumoOndeUsado(BaseModel):
     composicao_descricao: str
     tipo_item: str
     coeficiente: float
-    nivel: int
\ No newline at end of file
+    nivel: int
+class AlteracaoPreco(BaseModel):
+    """Alteração de preço de um insumo na simulação: variação percentual ou novo preço."""
+    codigo: int
+    variacao_percentual: Optional[float] = None
+    preco: Optional[float] = None
+
+class ImpactoComposicao(BaseModel):
+    """Schema para uma composição afetada na simulação de preços."""
+    composicao_codigo: int
+    composicao_descricao: str
+    custo_atual: Optional[float] = None
+    custo_simulado: Optional[float] = None
+    variacao: float
+    variacao_percentual: Optional[float] = None
+
+class InsumosEmLote(BaseModel):
+    """Resultado da consulta de insumos em lote: encontrados por código e códigos ausentes."""
+    itens: Dict[int, Insumo]
+    nao_encontrados: List[int]
+
+class ComposicoesEmLote(BaseModel):
+    """Resultado da consulta de composições em lote: encontradas por código e códigos ausentes."""
+    itens: Dict[int, Composicao]
+    nao_encontrados: List[int]
+
+class FacetaValor(BaseModel):
+    """Contagem de resultados de uma busca para um valor de faceta."""
+    valor: Optional[str] = None
+    total: int
+
+class FacetasInsumos(BaseModel):
+    """Facetas da busca de insumos: total e contagens por classificação, unidade e faixa de preço."""
+    total: int
+    classificacao: List[FacetaValor]
+    unidade: List[FacetaValor]
+    faixa_preco: List[FacetaValor]
+
+class FacetasComposicoes(BaseModel):
+    """Facetas da busca de composições: total e contagens por grupo, unidade e faixa de custo."""
+    total: int
+    grupo: List[FacetaValor]
+    unidade: List[FacetaValor]
+    faixa_preco: List[FacetaValor]
+
+class BuscaInsumos(BaseModel):
+    """Página da busca de insumos acompanhada das facetas do conjunto encontrado."""
+    itens: List[Insumo]
+    facetas: FacetasInsumos
+
+class BuscaComposicoes(BaseModel):
+    """Página da busca de composições acompanhada das facetas do conjunto encontrado."""
+    itens: List[Composicao]
+    facetas: FacetasComposicoes
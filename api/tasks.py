@@ -13,20 +13,38 @@ da API principal, garantindo que a API permaneça rápida e responsiva.
   a API e o toolkit `autosinapi`. Ela recebe os dicionários de configuração
   do endpoint da API e os repassa para a função `autosinapi.run_etl`.
   Todo o processo de download, processamento e carga de dados acontece
-  aqui, de forma isolada do processo da API.
+  aqui, de forma isolada do processo da API. Ao fim de uma carga bem-sucedida,
+  atualiza as estruturas derivadas (ver `maintenance`) e invalida os caches.
+
+- `warm_cache_task`: Encadeada ao fim de um ETL bem-sucedido, pré-calcula o
+  cache da fatia carregada (filtros, estatísticas e o BI das composições mais
+  acessadas), com limite de taxa para não saturar o banco.
+
+- `rollup_custos_task`: Recalcula em lote o custo de todas as composições de
+  uma fatia (UF, mês, regime) e registra as divergências com o custo oficial
+  (ver `rollup`).
 """
 
 import os
-import redis
+import time
 from celery import Celery
 import autosinapi
 
+from . import crud
+from .config import settings
+from .database import SessionLocal
+from .cache_utils import bump_generation, get_popular
+from .redis_pool import get_redis_client
+from .http_cache import purge_gateway_cache
+from .maintenance import rebuild_composicao_fechamento, ensure_month_partitions, refresh_cubo_precos
+from .rollup import run_rollup
+
 # Instancia o app Celery
 celery_app = Celery('tasks')
 celery_app.config_from_object('api.celery_config')
 
-# Cliente Redis para gerenciar o lock
-redis_client = redis.Redis(host=os.getenv("REDIS_HOST", "redis"), port=6379, db=0)
+# Cliente Redis para gerenciar o lock, sobre o pool compartilhado
+redis_client = get_redis_client()
 
 @celery_app.task(bind=True, max_retries=3, default_retry_delay=300)
 def populate_sinapi_task(self, db_config: dict, sinapi_config: dict):
@@ -40,9 +58,23 @@ def populate_sinapi_task(self, db_config: dict, sinapi_config: dict):
     mode_suffix = 'sandbox' if os.getenv("AUTOSINAPI_SANDBOX") == "true" else 'prod'
     lock_key = f"lock:autosinapi:populate:{year}:{month:02d}:{state.upper()}:{mode_suffix}"
 
+    data_referencia = f"{year}-{month:02d}"
+
     try:
         print(f"[{self.request.id}] Iniciando ETL para {state} {month}/{year} (Modo: {mode_suffix})...")
-        
+        # Nova geração já no início: o que for cacheado durante a carga não se mistura ao cache anterior
+        bump_generation(uf=state, data_referencia=data_referencia)
+
+        # Partições do mês criadas antes da carga; sem elas as linhas caem na partição default
+        db = SessionLocal()
+        try:
+            ensure_month_partitions(db, data_referencia)
+        except Exception as e:
+            db.rollback()
+            print(f"[{self.request.id}] Aviso: não foi possível criar as partições de {data_referencia}: {e}")
+        finally:
+            db.close()
+
         result = autosinapi.run_etl(
             db_config=db_config,
             sinapi_config=sinapi_config,
@@ -56,6 +88,24 @@ def populate_sinapi_task(self, db_config: dict, sinapi_config: dict):
                 raise self.retry(countdown=600)
             return result
 
+        # Estruturas derivadas lidas pelo BI, atualizadas antes de liberar o novo cache
+        try:
+            db = SessionLocal()
+            try:
+                rebuild_composicao_fechamento(db)
+                refresh_cubo_precos(db, data_referencia)
+            finally:
+                db.close()
+        except Exception as e:
+            print(f"[{self.request.id}] Erro ao atualizar as estruturas derivadas de {state} {data_referencia}: {e}")
+            raise
+        finally:
+            # Com a carga feita, o cache da fatia e o global são descartados mesmo se a derivação
+            # falhar: o que foi cacheado durante a carga não pode sobreviver a ela (O(1), as
+            # chaves antigas expiram sozinhas)
+            bump_generation(uf=state, data_referencia=data_referencia)
+            purge_gateway_cache(uf=state, data_referencia=data_referencia)
+        warm_cache_task.delay(state, data_referencia)
         print(f"[{self.request.id}] Tarefa de ETL concluída com sucesso.")
         return result
     except Exception as e:
@@ -66,3 +116,60 @@ def populate_sinapi_task(self, db_config: dict, sinapi_config: dict):
         if not self.request.called_directly:
             redis_client.delete(lock_key)
             print(f"[{self.request.id}] Lock {lock_key} liberado.")
+
+@celery_app.task(bind=True)
+def warm_cache_task(self, uf: str, data_referencia: str, regimes: list = None, top_n: int = None):
+    """
+    Aquece o cache após a carga de (UF, mês): filtros e estatísticas globais e,
+    para as composições mais acessadas na API, BOM, produtividade e hora-homem.
+    As consultas são espaçadas para respeitar `CACHE_WARM_MAX_QUERIES_PER_SECOND`.
+    """
+    regimes = regimes or [r.strip() for r in settings.CACHE_WARM_REGIMES.split(",") if r.strip()]
+    codigos = get_popular("composicao", top_n or settings.CACHE_WARM_TOP_N)
+    min_interval = 1.0 / settings.CACHE_WARM_MAX_QUERIES_PER_SECOND
+    warmed = 0
+    errors = 0
+
+    calls = [(crud.get_available_filters, {}), (crud.get_global_stats, {})]
+    for codigo in codigos:
+        calls.append((crud.get_composicao_man_hours, {"codigo": codigo}))
+        for regime in regimes:
+            params = {"codigo": codigo, "uf": uf, "data_referencia": data_referencia, "regime": regime}
+            calls.append((crud.get_composicao_bom, params))
+            calls.append((crud.get_composicao_produtividade, params))
+
+    print(f"[{self.request.id}] Aquecendo cache de {uf} {data_referencia}: {len(codigos)} composições populares, {len(calls)} consultas.")
+    db = SessionLocal()
+    try:
+        for func, params in calls:
+            started = time.monotonic()
+            try:
+                func(db, **params)
+                warmed += 1
+            except Exception as e:
+                errors += 1
+                db.rollback()
+                print(f"[{self.request.id}] Falha ao aquecer {func.__name__} {params}: {e}")
+            elapsed = time.monotonic() - started
+            if elapsed < min_interval:
+                time.sleep(min_interval - elapsed)
+    finally:
+        db.close()
+
+    print(f"[{self.request.id}] Aquecimento concluído: {warmed} consultas, {errors} falhas.")
+    return {"uf": uf, "data_referencia": data_referencia, "warmed": warmed, "errors": errors}
+
+@celery_app.task(bind=True)
+def rollup_custos_task(self, uf: str, data_referencia: str, regime: str):
+    """
+    Recalcula o custo de todas as composições de (UF, mês, regime) a partir dos
+    preços dos insumos e grava o resultado em `custos_composicoes_calculados`.
+    """
+    print(f"[{self.request.id}] Iniciando roll-up de custos para {uf} {data_referencia} ({regime})...")
+    db = SessionLocal()
+    try:
+        summary = run_rollup(db, uf, data_referencia, regime)
+    finally:
+        db.close()
+    print(f"[{self.request.id}] Roll-up concluído: {summary['composicoes']} composições, {summary['divergentes']} divergentes.")
+    return summary
@@ -1,6 +1,6 @@
 import pytest
 from unittest.mock import Mock, MagicMock, patch, PropertyMock
-from api import crud
+from api import crud, cache_utils
 from api.config import settings
 
 @pytest.fixture(autouse=True)
@@ -11,7 +11,16 @@ def mock_redis():
         mock_redis.set.return_value = True
         mock_redis.delete.return_value = 1
         mock_redis.scan.return_value = (0, [])
+        mock_redis.mget.return_value = [None, None]
+        mock_redis.zrange.return_value = []
+        cache_utils.local_cache.clear()
         yield mock_redis
+        cache_utils.local_cache.clear()
+
+@pytest.fixture(autouse=True)
+def sql_only(monkeypatch):
+    """As contagens de queries abaixo assumem as funções de BI lendo do banco, sem o grafo em memória."""
+    monkeypatch.setattr(settings, "GRAPH_ENGINE_ENABLED", False)
 
 @pytest.fixture
 def mock_db():
@@ -33,6 +42,7 @@ def test_cache_hit_prevents_db_call_bom(mock_db, mock_redis):
     assert mock_db.execute.call_count == 1
 
     # Segunda chamada: cache hit (simulado por mock_redis.get retornando valor)
+    cache_utils.local_cache.clear()
     mock_redis.get.return_value = '[{"item_codigo": 1}]'
     crud.get_composicao_bom(mock_db, codigo, uf, referencia, regime)
     assert mock_db.execute.call_count == 1
@@ -51,6 +61,7 @@ def test_cache_hit_prevents_db_call_abc(mock_db, mock_redis):
     crud.get_abc_curve_for_composicoes(mock_db, codigos, uf, referencia, regime)
     assert mock_db.execute.call_count == 1
 
+    cache_utils.local_cache.clear()
     mock_redis.get.return_value = '[{"codigo": 100}]'
     crud.get_abc_curve_for_composicoes(mock_db, codigos, uf, referencia, regime)
     assert mock_db.execute.call_count == 1
@@ -78,4 +89,442 @@ def test_invalidate_cache(mock_redis):
 
     deleted = invalidate_cache("cache:get_composicao_bom:*")
     assert deleted == 2
-    mock_redis.delete.assert_called_once()
\ No newline at end of file
+    mock_redis.delete.assert_called_once()
+
+def test_unreadable_generation_bypasses_cache(mock_db, mock_redis):
+    """Sem a geração (MGET falhou), a função é calculada sem ler nem gravar o cache."""
+    mock_redis.mget.side_effect = ConnectionError("Redis indisponível")
+    mock_db.execute.return_value.fetchall.return_value = [
+        Mock(_mapping={"item_codigo": 4, "tipo_item": "INSUMO", "descricao": "Item 4", "coeficiente": 1.0})
+    ]
+
+    for _ in range(2):
+        result = crud.get_composicao_bom(mock_db, 790, "SP", "2025-10", "DESONERADO")
+    assert result[0]["item_codigo"] == 4
+    assert mock_db.execute.call_count == 2
+    mock_redis.get.assert_not_called()
+    assert not [c for c in mock_redis.set.call_args_list if c.args[0].startswith("cache:")]
+    assert len(cache_utils.local_cache) == 0
+
+def test_l1_hit_skips_redis(mock_db, mock_redis):
+    """Segunda chamada no mesmo worker é servida pelo L1, sem ir ao Redis."""
+    mock_db.execute.return_value.fetchall.return_value = [
+        Mock(_mapping={"item_codigo": 3, "tipo_item": "INSUMO", "descricao": "Item 3", "coeficiente": 1.0})
+    ]
+
+    crud.get_composicao_bom(mock_db, 789, "SP", "2025-10", "DESONERADO")
+    redis_reads = mock_redis.get.call_count
+
+    result = crud.get_composicao_bom(mock_db, 789, "SP", "2025-10", "DESONERADO")
+    assert mock_redis.get.call_count == redis_reads
+    assert mock_db.execute.call_count == 1
+    assert result[0]["item_codigo"] == 3
+
+def test_invalidate_cache_evicts_l1_and_publishes(mock_redis):
+    """invalidate_cache limpa o L1 local e avisa os demais workers via pub/sub."""
+    from api.cache_utils import invalidate_cache, local_cache
+
+    local_cache.set("cache:get_global_stats:prod::", {"insumos": 1})
+    local_cache.set("cache:get_available_filters:prod::", {"ufs": ["SP"]})
+
+    invalidate_cache("cache:get_global_stats:*")
+
+    assert len(local_cache) == 1
+    mock_redis.publish.assert_called_once_with(settings.CACHE_INVALIDATION_CHANNEL, "cache:get_global_stats:*")
+
+def test_local_cache_is_bounded_and_expires():
+    """O L1 descarta a entrada menos usada ao exceder o limite e respeita o TTL."""
+    from api.cache_utils import LocalCache, _MISS
+
+    cache = LocalCache(max_items=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is _MISS
+    assert cache.get("a") == 1
+
+    with patch("api.cache_utils.time.monotonic", return_value=10**9):
+        assert cache.get("a") is _MISS
+
+def test_concurrent_misses_are_coalesced(mock_redis):
+    """Misses simultâneos da mesma chave executam a função uma única vez."""
+    import threading
+    import time
+    from api.cache_utils import cache_result
+
+    calls = []
+
+    @cache_result(ttl=60)
+    def slow_query(db, codigo):
+        calls.append(codigo)
+        time.sleep(0.2)
+        return [{"codigo": codigo}]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(slow_query(None, 42))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [[{"codigo": 42}]] * 8
+
+def test_followers_compute_when_leader_outlives_lock_timeout(mock_redis):
+    """Se o líder demora mais que CACHE_LOCK_TIMEOUT, as demais threads calculam em vez de falhar."""
+    import threading
+    import time
+    from api.cache_utils import cache_result
+
+    calls = []
+
+    @cache_result(ttl=60)
+    def slow_query(db, codigo):
+        calls.append(codigo)
+        time.sleep(0.3 if len(calls) == 1 else 0)
+        return [{"codigo": codigo}]
+
+    results, errors = [], []
+
+    def run():
+        try:
+            results.append(slow_query(None, 43))
+        except Exception as e:
+            errors.append(e)
+
+    with patch.object(settings, "CACHE_LOCK_TIMEOUT", 0.05):
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    assert errors == []
+    assert results == [[{"codigo": 43}]] * 3
+    assert len(calls) == 3
+
+def test_waits_for_remote_worker_holding_lock(mock_redis):
+    """Se outro worker detém a trava, aguarda o valor publicado no Redis em vez de recalcular."""
+    from api.cache_utils import cache_result
+
+    mock_redis.set.return_value = None  # SET NX falha: trava pertence a outro worker
+    mock_redis.get.side_effect = [None, '[{"codigo": 7}]']  # miss, valor publicado pelo outro worker
+    db = MagicMock()
+
+    @cache_result(ttl=60)
+    def query(db, codigo):
+        db.execute()
+        return []
+
+    with patch.object(settings, "CACHE_LOCK_POLL_INTERVAL", 0.001):
+        assert query(db, 7) == [{"codigo": 7}]
+    db.execute.assert_not_called()
+
+def test_stale_value_is_served_while_refreshing(mock_redis):
+    """Após o TTL fresco, o valor velho é devolvido e o recálculo vai para segundo plano."""
+    import json
+    import time
+    from api.cache_utils import cache_result, _SWR_FIELD
+
+    mock_redis.get.return_value = json.dumps({_SWR_FIELD: time.time() - 1, "data": [{"codigo": 1}]})
+    db = MagicMock()
+
+    @cache_result(ttl=60, stale_ttl=600)
+    def query(db, codigo):
+        db.execute()
+        return [{"codigo": codigo}]
+
+    with patch("api.cache_utils._refresh_in_background") as refresh:
+        assert query(db, 1) == [{"codigo": 1}]
+    refresh.assert_called_once()
+    db.execute.assert_not_called()
+
+def test_stale_ttl_extends_redis_expiry(mock_redis):
+    """Entradas com stale-while-revalidate expiram no Redis apenas após ttl + stale_ttl."""
+    from api.cache_utils import cache_result
+
+    @cache_result(ttl=60, stale_ttl=600)
+    def query(db, codigo):
+        return [{"codigo": codigo}]
+
+    query(None, 2)
+    value_call = [c for c in mock_redis.set.call_args_list if c.args[0].startswith("cache:")][0]
+    assert value_call.kwargs["ex"] == 660
+
+def test_codec_roundtrip_with_compression():
+    """Payloads grandes são comprimidos e voltam idênticos; Decimal vira float."""
+    import decimal
+    from api import cache_codec
+
+    value = [{"codigo": i, "descricao": "CIMENTO PORTLAND CP II-32" * 4, "preco": decimal.Decimal("12.34")} for i in range(500)]
+    raw = cache_codec.encode(value)
+
+    assert raw[0] >> 4 == cache_codec.FORMAT_VERSION
+    assert raw[0] & 0b11 != cache_codec.COMPRESSION_NONE
+    decoded = cache_codec.decode(raw)
+    assert decoded[10] == {"codigo": 10, "descricao": "CIMENTO PORTLAND CP II-32" * 4, "preco": 12.34}
+
+def test_codec_reads_legacy_json_entries():
+    """Entradas gravadas como JSON texto antes do codec continuam legíveis."""
+    from api import cache_codec
+
+    assert cache_codec.decode(b'[{"item_codigo": 1}]') == [{"item_codigo": 1}]
+    assert cache_codec.decode('{"ufs": ["SP"]}') == {"ufs": ["SP"]}
+    assert cache_codec.decode(b' null') is None
+
+def test_bump_generation_changes_only_its_slice(mock_redis):
+    """Incrementar a geração de uma fatia muda as chaves dela e as globais, não as de outras fatias."""
+    from api.cache_utils import cache_result, bump_generation
+
+    generations = {}
+    mock_redis.mget.side_effect = lambda keys: [generations.get(k) for k in keys]
+    pipe = mock_redis.pipeline.return_value
+    pipe.incr.side_effect = lambda key: generations.__setitem__(key, generations.get(key, 0) + 1)
+
+    @cache_result(ttl=60, sliced=True)
+    def by_slice(db, codigo, uf, data_referencia):
+        return [{"codigo": codigo}]
+
+    def stored_keys():
+        return [c.args[0] for c in mock_redis.set.call_args_list if c.args[0].startswith("cache:by_slice")]
+
+    by_slice(None, 1, "SP", "2025-09")
+    by_slice(None, 1, "RJ", "2025-09")
+    sp_key, rj_key = stored_keys()
+
+    bump_generation(uf="SP", data_referencia="2025-09")
+    cache_utils.local_cache.clear()
+    mock_redis.set.reset_mock()
+
+    by_slice(None, 1, "SP", "2025-09")
+    by_slice(None, 1, "RJ", "2025-09")
+    new_sp_key, new_rj_key = stored_keys()
+
+    assert new_sp_key != sp_key
+    assert ":g1:" in new_sp_key
+    assert new_rj_key == rj_key
+
+def test_positional_and_keyword_calls_share_key(mock_db, mock_redis):
+    """Chamadas posicionais, nomeadas e com caixa diferente de UF/regime usam a mesma chave."""
+    key_a = crud.get_composicao_bom.cache_key(mock_db, 123, "sp", "2025-10", "desonerado")
+    key_b = crud.get_composicao_bom.cache_key(mock_db, codigo=123, uf="SP", data_referencia="2025-10", regime="DESONERADO")
+    assert key_a == key_b
+
+    key_c = crud.get_abc_curve_for_composicoes.cache_key(mock_db, [200, 100, 100], "RJ", "2025-09", "NAO_DESONERADO")
+    key_d = crud.get_abc_curve_for_composicoes.cache_key(mock_db, codigos=[100, 200], uf="rj", data_referencia="2025-09", regime="NAO_DESONERADO", top_n=50)
+    assert key_c == key_d
+
+def test_long_arguments_are_hashed(mock_db, mock_redis):
+    """Listas longas entram na chave como hash de tamanho fixo."""
+    key = crud.get_abc_curve_for_composicoes.cache_key(mock_db, list(range(1000)), "SP", "2025-09", "NAO_DESONERADO")
+    assert len(key) < 200
+
+def test_cache_stats_count_hits_and_misses(mock_db, mock_redis):
+    """Os contadores por função registram misses, hits e tempo de cálculo."""
+    from api.cache_utils import get_cache_stats
+
+    mock_db.execute.return_value.scalar.return_value = 10
+    before = get_cache_stats().get("get_global_stats", {"misses": 0, "l1_hits": 0})
+
+    crud.get_global_stats(mock_db)
+    crud.get_global_stats(mock_db)
+
+    after = get_cache_stats()["get_global_stats"]
+    assert after["misses"] == before["misses"] + 1
+    assert after["l1_hits"] == before["l1_hits"] + 1
+    assert after["avg_compute_ms"] is not None
+
+def test_popularity_is_buffered_and_ranked(mock_redis):
+    """Acessos são enviados ao Redis em lote e o ranking volta do mais ao menos acessado."""
+    from api.cache_utils import track_popularity, get_popular
+
+    pipe = mock_redis.pipeline.return_value
+    with patch.object(settings, "CACHE_POPULARITY_FLUSH_INTERVAL", 3600):
+        track_popularity("composicao", 92711)
+        track_popularity("composicao", 92711)
+    pipe.zincrby.assert_not_called()
+
+    with patch.object(settings, "CACHE_POPULARITY_FLUSH_INTERVAL", 0):
+        track_popularity("composicao", 88307)
+    flushed = {c.args[2]: c.args[1] for c in pipe.zincrby.call_args_list}
+    assert flushed == {92711: 2, 88307: 1}
+
+    mock_redis.zunion.return_value = [(b"88307", 1.0), (b"92711", 9.0)]
+    assert get_popular("composicao", top_n=1) == [92711]
+
+def test_reference_month_ttl_policy(mock_db, mock_redis):
+    """Meses fechados recebem TTL longo; o mês mais recente carregado, TTL curto."""
+    mock_redis.zrange.return_value = [b"2025-10"]
+    mock_db.execute.return_value.fetchall.return_value = []
+
+    crud.get_composicao_bom(mock_db, 1, "SP", "2025-09", "DESONERADO")
+    crud.get_composicao_bom(mock_db, 1, "SP", "2025-10", "DESONERADO")
+    ttls = [c.kwargs["ex"] for c in mock_redis.set.call_args_list if c.args[0].startswith("cache:get_composicao_bom:")]
+    assert ttls == [
+        settings.CACHE_CLOSED_MONTH_TTL + settings.CACHE_STALE_TTL,
+        settings.CACHE_LIVE_MONTH_TTL + settings.CACHE_STALE_TTL,
+    ]
+    assert cache_utils.reference_month_ttl(mock_db, {"data_referencia": None}, 120) == 120
+
+def test_bump_generation_records_reference_month(mock_redis):
+    """O ETL registra o mês carregado, que passa a ser o mês 'vivo' da política de TTL."""
+    cache_utils.bump_generation("SP", "2025-11")
+    mock_redis.zadd.assert_called_once_with("cache:months:prod", {"2025-11": 0})
+
+def test_admission_stores_only_repeated_keys(mock_redis):
+    """O filtro de admissão só grava chaves vistas mais de uma vez."""
+    from api.cache_utils import cache_result
+
+    @cache_result(ttl=60, namespace="test-admission", admission=True)
+    def search(db, q):
+        return [{"q": q}]
+
+    def stored():
+        return [c.args[0] for c in mock_redis.set.call_args_list if c.args[0].startswith("cache:search:")]
+
+    search(None, "cimento")
+    assert stored() == []
+    search(None, "cimento")
+    assert len(stored()) == 1
+    assert cache_utils.get_namespace_stats()["test-admission"]["rejected"] == 1
+
+def test_frequency_sketch_ages_counters():
+    """Os contadores do sketch são divididos por dois a cada `width * 10` incrementos."""
+    sketch = cache_utils.FrequencySketch(1024)
+    for _ in range(4):
+        sketch.increment("a")
+    assert sketch.estimate("a") == 4
+    for _ in range(sketch.width * 10 - 4):
+        sketch.increment("b")
+    assert sketch.estimate("a") == 2
+
+def test_namespace_over_budget_evicts_and_purges_without_scan(mock_redis):
+    """Acima do orçamento, o namespace despeja pelo índice; o purge também não usa SCAN."""
+    namespace = cache_utils.get_namespace("test-budget")
+    mock_redis.eval.return_value = namespace.budget + 10
+    mock_redis.zpopmin.side_effect = [[(b"cache:a", 1.0)], [(b"cache:b", 2.0)], []]
+    mock_redis.hmget.return_value = [str(namespace.budget).encode()]
+
+    namespace.record_write("cache:c", 10, 60)
+    pipe = mock_redis.pipeline.return_value
+    pipe.unlink.assert_called_with(b"cache:a")
+    assert namespace.evicted == 1
+
+    deleted = cache_utils.purge_namespace("test-budget")
+    assert deleted == 1
+    mock_redis.unlink.assert_called_once_with(b"cache:b")
+    mock_redis.scan.assert_not_called()
+
+def test_bulk_lookup_uses_one_mget_and_one_query(mock_db, mock_redis):
+    """Lote: cacheados vêm de um MGET, o resto de uma única query, e ausentes voltam como None."""
+    from api import cache_codec
+    args = {"uf": "sp", "data_referencia": "2025-01", "regime": "desonerado"}
+    cached_key = crud.get_insumo_by_codigo.cache_key(mock_db, codigo=1, **args)
+
+    def mget(keys):
+        return [cache_codec.encode({"codigo": 1}) if key == cached_key else None for key in keys]
+    mock_redis.mget.side_effect = mget
+    mock_db.execute.return_value.fetchall.return_value = [
+        Mock(codigo=2, _mapping={"codigo": 2, "descricao": "Areia"})
+    ]
+
+    result = crud.get_insumos_by_codigos(mock_db, codigos=[1, 2, 3, 2], **args)
+
+    assert result == {1: {"codigo": 1}, 2: {"codigo": 2, "descricao": "Areia"}, 3: None}
+    assert mock_db.execute.call_count == 1
+    assert mock_db.execute.call_args[0][1]["codigos"] == [2, 3]
+    # Mesmas chaves da consulta unitária: a próxima chamada unitária vem do L1
+    assert crud.get_insumo_by_codigo(mock_db, codigo=2, **args) == {"codigo": 2, "descricao": "Areia"}
+    assert mock_db.execute.call_count == 1
+
+def test_bulk_lookup_skips_entries_that_fail_to_encode(mock_db, mock_redis):
+    """Lote: falha ao codificar uma entrada só deixa essa chave fora do Redis."""
+    from api import cache_codec
+    args = {"uf": "sp", "data_referencia": "2025-01", "regime": "desonerado"}
+    mock_redis.mget.side_effect = lambda keys: [None] * len(keys)
+    mock_db.execute.return_value.fetchall.return_value = [
+        Mock(codigo=1, _mapping={"codigo": 1, "descricao": "Cimento"}),
+        Mock(codigo=2, _mapping={"codigo": 2, "descricao": "Areia"}),
+    ]
+    encode = cache_codec.encode
+
+    def flaky_encode(value):
+        if isinstance(value, dict) and value.get("codigo") == 1:
+            raise TypeError("não serializável")
+        return encode(value)
+
+    with patch("api.cache_utils.cache_codec.encode", side_effect=flaky_encode):
+        result = crud.get_insumos_by_codigos(mock_db, codigos=[1, 2], **args)
+
+    assert result == {1: {"codigo": 1, "descricao": "Cimento"}, 2: {"codigo": 2, "descricao": "Areia"}}
+    stored = [c.args[0] for c in mock_redis.pipeline.return_value.set.call_args_list]
+    assert stored == [crud.get_insumo_by_codigo.cache_key(mock_db, codigo=2, **args)]
+
+def test_search_falls_back_to_ilike_without_trigram_extension(mock_db):
+    """Sem pg_trgm/unaccent no banco, a busca ranqueada cai para o ILIKE."""
+    from sqlalchemy.exc import ProgrammingError
+    ilike_result = MagicMock()
+    ilike_result.fetchall.return_value = [Mock(_mapping={"codigo": 1, "descricao": "AREIA"})]
+    mock_db.execute.side_effect = [ProgrammingError("SELECT", {}, Exception("function f_unaccent does not exist")), ilike_result]
+
+    result = crud.search_insumos_by_descricao(mock_db, "areia", "SP", "2025-01", "DESONERADO", 0, 10)
+
+    assert result == [{"codigo": 1, "descricao": "AREIA"}]
+    assert "word_similarity" in str(mock_db.execute.call_args_list[0][0][0])
+    assert "ILIKE" in str(mock_db.execute.call_args_list[1][0][0])
+    mock_db.rollback.assert_called_once()
+
+def test_search_rowmapping_result_roundtrips_through_redis(mock_db, mock_redis):
+    """Busca que retorna RowMapping é gravada no Redis, relida dele e contada no namespace."""
+    from sqlalchemy import create_engine, text
+    with create_engine("sqlite://").connect() as conn:
+        rows = conn.execute(text("SELECT 7 AS codigo, 'CIMENTO CP II' AS descricao, 41.5 AS preco_mediano")).fetchall()
+    mock_db.execute.return_value.fetchall.return_value = rows
+
+    store, sizes = {}, {}
+    mock_redis.get.side_effect = store.get
+    mock_redis.set.side_effect = lambda key, value, **kwargs: store.__setitem__(key, value) or True
+
+    def record(script, numkeys, keys_key, sizes_key, bytes_key, key, size, expire):
+        sizes[key] = size
+        return sum(sizes.values())
+    mock_redis.eval.side_effect = record
+
+    args = ("cimento", "SP", "2025-01", "DESONERADO", 0, 10)
+    expected = [{"codigo": 7, "descricao": "CIMENTO CP II", "preco_mediano": 41.5}]
+    assert crud.search_insumos_by_descricao(mock_db, *args) == expected
+    assert crud.search_insumos_by_descricao(mock_db, *args) == expected  # admitido na 2ª vez
+    key = crud.search_insumos_by_descricao.cache_key(mock_db, *args)
+    assert key in store
+
+    cache_utils.local_cache.clear()  # força a leitura do Redis
+    calls = mock_db.execute.call_count
+    assert crud.search_insumos_by_descricao(mock_db, *args) == expected
+    assert mock_db.execute.call_count == calls
+
+    mock_redis.pipeline.return_value.execute.return_value = [len(sizes), sum(sizes.values())]
+    assert cache_utils.get_namespace_stats()["search"]["bytes"] == len(store[key])
+
+def test_search_facets_come_from_one_grouping_sets_query(mock_db):
+    """Facetas por classificação, unidade e faixa de preço em uma única query."""
+    def row(categoria=None, unidade=None, faixa=None, sem=(1, 1, 1), total=0):
+        return Mock(categoria=categoria, unidade=unidade, faixa=faixa,
+                    sem_categoria=sem[0], sem_unidade=sem[1], sem_faixa=sem[2], total=total)
+    mock_db.execute.return_value.fetchall.return_value = [
+        row(total=7),
+        row(categoria="AGREGADOS", sem=(0, 1, 1), total=5),
+        row(categoria="CIMENTO", sem=(0, 1, 1), total=2),
+        row(unidade="M3", sem=(1, 0, 1), total=7),
+        row(faixa=6, sem=(1, 1, 0), total=1),
+        row(faixa=0, sem=(1, 1, 0), total=6),
+    ]
+
+    facetas = crud.get_insumo_search_facets(mock_db, "areia", "SP", "2025-01", "DESONERADO")
+
+    assert mock_db.execute.call_count == 1
+    assert "GROUPING SETS" in str(mock_db.execute.call_args[0][0])
+    assert facetas["total"] == 7
+    assert facetas["classificacao"][0] == {"valor": "AGREGADOS", "total": 5}
+    assert facetas["unidade"] == [{"valor": "M3", "total": 7}]
+    assert facetas["faixa_preco"] == [{"valor": "ate 10", "total": 6}, {"valor": "acima de 5000", "total": 1}]
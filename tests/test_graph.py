@@ -0,0 +1,88 @@
+"""
+Testes do grafo de composições em memória (api.graph).
+"""
+import pytest
+
+from api.graph import CompositionGraph, CompositionCycleError
+
+# 1 -> 2 (x2), 1 -> insumo 100 (x1); 2 -> insumo 100 (x3), 2 -> insumo 200 (x0.5, mão de obra)
+# 3 -> 1 (x1) e 3 -> 2 (x1): o insumo 100 chega a 3 por três caminhos
+EDGES = [
+    (1, 2, "COMPOSICAO", 2),
+    (1, 100, "INSUMO", 1),
+    (2, 100, "INSUMO", 3),
+    (2, 200, "INSUMO", 0.5),
+    (3, 1, "COMPOSICAO", 1),
+    (3, 2, "COMPOSICAO", 1),
+]
+
+
+@pytest.fixture
+def graph():
+    return CompositionGraph(EDGES, descricoes={1: "A", 2: "B", 3: "C"}, unidades={100: "KG", 200: "H"})
+
+
+def _as_dict(bom):
+    return {(tipo, codigo): (round(coef, 6), nivel) for tipo, codigo, coef, nivel in bom}
+
+
+def test_explode_accumulates_coefficients_over_all_paths(graph):
+    bom = _as_dict(graph.explode(3))
+    assert bom[("COMPOSICAO", 1)] == (1.0, 1)
+    assert bom[("COMPOSICAO", 2)] == (3.0, 1)            # 1 + 1*2
+    assert bom[("INSUMO", 100)] == (10.0, 2)             # 1*1 + 1*3 + 1*2*3
+    assert bom[("INSUMO", 200)] == (1.5, 2)
+
+
+def test_man_hours_sums_labor_inputs(graph):
+    assert graph.man_hours(1) == pytest.approx(1.0)
+    assert graph.man_hours(999) == 0.0
+
+
+def test_where_used_walks_reverse_graph(graph):
+    usos = {codigo: (round(coef, 6), nivel) for codigo, coef, nivel in graph.where_used("INSUMO", 200)}
+    assert usos == {2: (0.5, 1), 1: (1.0, 2), 3: (1.5, 2)}
+
+
+def test_depth_is_reported(graph):
+    report = graph.diagnostics()
+    assert report["profundidade_maxima"] == 3
+    assert report["em_ciclo"] == []
+
+
+def test_cycles_are_detected_and_not_truncated():
+    graph = CompositionGraph(EDGES + [(2, 3, "COMPOSICAO", 1)], descricoes={1: "A", 2: "B", 3: "C"})
+    assert graph.diagnostics()["em_ciclo"] == [1, 2, 3]
+    with pytest.raises(CompositionCycleError):
+        graph.explode(3)
+    with pytest.raises(CompositionCycleError):
+        graph.where_used("INSUMO", 100)
+
+
+def test_deep_structures_are_listed(monkeypatch):
+    from api.graph import settings
+    monkeypatch.setattr(settings, "BOM_MAX_DEPTH", 2)
+    graph = CompositionGraph(EDGES)
+    assert graph.diagnostics()["acima_do_limite"] == [3]
+    assert len(graph.explode(3)) == 4
+
+
+def test_price_deltas_propagate_through_ancestors_only(graph):
+    codigos, variacoes = graph.propagate_price_deltas({200: 2.0})
+    assert dict(zip(codigos.tolist(), variacoes.round(6).tolist())) == {1: 2.0, 2: 1.0, 3: 3.0}
+    codigos, _ = graph.propagate_price_deltas({999: 1.0})
+    assert codigos.size == 0
+
+
+def test_price_deltas_match_full_explosion(graph):
+    deltas = {100: 1.5, 200: -4.0}
+    codigos, variacoes = graph.propagate_price_deltas(deltas)
+    for codigo, variacao in zip(codigos.tolist(), variacoes.tolist()):
+        esperado = sum(coef * deltas.get(item, 0) for tipo, item, coef, _ in graph.explode(codigo) if tipo == "INSUMO")
+        assert variacao == pytest.approx(esperado)
+
+
+def test_price_deltas_reaching_a_cycle_raise():
+    graph = CompositionGraph(EDGES + [(2, 3, "COMPOSICAO", 1)])
+    with pytest.raises(CompositionCycleError):
+        graph.propagate_price_deltas({100: 1.0})
@@ -0,0 +1,241 @@
+"""
+Testes do cache HTTP da API pública (ETag / Last-Modified / 304 e cache de resposta).
+Usa uma aplicação FastAPI mínima com os middlewares de `api.http_cache`.
+"""
+from typing import List
+from unittest.mock import MagicMock, patch
+import pytest
+from fastapi import Body, FastAPI, Response
+from fastapi.testclient import TestClient
+
+from api import http_cache, cache_utils
+
+
+@pytest.fixture
+def calls():
+    return []
+
+
+@pytest.fixture
+def client(calls):
+    app = FastAPI()
+    app.middleware("http")(http_cache.response_cache)
+    app.middleware("http")(http_cache.conditional_requests)
+
+    @app.get("/api/v1/public/insumos/{codigo}")
+    def read_insumo(codigo: int, data_referencia: str = None):
+        calls.append(codigo)
+        return {"codigo": codigo}
+
+    @app.get("/api/v1/public/bi/composicao/{codigo}/bom")
+    @http_cache.cached_response(popularity="composicao")
+    def read_bom(codigo: int, uf: str = "SP"):
+        calls.append(("bom", codigo, uf))
+        return [{"item_codigo": i, "descricao": "ITEM DE TESTE " * 10} for i in range(50)]
+
+    @app.post("/api/v1/public/bi/curva-abc")
+    @http_cache.cached_response()
+    def abc(codigos: List[int] = Body(...)):
+        calls.append(("abc", tuple(codigos)))
+        return [{"codigo": c} for c in codigos]
+
+    @app.get("/api/v1/public/health")
+    def health():
+        return {"status": "healthy"}
+
+    return TestClient(app)
+
+
+@pytest.fixture(autouse=True)
+def fake_redis():
+    """Redis em memória suficiente para o cache de resposta."""
+    store = {}
+    redis = MagicMock()
+    redis.mget.side_effect = lambda keys: [store.get(k) for k in keys]
+    pipe = redis.pipeline.return_value
+    pipe.set.side_effect = lambda key, value, ex=None: store.__setitem__(key, value)
+    cache_utils.local_cache.clear()
+    with patch("api.http_cache.redis_client", redis), patch("api.http_cache.track_popularity") as track:
+        redis.track_popularity = track
+        yield redis
+    cache_utils.local_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def generation():
+    state = {"value": (3, 1_700_000_000.0)}
+    with patch("api.http_cache.get_generation_state", side_effect=lambda: state["value"]):
+        yield state
+
+
+@pytest.fixture(autouse=True)
+def latest_month():
+    with patch("api.http_cache.get_latest_reference_month", return_value="2025-06") as latest:
+        yield latest
+
+
+def test_response_has_validators(client):
+    response = client.get("/api/v1/public/insumos/1?data_referencia=2020-01")
+    assert response.status_code == 200
+    assert response.headers["ETag"].startswith('"')
+    assert "Last-Modified" in response.headers
+    assert response.headers["Cache-Control"].endswith("max-age=86400")
+
+
+def test_closed_month_follows_latest_loaded_month(client):
+    """Fechado é o mês anterior ao último carregado pelo ETL, não ao mês do calendário."""
+    latest = client.get("/api/v1/public/insumos/1?data_referencia=2025-06")
+    previous = client.get("/api/v1/public/insumos/1?data_referencia=2025-05")
+    assert latest.headers["Cache-Control"].endswith("max-age=300")
+    assert previous.headers["Cache-Control"].endswith("max-age=86400")
+
+
+def test_if_none_match_returns_304_without_running_route(client, calls):
+    etag = client.get("/api/v1/public/insumos/1").headers["ETag"]
+    response = client.get("/api/v1/public/insumos/1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert calls == [1]
+
+
+def test_if_none_match_wildcard_runs_route(client, calls):
+    response = client.get("/api/v1/public/insumos/1", headers={"If-None-Match": "*"})
+    assert response.status_code == 200
+    assert calls == [1]
+
+
+def test_unknown_generation_skips_validators_and_response_cache(client, calls, generation):
+    generation["value"] = (None, None)
+    for _ in range(2):
+        response = client.get("/api/v1/public/bi/composicao/13/bom", headers={"If-None-Match": "*"})
+        assert response.status_code == 200
+        assert "ETag" not in response.headers and "X-Cache" not in response.headers
+    assert calls == [("bom", 13, "SP")] * 2
+
+
+def test_redis_backed_lookups_run_off_the_event_loop(client, generation, latest_month):
+    """Geração e último mês carregado (que podem ir ao Redis) não rodam no event loop."""
+    import asyncio
+
+    def in_event_loop():
+        try:
+            asyncio.get_running_loop()
+            return True
+        except RuntimeError:
+            return False
+
+    seen = []
+    state = generation["value"]
+    with patch("api.http_cache.get_generation_state", side_effect=lambda: seen.append(in_event_loop()) or state):
+        latest_month.side_effect = lambda: seen.append(in_event_loop()) or "2025-06"
+        client.get("/api/v1/public/bi/composicao/14/bom?data_referencia=2025-01")
+    assert len(seen) == 3 and not any(seen)
+
+
+def test_etag_changes_with_generation(client, generation):
+    etag = client.get("/api/v1/public/insumos/1").headers["ETag"]
+    generation["value"] = (4, 1_700_000_100.0)
+    response = client.get("/api/v1/public/insumos/1", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_etag_ignores_query_order(client):
+    a = client.get("/api/v1/public/insumos/1?data_referencia=2025-01&x=1").headers["ETag"]
+    b = client.get("/api/v1/public/insumos/1?x=1&data_referencia=2025-01").headers["ETag"]
+    assert a == b
+
+
+def test_if_modified_since(client):
+    last_modified = client.get("/api/v1/public/insumos/1").headers["Last-Modified"]
+    response = client.get("/api/v1/public/insumos/1", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+
+
+def test_health_is_not_cached(client):
+    response = client.get("/api/v1/public/health")
+    assert "ETag" not in response.headers
+
+
+def test_response_cache_skips_route_on_hit(client, calls, fake_redis):
+    first = client.get("/api/v1/public/bi/composicao/10/bom?uf=SP")
+    cache_utils.local_cache.clear()  # força a leitura do Redis
+    second = client.get("/api/v1/public/bi/composicao/10/bom?uf=SP")
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.json() == first.json()
+    assert calls == [("bom", 10, "SP")]
+    fake_redis.track_popularity.assert_called_once_with("composicao", 10)
+
+
+def test_response_cache_serves_gzip_variant(client):
+    client.get("/api/v1/public/bi/composicao/11/bom")
+    response = client.get("/api/v1/public/bi/composicao/11/bom", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["X-Cache"] == "HIT"
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(response.json()) == 50
+
+
+def test_gzip_variant_has_its_own_etag_and_all_variants_vary(client):
+    miss = client.get("/api/v1/public/bi/composicao/12/bom")
+    identity = client.get("/api/v1/public/bi/composicao/12/bom", headers={"Accept-Encoding": "identity"})
+    gzipped = client.get("/api/v1/public/bi/composicao/12/bom", headers={"Accept-Encoding": "gzip"})
+    assert (miss.headers["X-Cache"], identity.headers["X-Cache"], gzipped.headers["X-Cache"]) == ("MISS", "HIT", "HIT")
+    assert "Content-Encoding" not in identity.headers and gzipped.headers["Content-Encoding"] == "gzip"
+    assert miss.headers["Vary"] == identity.headers["Vary"] == gzipped.headers["Vary"] == "Accept-Encoding"
+    assert miss.headers["ETag"] == identity.headers["ETag"]
+    assert gzipped.headers["ETag"] == http_cache.gzip_etag(identity.headers["ETag"])
+    # O validador de cada variante revalida a própria variante
+    revalidated = client.get("/api/v1/public/bi/composicao/12/bom",
+                             headers={"Accept-Encoding": "gzip", "If-None-Match": gzipped.headers["ETag"]})
+    assert revalidated.status_code == 304
+    assert revalidated.headers["ETag"] == gzipped.headers["ETag"]
+    assert revalidated.headers["Vary"] == "Accept-Encoding"
+
+
+def test_response_cache_keys_on_body(client, calls):
+    client.post("/api/v1/public/bi/curva-abc", json=[1, 2])
+    client.post("/api/v1/public/bi/curva-abc", json=[1, 2])
+    client.post("/api/v1/public/bi/curva-abc", json=[3])
+    assert calls == [("abc", (1, 2)), ("abc", (3,))]
+
+
+def test_response_cache_ignores_unmarked_routes(client, calls):
+    client.get("/api/v1/public/insumos/5")
+    client.get("/api/v1/public/insumos/5")
+    assert calls == [5, 5]
+
+
+def test_purge_gateway_cache_calls_kong_admin():
+    response = MagicMock(status=204)
+    response.__enter__.return_value = response
+    with patch("api.http_cache.urllib.request.urlopen", return_value=response) as urlopen:
+        assert http_cache.purge_gateway_cache("SP", "2025-09") is True
+    request = urlopen.call_args.args[0]
+    assert request.get_method() == "DELETE"
+    assert request.full_url.endswith("/proxy-cache")
+
+
+def test_purge_gateway_cache_tolerates_unreachable_kong():
+    with patch("api.http_cache.urllib.request.urlopen", side_effect=OSError("connection refused")):
+        assert http_cache.purge_gateway_cache("SP", "2025-09") is False
+
+
+def test_cached_response_keeps_next_cursor_header():
+    app = FastAPI()
+    app.middleware("http")(http_cache.response_cache)
+    calls = []
+
+    @app.get("/api/v1/public/insumos")
+    @http_cache.cached_response()
+    def search(response: Response, cursor: str = None):
+        calls.append(cursor)
+        response.headers["X-Next-Cursor"] = "abc"
+        return [{"codigo": 1}]
+
+    client = TestClient(app)
+    first = client.get("/api/v1/public/insumos?cursor=")
+    second = client.get("/api/v1/public/insumos?cursor=")
+    assert second.headers["X-Cache"] == "HIT"
+    assert first.headers["X-Next-Cursor"] == second.headers["X-Next-Cursor"] == "abc"
+    assert calls == [""]
@@ -0,0 +1,71 @@
+"""
+Testes da reconstrução incremental do fechamento transitivo das composições.
+O banco é mockado: os testes verificam quais composições são recalculadas.
+"""
+from unittest.mock import MagicMock
+import pytest
+
+from api import maintenance
+
+
+def _statements(db):
+    return [" ".join(str(c.args[0]).split()) for c in db.execute.call_args_list]
+
+
+@pytest.fixture
+def db():
+    return MagicMock()
+
+
+def test_nothing_changed_skips_rebuild(db, monkeypatch):
+    monkeypatch.setattr(maintenance, "_changed_composicoes", lambda db: [])
+    summary = maintenance.rebuild_composicao_fechamento(db)
+    assert summary["recalculadas"] == 0
+    assert not any(s.startswith("DELETE") for s in _statements(db))
+    db.commit.assert_called_once()
+
+
+def test_changed_composicao_recalculates_its_ancestors(db, monkeypatch):
+    monkeypatch.setattr(maintenance, "_changed_composicoes", lambda db: [10])
+    db.execute.return_value.scalars.return_value.all.return_value = [1, 2]
+    db.execute.return_value.rowcount = 7
+
+    summary = maintenance.rebuild_composicao_fechamento(db)
+
+    assert summary == {"alteradas": 1, "recalculadas": 3, "linhas": 7, "segundos": summary["segundos"]}
+    delete_call = next(c for c in db.execute.call_args_list if str(c.args[0]).startswith("DELETE FROM composicao_fechamento "))
+    assert delete_call.args[1] == {"codigos": [1, 2, 10]}
+    assert any("WITH RECURSIVE" in s for s in _statements(db))
+
+
+def test_full_rebuild_truncates_first(db, monkeypatch):
+    monkeypatch.setattr(maintenance, "_changed_composicoes", lambda db: [])
+    maintenance.rebuild_composicao_fechamento(db, full=True)
+    assert _statements(db)[0] == "TRUNCATE composicao_fechamento, composicao_fechamento_estado"
+
+
+def test_month_partitions_are_ensured_for_both_price_tables(db):
+    db.execute.return_value.scalar.side_effect = ["precos_insumos_mensal_2025_09", None]
+    partitions = maintenance.ensure_month_partitions(db, "2025-09")
+    assert partitions == ["precos_insumos_mensal_2025_09"]
+    assert [c.args[1] for c in db.execute.call_args_list] == [
+        {"tabela": "precos_insumos_mensal", "mes": "2025-09-01"},
+        {"tabela": "custos_composicoes_mensal", "mes": "2025-09-01"},
+    ]
+    db.commit.assert_called_once()
+
+
+def test_cubo_refresh_recomputes_the_whole_month_for_both_item_types(db):
+    db.execute.return_value.rowcount = 4
+    summary = maintenance.refresh_cubo_precos(db, "2025-09")
+
+    statements = _statements(db)
+    assert statements[0] == (
+        "DELETE FROM cubo_precos_mensal WHERE data_referencia >= :start_date AND data_referencia <= :end_date"
+    )
+    inserts = [c for c in db.execute.call_args_list if str(c.args[0]).lstrip().startswith("INSERT")]
+    assert [c.args[1]["tipo_item"] for c in inserts] == ["INSUMO", "COMPOSICAO"]
+    assert all("GROUPING SETS ((r.regiao, p.uf), (r.regiao), ())" in str(c.args[0]) for c in inserts)
+    assert len(inserts[0].args[1]["ufs"]) == len(inserts[0].args[1]["regioes"]) == 27
+    assert summary["linhas"] == 8
+    db.commit.assert_called_once()
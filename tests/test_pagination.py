@@ -0,0 +1,76 @@
+"""
+Testes da paginação por cursor (api.pagination) e do seek nas buscas.
+"""
+from unittest.mock import MagicMock, Mock, patch
+
+import pytest
+
+from api import crud, cache_utils
+from api.pagination import encode_cursor, decode_cursor, next_cursor
+
+
+def test_cursor_round_trip_with_accents():
+    cursor = encode_cursor("AREIA MÉDIA - POSTO JAZIDA", 370)
+    assert "=" not in cursor
+    assert decode_cursor(cursor, 2) == ["AREIA MÉDIA - POSTO JAZIDA", 370]
+
+
+def test_empty_cursor_is_first_page_and_garbage_is_rejected():
+    assert decode_cursor("", 2) is None
+    with pytest.raises(ValueError):
+        decode_cursor("não-é-um-cursor", 2)
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor("A"), 2)
+
+
+def test_next_cursor_only_for_full_pages():
+    rows = [{"descricao": "A", "codigo": 1}, {"descricao": "B", "codigo": 2}]
+    assert decode_cursor(next_cursor(rows, 2, "descricao", "codigo"), 2) == ["B", 2]
+    assert next_cursor(rows, 3, "descricao", "codigo") is None
+
+
+@pytest.fixture
+def db():
+    with patch("api.cache_utils.redis_client") as redis:
+        redis.get.return_value = None
+        redis.mget.return_value = [None, None]
+        redis.zrange.return_value = []
+        cache_utils.local_cache.clear()
+        session = MagicMock()
+        session.execute.return_value.fetchall.return_value = [Mock(_mapping={"codigo": 9})]
+        yield session
+        cache_utils.local_cache.clear()
+
+
+def test_cursor_search_seeks_instead_of_offset(db):
+    cursor = encode_cursor("AREIA FINA", 367)
+    crud.search_insumos_by_descricao(db, "areia", "SP", "2025-01", "DESONERADO", 0, 50, cursor=cursor)
+    sql, params = str(db.execute.call_args[0][0]), db.execute.call_args[0][1]
+    assert "(i.descricao, i.codigo) > (:after_descricao, :after_codigo)" in sql
+    assert "OFFSET" not in sql and "relevancia DESC" not in sql
+    assert (params["after_descricao"], params["after_codigo"]) == ("AREIA FINA", 367)
+
+
+def test_offset_search_is_unchanged_without_cursor(db):
+    crud.search_composicoes_by_descricao(db, "alvenaria", "SP", "2025-01", "DESONERADO", 100, 50)
+    sql = str(db.execute.call_args[0][0])
+    assert "OFFSET :skip LIMIT :limit" in sql and "after_descricao" not in sql
+
+
+def test_audit_events_use_generated_columns_and_seek(db):
+    cursor = encode_cursor("2025-09-10 12:00:00.123456+00:00", 41)
+    crud.get_audit_events(db, "composicao", 92711, data_referencia="2025-09", limit=20, cursor=cursor)
+    sql, params = " ".join(str(db.execute.call_args[0][0]).split()), db.execute.call_args[0][1]
+    assert "WHERE tipo_item = :tipo_item AND item_codigo = :codigo AND data_referencia = :data_referencia" in sql
+    assert "(created_at, id) < (CAST(:after_created_at AS timestamptz), :after_id)" in sql
+    assert "record_pk->>" not in sql and "ORDER BY created_at DESC, id DESC LIMIT :limit" in sql
+    assert (params["tipo_item"], params["after_created_at"], params["after_id"]) == (
+        "COMPOSICAO", "2025-09-10 12:00:00.123456+00:00", 41
+    )
+    assert str(params["data_referencia"]) == "2025-09-01"
+    # Linhas de estrutura da composição entram por um segundo ramo, com os mesmos filtros
+    assert "UNION ALL" in sql and "WHERE composicao_codigo = :codigo AND data_referencia = :data_referencia" in sql
+
+    crud.get_audit_events(db, "insumo", 370)
+    sql = " ".join(str(db.execute.call_args[0][0]).split())
+    assert "composicao_codigo" not in sql and "UNION ALL" not in sql
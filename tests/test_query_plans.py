@@ -0,0 +1,347 @@
+"""
+Regressão dos planos de execução das consultas de `api.crud`.
+
+Cada função de `crud` é executada contra um PostgreSQL local com uma massa
+sintética; as consultas que ela envia ao banco são capturadas e passam por
+`EXPLAIN`. O teste falha se aparecer leitura sequencial nas tabelas quentes
+(preços, custos, estrutura e fechamento das composições) ou ordenação
+grande (Sort) sobre elas. Conta como leitura sequencial tanto o Seq Scan
+quanto a varredura de um índice inteiro, sem condição na sua primeira coluna.
+
+O banco precisa estar migrado (`alembic upgrade head`) e é informado em
+PLAN_TEST_DATABASE_URL; sem ela a suíte é ignorada. A massa é inserida numa
+transação desfeita ao final, então o banco pode ter outros dados.
+
+    PLAN_TEST_DATABASE_URL=postgresql+psycopg2://postgres@localhost:5432/sinapi_plan pytest tests/test_query_plans.py
+"""
+import os
+import re
+import json
+
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import Session
+
+from api import crud, maintenance
+from api.config import settings
+from api.pagination import encode_cursor
+
+PLAN_TEST_DATABASE_URL = os.getenv("PLAN_TEST_DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(
+    not PLAN_TEST_DATABASE_URL, reason="PLAN_TEST_DATABASE_URL não definida (PostgreSQL migrado para os testes de plano)"
+)
+
+# Tabelas (e suas partições) em que leitura sequencial ou Sort grande reprovam o plano
+HOT_TABLES = (
+    "precos_insumos_mensal",
+    "custos_composicoes_mensal",
+    "composicao_insumos",
+    "composicao_subcomposicoes",
+    "composicao_fechamento",
+    "cubo_precos_mensal",
+    "sinapi_audit_log",
+)
+# Acima disso (linhas estimadas) uma ordenação alimentada por tabela quente é "grande"
+MAX_SORT_ROWS = 1000
+
+# Massa sintética: códigos altos para não colidir com dados já carregados
+BASE = 9_000_000
+N_INSUMOS = 2000
+N_COMPOSICOES = 500
+UFS = ["SP", "RJ", "MG", "BA", "DF"]
+REGIMES = ["NAO_DESONERADO", "DESONERADO"]
+MESES = ["2025-01", "2025-02", "2025-03"]
+
+UF, REGIME, MES = "SP", "NAO_DESONERADO", "2025-03"
+INSUMO = BASE + 7
+COMPOSICAO = BASE + 100_000 + 400
+
+
+def _seed(db: Session) -> None:
+    # Colunas criadas pela carga do toolkit e lidas por `crud`, ausentes das migrações
+    db.execute(text(f"ALTER TABLE {settings.TABLE_PRECOS_INSUMOS} ADD COLUMN IF NOT EXISTS origem_preco VARCHAR(50)"))
+    db.execute(text(f"ALTER TABLE {settings.TABLE_CUSTOS_COMPOSICOES} ADD COLUMN IF NOT EXISTS percentual_mo NUMERIC"))
+    for mes in MESES:
+        maintenance.ensure_month_partitions(db, mes)
+
+    params = {
+        "base": BASE, "n_insumos": N_INSUMOS, "n_composicoes": N_COMPOSICOES,
+        "ufs": UFS, "regimes": REGIMES, "meses": [f"{mes}-01" for mes in MESES],
+    }
+    db.execute(text(f"""
+        INSERT INTO {settings.TABLE_INSUMOS} (codigo, descricao, unidade, classificacao, status)
+        SELECT :base + g,
+               (ARRAY['CIMENTO PORTLAND', 'AREIA MEDIA', 'TIJOLO CERAMICO', 'SERVENTE DE OBRAS', 'BETONEIRA'])[g % 5 + 1] || ' TIPO ' || g,
+               (ARRAY['KG', 'M3', 'UN', 'H', 'CHP'])[g % 5 + 1],
+               'CLASSE ' || (g % 20), 'ATIVO'
+        FROM generate_series(1, :n_insumos) AS g
+    """), params)
+    db.execute(text(f"""
+        INSERT INTO {settings.TABLE_COMPOSICOES} (codigo, descricao, unidade, grupo, status)
+        SELECT :base + 100000 + g, 'ALVENARIA DE VEDACAO TIPO ' || g, 'M2', 'GRUPO ' || (g % 10), 'ATIVO'
+        FROM generate_series(1, :n_composicoes) AS g
+    """), params)
+    db.execute(text(f"""
+        INSERT INTO {settings.TABLE_PRECOS_INSUMOS} (insumo_codigo, uf, data_referencia, regime, preco_mediano, origem_preco)
+        SELECT :base + g, uf, CAST(mes AS date), regime, 1 + (g * 37 % 500), 'SINAPI'
+        FROM generate_series(1, :n_insumos) AS g, unnest(CAST(:ufs AS text[])) AS uf,
+             unnest(CAST(:regimes AS text[])) AS regime, unnest(CAST(:meses AS text[])) AS mes
+    """), params)
+    db.execute(text(f"""
+        INSERT INTO {settings.TABLE_CUSTOS_COMPOSICOES} (composicao_codigo, uf, data_referencia, regime, custo_total, percentual_mo)
+        SELECT :base + 100000 + g, uf, CAST(mes AS date), regime, 10 + (g * 53 % 900), 40
+        FROM generate_series(1, :n_composicoes) AS g, unnest(CAST(:ufs AS text[])) AS uf,
+             unnest(CAST(:regimes AS text[])) AS regime, unnest(CAST(:meses AS text[])) AS mes
+    """), params)
+    # Dez insumos por composição; as pares a partir de 10 contêm a de metade do número
+    db.execute(text("""
+        INSERT INTO composicao_insumos (composicao_pai_codigo, insumo_filho_codigo, coeficiente)
+        SELECT :base + 100000 + g, :base + 1 + (g * 7 + k * 131) % :n_insumos, 0.5 + k
+        FROM generate_series(1, :n_composicoes) AS g, generate_series(0, 9) AS k
+    """), params)
+    db.execute(text("""
+        INSERT INTO composicao_subcomposicoes (composicao_pai_codigo, composicao_filho_codigo, coeficiente)
+        SELECT :base + 100000 + g, :base + 100000 + g / 2, 1.5
+        FROM generate_series(10, :n_composicoes, 2) AS g
+    """), params)
+    db.execute(text("""
+        INSERT INTO sinapi_audit_log (table_name, record_pk, operation, new_values)
+        SELECT 'precos_insumos_mensal',
+               jsonb_build_object('insumo_codigo', (:base + g % :n_insumos)::text, 'uf', 'SP',
+                                  'data_referencia', mes, 'regime', 'NAO_DESONERADO'),
+               'UPDATE', '{}'::jsonb
+        FROM generate_series(1, 3 * :n_insumos) AS g, unnest(CAST(:meses AS text[])) AS mes
+    """), params)
+    # Alterações de estrutura: o record_pk traz a composição e o insumo
+    db.execute(text("""
+        INSERT INTO sinapi_audit_log (table_name, record_pk, operation, new_values)
+        SELECT 'composicao_insumos',
+               jsonb_build_object('composicao_codigo', (:base + 100000 + g % :n_composicoes)::text,
+                                  'insumo_codigo', (:base + g % :n_insumos)::text),
+               'UPDATE', '{}'::jsonb
+        FROM generate_series(1, 4 * :n_composicoes) AS g
+    """), params)
+    maintenance.rebuild_composicao_fechamento(db)
+    for mes in MESES:
+        maintenance.refresh_cubo_precos(db, mes)
+    for table in (settings.TABLE_INSUMOS, settings.TABLE_COMPOSICOES, settings.TABLE_PRECOS_INSUMOS,
+                  settings.TABLE_CUSTOS_COMPOSICOES, "composicao_insumos", "composicao_subcomposicoes",
+                  settings.TABLE_COMPOSICAO_FECHAMENTO, settings.TABLE_CUBO_PRECOS, "sinapi_audit_log"):
+        db.execute(text(f"ANALYZE {table}"))
+
+
+@pytest.fixture(scope="module")
+def plan_db():
+    """
+    Sessão sobre uma transação com a massa sintética, desfeita ao final. Os
+    `commit` de `crud`/`maintenance` viram savepoints. Yields `(db, capturadas)`,
+    com as consultas enviadas ao driver enquanto a captura está ativa.
+    """
+    engine = create_engine(PLAN_TEST_DATABASE_URL)
+    connection = engine.connect()
+    transaction = connection.begin()
+    db = Session(bind=connection, join_transaction_mode="create_savepoint")
+    captured = []
+
+    @event.listens_for(connection, "before_cursor_execute")
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if captured is not None and not executemany and statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            captured.append((statement, parameters))
+
+    try:
+        _seed(db)
+        # Seq Scan só sobra no plano se nenhum índice atende a consulta
+        db.execute(text("SET LOCAL enable_seqscan = off"))
+        captured.clear()
+        yield db, captured
+    finally:
+        db.close()
+        transaction.rollback()
+        connection.close()
+        engine.dispose()
+
+
+def _nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _nodes(child)
+
+
+def _is_hot(relation) -> bool:
+    return bool(relation) and relation.startswith(HOT_TABLES)
+
+
+def _leading_columns(db: Session) -> dict:
+    """Primeira coluna de cada índice (`None` quando é uma expressão)."""
+    rows = db.execute(text("""
+        SELECT ic.relname, a.attname
+        FROM pg_index x
+        JOIN pg_class ic ON ic.oid = x.indexrelid
+        LEFT JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = x.indkey[0]
+    """)).fetchall()
+    return dict(rows)
+
+
+def _plan_problems(plan: dict, leading: dict, full_index_ok: bool = False) -> list:
+    """
+    Leituras sequenciais e Sorts grandes sobre as tabelas quentes em um plano
+    de `EXPLAIN (FORMAT JSON)`. Com `full_index_ok`, a varredura de um índice
+    inteiro é aceita.
+    """
+    problems = []
+    for node in _nodes(plan):
+        relation = node.get("Relation Name")
+        if node["Node Type"] == "Seq Scan" and _is_hot(relation):
+            problems.append(f"Seq Scan em {relation}")
+        elif node["Node Type"] in ("Index Scan", "Index Only Scan") and _is_hot(relation) and not full_index_ok:
+            column = leading.get(node["Index Name"])
+            if column and not re.search(rf"\b{column}\b", node.get("Index Cond", "")):
+                problems.append(f"{node['Node Type']} de todo o índice {node['Index Name']} (sem condição em {column})")
+        elif node["Node Type"] in ("Sort", "Incremental Sort") and node.get("Plan Rows", 0) > MAX_SORT_ROWS:
+            hot = sorted({n["Relation Name"] for n in _nodes(node) if _is_hot(n.get("Relation Name"))})
+            if hot:
+                problems.append(f"{node['Node Type']} de ~{node['Plan Rows']} linhas sobre {', '.join(hot)}")
+    return problems
+
+
+def _explain(db: Session, statement: str, parameters) -> dict:
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        document = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    if isinstance(document, str):
+        document = json.loads(document)
+    return document[0]["Plan"]
+
+
+FATIA = {"uf": UF, "data_referencia": MES, "regime": REGIME}
+CODIGOS_INSUMOS = [BASE + g for g in range(1, 200, 3)]
+CODIGOS_COMPOSICOES = [BASE + 100_000 + g for g in range(300, 500, 7)]
+
+# Contagens e valores distintos da tabela inteira (servidos pelo cache de `lookup`):
+# a leitura de todo o índice é inerente à consulta
+FULL_INDEX_CASES = {"global_stats", "available_filters"}
+# Problemas conhecidos: a suíte passa a cobrá-los quando forem resolvidos (strict)
+KNOWN_PROBLEMS = {}
+
+CASES = {
+    "global_stats": (crud.get_global_stats, {}),
+    "available_filters": (crud.get_available_filters, {}),
+    "insumo_by_codigo": (crud.get_insumo_by_codigo, {"codigo": INSUMO, **FATIA}),
+    "insumos_by_codigos": (crud._fetch_insumos_by_codigos, {"codigos": CODIGOS_INSUMOS, **FATIA}),
+    "search_insumos": (crud.search_insumos_by_descricao, {"q": "cimento", **FATIA, "skip": 0, "limit": 20}),
+    "search_insumos_classificacao": (
+        crud.search_insumos_by_descricao, {"q": "cimento", **FATIA, "skip": 0, "limit": 20, "classificacao": "CLASSE 5"}
+    ),
+    "search_insumos_cursor": (
+        crud.search_insumos_by_descricao,
+        {"q": "cimento", **FATIA, "skip": 0, "limit": 20, "cursor": encode_cursor("CIMENTO PORTLAND TIPO 500", BASE + 500)},
+    ),
+    "insumo_facets": (crud.get_insumo_search_facets, {"q": "cimento", **FATIA}),
+    "composicao_by_codigo": (crud.get_composicao_by_codigo, {"codigo": COMPOSICAO, **FATIA}),
+    "composicoes_by_codigos": (crud._fetch_composicoes_by_codigos, {"codigos": CODIGOS_COMPOSICOES, **FATIA}),
+    "search_composicoes": (crud.search_composicoes_by_descricao, {"q": "alvenaria 40", **FATIA, "skip": 0, "limit": 20}),
+    "search_composicoes_cursor": (
+        crud.search_composicoes_by_descricao,
+        {"q": "alvenaria 40", **FATIA, "skip": 0, "limit": 20, "grupo": "GRUPO 1", "cursor": ""},
+    ),
+    "composicao_facets": (crud.get_composicao_search_facets, {"q": "alvenaria 40", **FATIA}),
+    "composicao_bom": (crud.get_composicao_bom, {"codigo": COMPOSICAO, **FATIA}),
+    "abc_curve": (crud.get_abc_curve_for_composicoes, {"codigos": CODIGOS_COMPOSICOES, **FATIA}),
+    "custo_historico_insumo": (
+        crud.get_custo_historico,
+        {"tipo_item": "insumo", "codigo": INSUMO, "uf": UF, "regime": REGIME, "data_inicio": MESES[0], "data_fim": MES},
+    ),
+    "custo_historico_composicao": (
+        crud.get_custo_historico,
+        {"tipo_item": "composicao", "codigo": COMPOSICAO, "uf": UF, "regime": REGIME, "data_inicio": MESES[0], "data_fim": MES},
+    ),
+    "man_hours": (crud.get_composicao_man_hours, {"codigo": COMPOSICAO}),
+    "manutencoes_historico": (crud.get_manutencoes_historico, {"codigo": INSUMO, "tipo_item": "INSUMO"}),
+    "abc_by_classificacao": (crud.get_abc_by_classificacao, {"codigos": CODIGOS_COMPOSICOES, **FATIA}),
+    "tendencias_classificacao": (crud.get_tendencias, {"uf": UF, "regime": REGIME, "data_referencia": MES, "meses": 2}),
+    "tendencias_grupo": (
+        crud.get_tendencias, {"uf": UF, "regime": REGIME, "data_referencia": MES, "agrupar_por": "grupo", "meses": 2}
+    ),
+    "tendencias_item": (
+        crud.get_tendencias,
+        {"uf": UF, "regime": REGIME, "data_referencia": MES, "agrupar_por": "item", "meses": 2, "codigos": CODIGOS_INSUMOS},
+    ),
+    "drilldown_brasil": (
+        crud.get_cubo_drilldown, {"tipo_item": "insumo", "data_referencia": MES, "regime": REGIME, "meses": 2}
+    ),
+    "drilldown_regiao": (
+        crud.get_cubo_drilldown,
+        {"tipo_item": "composicao", "data_referencia": MES, "regime": REGIME, "nivel": "regiao", "local": "SUDESTE",
+         "categoria": "grupo 1"},
+    ),
+    "drilldown_uf": (
+        crud.get_cubo_drilldown, {"tipo_item": "insumo", "data_referencia": MES, "regime": REGIME, "nivel": "uf", "local": "sp"}
+    ),
+    "precos_all_ufs": (crud.get_precos_all_ufs, {"tipo_item": "insumo", "codigo": INSUMO, "data_referencia": MES, "regime": REGIME}),
+    "custos_all_ufs": (
+        crud.get_precos_all_ufs, {"tipo_item": "composicao", "codigo": COMPOSICAO, "data_referencia": MES, "regime": REGIME}
+    ),
+    "simulacao_precos": (
+        crud.simulate_price_changes,
+        {"alteracoes": [{"codigo": INSUMO, "variacao_percentual": 10}, {"codigo": BASE + 8, "preco": 99}], **FATIA},
+    ),
+    "onde_usado_insumo": (crud.get_onde_usado, {"codigo": INSUMO, "tipo_item": "insumo"}),
+    "onde_usado_composicao": (crud.get_onde_usado, {"codigo": BASE + 100_000 + 100, "tipo_item": "composicao"}),
+    "audit_events": (crud.get_audit_events, {"tipo_item": "insumo", "codigo": INSUMO}),
+    "audit_events_mes_cursor": (
+        crud.get_audit_events,
+        {"tipo_item": "insumo", "codigo": INSUMO, "data_referencia": MES, "limit": 2,
+         "cursor": encode_cursor("2999-01-01 00:00:00+00:00", 0)},
+    ),
+    "audit_events_composicao": (crud.get_audit_events, {"tipo_item": "composicao", "codigo": COMPOSICAO}),
+    "rollup_divergencias": (crud.get_rollup_divergencias, FATIA),
+}
+
+
+@pytest.mark.parametrize("case", [
+    pytest.param(case, marks=pytest.mark.xfail(strict=True, reason=KNOWN_PROBLEMS[case])) if case in KNOWN_PROBLEMS else case
+    for case in CASES
+])
+def test_crud_query_plans_avoid_full_scans_of_hot_tables(plan_db, case, monkeypatch):
+    db, captured = plan_db
+    func, kwargs = CASES[case]
+    # Sem o grafo em memória as funções de BI vão ao banco; o cache é contornado
+    monkeypatch.setattr(settings, "GRAPH_ENGINE_ENABLED", False)
+    captured.clear()
+    getattr(func, "__wrapped__", func)(db, **kwargs)
+    statements = list(captured)
+    assert statements, f"{case}: nenhuma consulta capturada"
+
+    leading = _leading_columns(db)
+    problems = []
+    for statement, parameters in statements:
+        problems += [f"{p}\n{statement.strip()}" for p in _plan_problems(
+            _explain(db, statement, parameters), leading, full_index_ok=case in FULL_INDEX_CASES
+        )]
+    assert not problems, f"{case}:\n" + "\n\n".join(problems)
+
+
+def test_audit_structure_row_is_in_composicao_and_insumo_history(plan_db):
+    """Uma linha de composicao_insumos aparece no histórico da composição e no do insumo."""
+    db, _ = plan_db
+    composicao, insumo = BASE + 100_000 + 499, BASE + 1999
+    db.execute(text("""
+        INSERT INTO sinapi_audit_log (table_name, record_pk, operation, new_values, created_at)
+        VALUES ('composicao_insumos',
+                jsonb_build_object('composicao_codigo', CAST(:composicao AS text), 'insumo_codigo', CAST(:insumo AS text)),
+                'DELETE', '{}'::jsonb, '2999-01-01')
+    """), {"composicao": composicao, "insumo": insumo})
+    get_audit_events = crud.get_audit_events.__wrapped__
+
+    historico_composicao = get_audit_events(db, "composicao", composicao, limit=1)
+    historico_insumo = get_audit_events(db, "insumo", insumo, limit=1)
+
+    assert historico_composicao[0]["id"] == historico_insumo[0]["id"]
+    assert historico_composicao[0]["record_pk"] == {"composicao_codigo": str(composicao), "insumo_codigo": str(insumo)}
+    # As demais linhas da estrutura também entram, sem repetir eventos
+    eventos = get_audit_events(db, "composicao", composicao, limit=100)
+    assert len(eventos) == len({e["id"] for e in eventos}) > 1
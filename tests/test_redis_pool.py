@@ -0,0 +1,66 @@
+"""
+Testes do cliente Redis compartilhado: o disjuntor deve recusar comandos sem
+tocar a rede após falhas seguidas e voltar a fechar quando o Redis responder.
+"""
+from unittest.mock import patch
+import pytest
+import redis
+
+from api import redis_pool
+from api.redis_pool import BreakerRedis, CircuitBreaker, CircuitOpenError
+
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker(failure_threshold=2, reset_timeout=30.0)
+
+
+@pytest.fixture
+def client(breaker):
+    return BreakerRedis(host="localhost", port=1, breaker=breaker)
+
+
+def test_circuit_opens_after_repeated_failures(client, breaker):
+    with patch.object(redis.Redis, "execute_command", side_effect=redis.exceptions.TimeoutError) as execute:
+        for _ in range(2):
+            with pytest.raises(redis.exceptions.TimeoutError):
+                client.get("k")
+        with pytest.raises(CircuitOpenError):
+            client.get("k")
+    assert execute.call_count == 2
+    assert breaker.state == "open"
+
+
+def test_circuit_half_opens_after_cooldown(client, breaker):
+    for _ in range(2):
+        breaker.record_failure()
+    with patch("api.redis_pool.time.monotonic", return_value=10**9), \
+         patch.object(redis.Redis, "execute_command", return_value=b"v") as execute:
+        assert client.get("k") == b"v"
+    execute.assert_called_once()
+    assert breaker.state == "closed"
+
+
+def test_pipeline_goes_through_breaker(client, breaker):
+    for _ in range(2):
+        breaker.record_failure()
+    pipe = client.pipeline(transaction=False)
+    pipe.get("k")
+    with pytest.raises(CircuitOpenError):
+        pipe.execute()
+
+
+def test_non_connection_errors_do_not_trip_the_circuit(client, breaker):
+    with patch.object(redis.Redis, "execute_command", side_effect=redis.exceptions.ResponseError("WRONGTYPE")):
+        for _ in range(3):
+            with pytest.raises(redis.exceptions.ResponseError):
+                client.get("k")
+    assert breaker.state == "closed"
+
+
+def test_shared_client_uses_settings():
+    client = redis_pool.get_redis_client()
+    assert client is redis_pool.get_redis_client()
+    kwargs = client.connection_pool.connection_kwargs
+    assert kwargs["socket_timeout"] == redis_pool.settings.REDIS_SOCKET_TIMEOUT
+    assert kwargs["socket_connect_timeout"] == redis_pool.settings.REDIS_SOCKET_CONNECT_TIMEOUT
@@ -0,0 +1,57 @@
+"""
+Testes do roll-up de custos em lote (api.rollup).
+"""
+import pytest
+
+from api.graph import CompositionGraph
+from api.rollup import compute_rollup, compare_with_official
+
+# 1 -> 2 (x2), 1 -> insumo 100 (x1); 2 -> insumo 100 (x3), 2 -> insumo 200 (x0.5, mão de obra)
+# 3 -> 1 (x1), 3 -> 2 (x1), 3 -> insumo 300 (x4, equipamento)
+EDGES = [
+    (1, 2, "COMPOSICAO", 2),
+    (1, 100, "INSUMO", 1),
+    (2, 100, "INSUMO", 3),
+    (2, 200, "INSUMO", 0.5),
+    (3, 1, "COMPOSICAO", 1),
+    (3, 2, "COMPOSICAO", 1),
+    (3, 300, "INSUMO", 4),
+]
+UNIDADES = {100: "KG", 200: "H", 300: "CHP"}
+PRECOS = {100: 10.0, 200: 20.0, 300: 5.0}
+
+
+def _by_code(result, field):
+    return {int(c): v for c, v in zip(result["codigo"], result[field])}
+
+
+def test_rollup_matches_recursive_cost():
+    result = compute_rollup(CompositionGraph(EDGES, unidades=UNIDADES), PRECOS)
+    custo = _by_code(result, "custo")
+    assert custo[2] == pytest.approx(3 * 10 + 0.5 * 20)          # 40
+    assert custo[1] == pytest.approx(10 + 2 * 40)                # 90
+    assert custo[3] == pytest.approx(90 + 40 + 4 * 5)            # 150
+
+
+def test_rollup_splits_labor_material_equipment():
+    result = compute_rollup(CompositionGraph(EDGES, unidades=UNIDADES), PRECOS)
+    assert _by_code(result, "mao_de_obra")[3] == pytest.approx(30)     # 1.5 h * 20
+    assert _by_code(result, "material")[3] == pytest.approx(100)       # 10 kg * 10
+    assert _by_code(result, "equipamento")[3] == pytest.approx(20)
+    assert _by_code(result, "total_hh")[3] == pytest.approx(1.5)
+
+
+def test_missing_prices_are_counted_and_cycles_invalidated():
+    result = compute_rollup(CompositionGraph(EDGES, unidades=UNIDADES), {100: 10.0, 300: 5.0})
+    assert _by_code(result, "itens_sem_preco") == {1: 1, 2: 1, 3: 2}
+
+    cyclic = CompositionGraph(EDGES + [(2, 3, "COMPOSICAO", 1)], unidades=UNIDADES)
+    assert not compute_rollup(cyclic, PRECOS)["valido"].any()
+
+
+def test_compare_flags_divergences_over_tolerance():
+    result = compute_rollup(CompositionGraph(EDGES, unidades=UNIDADES), PRECOS)
+    linhas = {l["composicao_codigo"]: l for l in compare_with_official(result, {1: 90.5, 2: 40.0}, tolerance=0.001)}
+    assert linhas[1]["divergente"] and linhas[1]["diferenca"] == pytest.approx(-0.5)
+    assert not linhas[2]["divergente"]
+    assert linhas[3]["custo_oficial"] is None and not linhas[3]["divergente"]